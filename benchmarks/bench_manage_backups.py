@@ -0,0 +1,146 @@
+#!/usr/bin/env python3
+"""
+Benchmarks hot paths of manage_backups.py on synthetic backup directories.
+
+Every run creates directories with the requested numbers of empty backup files (spread over the last 3 years,
+plus some unrelated files), times listing, splitting, retention, a dry auto-clean and name generation, and writes
+one JSON object per measurement. Compare results of two revisions to catch regressions.
+
+Example:
+  benchmarks/bench_manage_backups.py --sizes 10000 100000 --locations /dev/shm /var/tmp --output results.jsonl
+"""
+
+import argparse
+import json
+import os
+import shutil
+import statistics
+import sys
+import tempfile
+import time
+from datetime import datetime, timedelta
+from types import SimpleNamespace
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), os.pardir, "scripts"))
+import manage_backups  # noqa: E402
+
+PREFIX = "bench"
+EXTENSION = ".tar.gz"
+# Backups are spread over this period
+SPAN = timedelta(days=3 * 365)
+# Every that many backups, an unrelated file is created to exercise filtering
+UNRELATED_FILE_EVERY = 10
+
+
+def configure_parser():
+  parser = argparse.ArgumentParser(
+    description='Benchmarks listing and retention hot paths of manage_backups.py on synthetic directories'
+  )
+  parser.add_argument("--sizes", type=int, nargs="+", default=[10000, 100000, 1000000],
+                      help="Numbers of backup files in synthetic directories (default: 10k, 100k and 1M)")
+  parser.add_argument("--locations", type=str, nargs="+", default=["/dev/shm", tempfile.gettempdir()],
+                      help="Parent directories for synthetic directories, e.g. a tmpfs and a disk-backed one")
+  parser.add_argument("--repeat", type=int, default=3,
+                      help="How many times every measurement is repeated (default: 3)")
+  parser.add_argument("--output", type=str, default="-",
+                      help="File to write JSON lines with results to (default: stdout)")
+  return parser
+
+
+def create_backup_dir(location, size):
+  backup_dir = tempfile.mkdtemp(prefix="bench_manage_backups_%s_" % size, dir=location)
+  # Leave room for generate_name() to succeed
+  newest = datetime.now().replace(microsecond=0) - timedelta(hours=1)
+  # Second precision of names limits how densely backups can be spread
+  step = max(SPAN / size, timedelta(seconds=1))
+  for i in range(size):
+    timestamp = (newest - step * i).strftime(manage_backups.DATE_STRING_FORMAT)
+    os.close(os.open(os.path.join(backup_dir, "%s__%s%s" % (PREFIX, timestamp, EXTENSION)),
+                     os.O_WRONLY | os.O_CREAT | os.O_EXCL, 0o644))
+    if i % UNRELATED_FILE_EVERY == 0:
+      os.close(os.open(os.path.join(backup_dir, "unrelated_%s.log" % i), os.O_WRONLY | os.O_CREAT, 0o644))
+  return backup_dir
+
+
+def create_args(backup_dir):
+  args = SimpleNamespace()
+  args.backup_dest_dir = backup_dir
+  args.prefix = PREFIX
+  args.extension = EXTENSION
+  args.catalog_file = None
+  args.dedup_store = None
+  args.verify_state_file = None
+  args.max_total_size_mb = None
+  args.min_free_space_mb = None
+  args.policy_file = None
+  args.dry_mode = True
+  args.delete_workers = 4
+  args.gentle_delete_rate_mb = None
+  args.gentle_delete_in_background = False
+  args.daily_backups_max_count = 5
+  args.weekly_backups_max_count = 3
+  args.monthly_backups_max_count = 6
+  args.yearly_backups_max_count = 2
+  return args
+
+
+def measure(repeat, function):
+  timings = []
+  for _ in range(repeat):
+    started = time.perf_counter()
+    function()
+    timings.append(time.perf_counter() - started)
+  return {"min_seconds": min(timings), "median_seconds": statistics.median(timings), "repeat": repeat}
+
+
+def run_benchmarks(location, size, repeat):
+  """
+  :return: a list of result dicts
+  """
+  backup_dir = create_backup_dir(location, size)
+  try:
+    args = create_args(backup_dir)
+    backups = manage_backups._list_backup_files(args)
+    now_timestamp = datetime.now().timestamp()
+    catalog_dir = tempfile.mkdtemp(prefix="bench_manage_backups_catalog_", dir=location)
+    catalog_args = create_args(backup_dir)
+    catalog_args.catalog_file = os.path.join(catalog_dir, "catalog")
+    benchmarks = [
+      ("list_backup_files", lambda: manage_backups._list_backup_files(args)),
+      ("split_backups", lambda: manage_backups._split_backups(backups, now_timestamp)),
+      ("choose_valuable_backups", lambda: manage_backups._choose_valuable_backups(backups, args)),
+      ("auto_clean_dry_mode", lambda: manage_backups.auto_clean(args)),
+      ("generate_name", lambda: manage_backups.generate_name(args)),
+      # The first sync fills the catalog, following ones only check directory mtime
+      ("catalog_first_sync", lambda: manage_backups._sync_catalog(catalog_args)),
+      ("list_backup_files_with_catalog", lambda: manage_backups._list_backup_files(catalog_args)),
+    ]
+    results = []
+    for name, function in benchmarks:
+      # The first sync can only be measured once per catalog
+      result = measure(1 if name == "catalog_first_sync" else repeat, function)
+      result.update({"benchmark": name, "size": size, "location": location, "backups_found": len(backups),
+                     "python": sys.version.split()[0], "time": datetime.now().isoformat()})
+      results.append(result)
+    shutil.rmtree(catalog_dir)
+    return results
+  finally:
+    shutil.rmtree(backup_dir)
+
+
+def main():
+  args = configure_parser().parse_args()
+  output = sys.stdout if args.output == "-" else open(args.output, "a")
+  try:
+    for location in args.locations:
+      for size in args.sizes:
+        for result in run_benchmarks(location, size, args.repeat):
+          output.write(json.dumps(result, sort_keys=True) + "\n")
+          output.flush()
+  finally:
+    if output is not sys.stdout:
+      output.close()
+
+
+if __name__ == "__main__":
+  main()
@@ -1,18 +1,93 @@
 #!/usr/bin/env python3
 
 import argparse
+import codecs
+import collections
+import concurrent.futures
+import fcntl
+import glob
+import hashlib
+import json
 import math
+import mmap
 import os
 import pathlib
+import re
+import select
+import struct
 import subprocess
+import time
 
 TIMEOUT = 60
 INCREASED_TIMEOUT = TIMEOUT * 15
 
 SNAPSHOT_MOUNT_ACTION = 'snapshot-mount'
 SNAPSHOT_UNMOUNT_ACTION = 'snapshot-unmount'
-
-DD_BLOCK_SIZE = 16
+SNAPSHOT_IMAGE_ACTION = 'snapshot-image'
+IMAGE_APPLY_DELTA_ACTION = 'image-apply-delta'
+SNAPSHOT_WATCH_ACTION = 'snapshot-watch'
+SNAPSHOT_SET_MOUNT_ACTION = 'snapshot-set-mount'
+SNAPSHOT_SET_UNMOUNT_ACTION = 'snapshot-set-unmount'
+
+TMP_FILE_ALLOCATION_AUTO = 'auto'
+TMP_FILE_ALLOCATION_FALLOCATE = 'fallocate'
+TMP_FILE_ALLOCATION_ZERO_FILL = 'zero-fill'
+TMP_FILE_ALLOCATION_SPARSE = 'sparse'
+# Filesystems that reserve space for fallocate() without writing it. On others, glibc emulates it by writing
+FALLOCATE_FILESYSTEMS = ["ext4", "xfs", "btrfs", "f2fs", "ocfs2", "gfs2", "tmpfs"]
+# Size of a single write of zeros, and the granularity of tmp file sizes, in megabytes
+ALLOCATION_BLOCK_MB = 16
+PROGRESS_INTERVAL_SECONDS = 5
+# Suffix of a file that records the loop device a tmp file is attached to
+LOOP_DEVICE_RECORD_SUFFIX = ".loop-device"
+
+LVM_BINARY = '/sbin/lvm'
+# The LVM shell prints it when it is ready for the next command
+LVM_SHELL_PROMPT = 'lvm> '
+# Outputs of LVM reporting commands run during the current run, see lvm_report()
+lvm_report_cache = {}
+# LVM shell that runs LVM commands during the current run, see start_lvm_shell()
+lvm_shell = None
+# LVM binary given by --lvm-binary option, for the shell and for commands run without it
+lvm_binary = LVM_BINARY
+
+# Offsets of O_DIRECT reads, and their sizes, are aligned to this value
+IMAGE_ALIGNMENT = 4096
+# All-zero blocks of this size are not written to the image and stay holes
+IMAGE_ZERO_BLOCK_SIZE = 64 * 1024
+IMAGE_ZERO_BLOCK = bytes(IMAGE_ZERO_BLOCK_SIZE)
+
+# Snapshots are never auto sized smaller than this
+AUTO_SIZE_MIN_MB = 256
+# Number of previous runs of a snapshot that are kept in its history
+SNAPSHOT_HISTORY_RUNS = 30
+SECTOR_SIZE = 512
+
+# ioctls of linux/fs.h that freeze and thaw a filesystem, as fsfreeze does
+FIFREEZE = 0xC0045877
+FITHAW = 0xC0045878
+# Before this kernel version, device mapper can not suspend a volume with lockfs while its filesystem is frozen
+NESTED_FREEZE_MIN_KERNEL = (6, 6)
+
+BLOCK_INDEX_VERSION = 1
+DELTA_VERSION = 1
+BLOCK_HASH_SIZE = hashlib.sha256().digest_size
+# Number of a changed block and size of its data that follows, zero for an all-zero block
+DELTA_RECORD = struct.Struct("<QI")
+
+EXT_SUPERBLOCK_OFFSET = 1024
+EXT_MAGIC = 0xEF53
+EXT_FEATURE_INCOMPAT_RECOVER = 0x4
+EXT_FEATURE_INCOMPAT_META_BG = 0x10
+EXT_FEATURE_INCOMPAT_64BIT = 0x80
+EXT_FEATURE_RO_COMPAT_BIGALLOC = 0x200
+# Features that do not change the meaning of block bitmaps and the layout of block groups. Filesystems with other
+# features are read whole
+EXT_KNOWN_FEATURES_INCOMPAT = 0x2 | EXT_FEATURE_INCOMPAT_RECOVER | EXT_FEATURE_INCOMPAT_META_BG | 0x40 | \
+    EXT_FEATURE_INCOMPAT_64BIT | 0x100 | 0x200 | 0x400 | 0x2000 | 0x4000 | 0x8000 | 0x10000 | 0x20000
+EXT_KNOWN_FEATURES_RO_COMPAT = 0x1 | 0x2 | 0x4 | 0x8 | 0x10 | 0x20 | 0x40 | 0x100 | 0x400 | 0x1000 | 0x2000 | \
+    0x8000 | 0x10000
+EXT_BG_BLOCK_UNINIT = 0x2
 
 
 def configure_parser():
@@ -22,54 +97,137 @@ def configure_parser():
     )
     parser.add_argument('-v', '--verbose', action="count",
                         help="controls verbosity. May be specified multiple times")
+    parser.add_argument("--lvm-binary", type=str, default=LVM_BINARY,
+                        help="Path to the lvm tool (default is %s). All LVM commands of an action run at a single "
+                             "lvm shell session" % LVM_BINARY)
 
     lvm_group = parser.add_argument_group("Loop device, temporary file and LVM snapshot options")
     lvm_group.add_argument("--lvm-volume-size-mb", type=int, default=4096,
                            help="Size of LVM snapshot volume in megabytes (default is 4096). This space is used "
                                 "only to store changes that are written to the source volume while snapshot exists. "
-                                "If this space is exhausted, snapshot disappears.")
-    lvm_group.add_argument("--source-lvm-vg", type=str, required=True,
-                           help="Name of LVM volume group")
-    lvm_group.add_argument("--source-lvm-lv", type=str, required=True,
-                           help="Name of LVM logical volume")
-    lvm_group.add_argument("--lvm-snapshot-name", type=str, required=True,
-                           help="Name of LVM snapshot")
+                                "If this space is exhausted, snapshot disappears. Not used for thin provisioned "
+                                "volumes, their snapshots take space from the thin pool as needed.")
+    lvm_group.add_argument("--source-lvm-vg", type=str,
+                           help="Name of LVM volume group. Required for all actions but %s" % IMAGE_APPLY_DELTA_ACTION)
+    lvm_group.add_argument("--source-lvm-lv", type=str,
+                           help="Name of LVM logical volume. Required for all actions but %s"
+                                % IMAGE_APPLY_DELTA_ACTION)
+    lvm_group.add_argument("--lvm-snapshot-name", type=str,
+                           help="Name of LVM snapshot. Required for all actions but %s" % IMAGE_APPLY_DELTA_ACTION)
     lvm_group.add_argument("--lvm-snapshot-tmp-file", type=str,
                            help="Use this option if LVM volume has no enough unallocated space to create a snapshot."
                                 "A temporary file will be created at this path, and it will be mounted "
                                 "on a loop device. This loop device will then be added as a physical volume into "
                                 "the same volume group. During snapshot unmount (or after unsuccessful mount), "
                                 "the physical volume, loop device and temporary file will be attempted to be removed. "
-                                "This option should be specified during unmount as well. Option should be always used "
-                                "in conjunction with --loop-device option. Consider also --use-fallocate flag."
+                                "This option should be specified during unmount as well. A free loop device is "
+                                "taken automatically, unless --loop-device option is used. "
+                                "Consider also --tmp-file-allocation option. "
                                 "WARNING: Never specify path that is located on a logical volume being snapshoted,"
                                 "otherwise the entire filesystem will hang during snapshot creation")
     lvm_group.add_argument("--loop-device", type=str,
                            help="Full path to the loop device. Valid only if --lvm-snapshot-tmp-file option "
-                                "is specified. Loop device should already exist")
+                                "is specified. Loop device should already exist. By default, a free loop device is "
+                                "found during mount, and recorded next to the tmp file for unmount")
+    lvm_group.add_argument("--tmp-file-allocation", type=str, default=TMP_FILE_ALLOCATION_AUTO,
+                           choices=[TMP_FILE_ALLOCATION_AUTO, TMP_FILE_ALLOCATION_FALLOCATE,
+                                    TMP_FILE_ALLOCATION_ZERO_FILL, TMP_FILE_ALLOCATION_SPARSE],
+                           help="Matters only when --lvm-snapshot-tmp-file option is used. '{0}' reserves space "
+                                "without writing it, and works only on some filesystems (e.g. local ext4 or xfs). "
+                                "'{1}' writes zeros with direct I/O, bypassing the page cache. '{2}' creates a "
+                                "sparse file instantly, but the snapshot fails if the filesystem runs out of space "
+                                "later. '{3}' (default) picks '{0}' or '{1}' by the type of the filesystem"
+                           .format(TMP_FILE_ALLOCATION_FALLOCATE, TMP_FILE_ALLOCATION_ZERO_FILL,
+                                   TMP_FILE_ALLOCATION_SPARSE, TMP_FILE_ALLOCATION_AUTO))
     lvm_group.add_argument("--use-fallocate", action="store_true",
-                           help="Matters only when --lvm-snapshot-tmp-dir option is used. If specified, uses "
-                                "'fallocate' method to create a temporary file. That is faster then dd command that is "
-                                "used by default, but works only on some filesystems (e.g. local ext4). ")
+                           help="Deprecated, same as --tmp-file-allocation %s" % TMP_FILE_ALLOCATION_FALLOCATE)
+    lvm_group.add_argument("--snapshot-history-file", type=str,
+                           help="Record size, duration and peak usage of every snapshot to this file. Should be "
+                                "specified both during mount and unmount")
+    lvm_group.add_argument("--auto-size", action="store_true",
+                           help="Choose the size of the snapshot instead of --lvm-volume-size-mb, from the current "
+                                "write rate of the source volume, and from durations and peak usages of previous runs "
+                                "kept at --snapshot-history-file. Until there is history, --lvm-volume-size-mb is used")
+    lvm_group.add_argument("--write-sample-seconds", type=float, default=10,
+                           help="Matters only with --auto-size. Time to measure the write rate of the source volume "
+                                "in seconds (default is 10)")
+    lvm_group.add_argument("--auto-size-margin", type=float, default=2.0,
+                           help="Matters only with --auto-size. The predicted usage of the snapshot is multiplied "
+                                "by this factor (default is 2.0)")
 
     backup_group = parser.add_argument_group("Mounting and unmounting", "Mount stage options")
-    backup_group.add_argument("--mountpoint", type=str, required=True,
-                              help="Target directory for snapshot mount. If it does not exist, it will be created.")
+    backup_group.add_argument("--mountpoint", type=str,
+                              help="Target directory for snapshot mount. If it does not exist, it will be created. "
+                                   "Required for %s and %s actions" % (SNAPSHOT_MOUNT_ACTION, SNAPSHOT_UNMOUNT_ACTION))
     backup_group.add_argument("--remove-mountpoint", action="store_true",
                               help="Remove snapshot mount directory during unmount. "
                                    "Valid only for %s action" % SNAPSHOT_UNMOUNT_ACTION)
 
+    image_group = parser.add_argument_group("Block image", "Options of %s action" % SNAPSHOT_IMAGE_ACTION)
+    image_group.add_argument("--image-file", type=str,
+                             help="Path of a sparse image file to copy the snapshot device into. Required for %s "
+                                  "action. All-zero blocks of the device become holes of the image. For %s action, "
+                                  "path of the image that deltas are applied to"
+                                  % (SNAPSHOT_IMAGE_ACTION, IMAGE_APPLY_DELTA_ACTION))
+    image_group.add_argument("--image-read-mb", type=int, default=8,
+                             help="Size of direct reads from the snapshot device in megabytes (default is 8)")
+    image_group.add_argument("--image-skip-free-blocks", action="store_true",
+                             help="Do not read blocks that are free according to the block bitmaps of the "
+                                  "filesystem on the snapshot. They become holes of the image. Supported for clean "
+                                  "ext2/ext3/ext4 filesystems, the whole device is read otherwise")
+    image_group.add_argument("--block-index-file", type=str,
+                             help="Path of an index with hashes of all blocks of the device, that is kept between "
+                                  "runs. If the index exists, only blocks changed since it was written are copied, "
+                                  "and --image-file receives a delta instead of a full image. Use %s action to "
+                                  "restore a full image from the first image and its deltas" % IMAGE_APPLY_DELTA_ACTION)
+    image_group.add_argument("--tracked-block-kb", type=int, default=1024,
+                             help="Size of blocks hashed at the block index in kilobytes (default is 1024). Should "
+                                  "not change between runs that share an index")
+    image_group.add_argument("--hash-workers", type=int, default=os.cpu_count(),
+                             help="Number of processes that hash blocks (default is the number of CPUs)")
+    image_group.add_argument("--delta-file", type=str, action="append",
+                             help="Delta to apply to --image-file during %s action. May be specified multiple "
+                                  "times, deltas are applied in the given order" % IMAGE_APPLY_DELTA_ACTION)
+
+    watch_group = parser.add_argument_group("Snapshot watchdog", "Options of %s action" % SNAPSHOT_WATCH_ACTION)
+    watch_group.add_argument("--watch-interval-seconds", type=float, default=5,
+                             help="Interval between checks of snapshot usage in seconds (default is 5)")
+    watch_group.add_argument("--extend-threshold-percent", type=float, default=80,
+                             help="Extend the snapshot when this share of its space is used (default is 80)")
+    watch_group.add_argument("--extend-step-mb", type=int, default=1024,
+                             help="Extend the snapshot by this number of megabytes at least (default is 1024). "
+                                  "If the snapshot fills faster, it is extended by twice the amount it fills "
+                                  "during an interval. If the volume group has no enough free space and "
+                                  "--lvm-snapshot-tmp-file is used, the temporary file is grown first")
+    watch_group.add_argument("--watch-metrics-file", type=str,
+                             help="Append snapshot usage and fill rate of every check to this file, as JSON lines")
+
+    set_group = parser.add_argument_group("Snapshot set", "Options of %s and %s actions"
+                                          % (SNAPSHOT_SET_MOUNT_ACTION, SNAPSHOT_SET_UNMOUNT_ACTION))
+    set_group.add_argument("--snapshot-set-lv", type=str, action="append",
+                           help="Logical volume of --source-lvm-vg to snapshot as a part of a consistent set, as "
+                                "LV:SNAPSHOT_NAME:MOUNTPOINT. Should be specified for every volume of the set, "
+                                "instead of --source-lvm-lv, --lvm-snapshot-name and --mountpoint options. Classic "
+                                "snapshots take --lvm-volume-size-mb each, --lvm-snapshot-tmp-file holds all of them")
+
     parser.add_argument('action', metavar="ACTION",
-                        choices=[SNAPSHOT_MOUNT_ACTION, SNAPSHOT_UNMOUNT_ACTION],
-                        help="%s creates snapshot and mounts it, %s unmounts snapshot and "
-                             "removes it" % (SNAPSHOT_MOUNT_ACTION, SNAPSHOT_UNMOUNT_ACTION))
+                        choices=[SNAPSHOT_MOUNT_ACTION, SNAPSHOT_UNMOUNT_ACTION, SNAPSHOT_IMAGE_ACTION,
+                                 IMAGE_APPLY_DELTA_ACTION, SNAPSHOT_WATCH_ACTION, SNAPSHOT_SET_MOUNT_ACTION,
+                                 SNAPSHOT_SET_UNMOUNT_ACTION],
+                        help="%s creates snapshot and mounts it, %s unmounts snapshot and removes it, %s creates "
+                             "snapshot, copies it into an image file and removes it, %s applies deltas to an "
+                             "image, %s extends the snapshot as it fills until it is removed, %s creates "
+                             "snapshots of several volumes at the same moment and mounts them, %s unmounts and "
+                             "removes them"
+                             % (SNAPSHOT_MOUNT_ACTION, SNAPSHOT_UNMOUNT_ACTION, SNAPSHOT_IMAGE_ACTION,
+                                IMAGE_APPLY_DELTA_ACTION, SNAPSHOT_WATCH_ACTION, SNAPSHOT_SET_MOUNT_ACTION,
+                                SNAPSHOT_SET_UNMOUNT_ACTION))
     return parser
 
 
 def validate_args(args):
-    if args.lvm_snapshot_tmp_file and not args.loop_device \
-            or not args.lvm_snapshot_tmp_file and args.loop_device:
-        raise ValueError("--lvm-snapshot-tmp-file option and --loop-device option should always be used together")
+    if args.loop_device and not args.lvm_snapshot_tmp_file:
+        raise ValueError("--loop-device option is valid only with --lvm-snapshot-tmp-file option")
 
     if args.lvm_snapshot_tmp_file and not os.path.isabs(args.lvm_snapshot_tmp_file):
         raise ValueError("Argument passed to --lvm-snapshot-tmp-file option should be an absolute path")
@@ -77,21 +235,112 @@ def validate_args(args):
     if args.loop_device and not os.path.isabs(args.loop_device):
         raise ValueError("Argument passed to --loop-device option should be an absolute path")
 
-    if args.lvm_snapshot_tmp_file and not os.path.isabs(args.mountpoint):
+    if args.lvm_snapshot_tmp_file and args.mountpoint and not os.path.isabs(args.mountpoint):
         raise ValueError("Argument passed to --mountpoint option should be an absolute path")
 
+    if args.image_read_mb < 1:
+        raise ValueError("--image-read-mb should be a positive number")
+
+    if args.action in [SNAPSHOT_MOUNT_ACTION, SNAPSHOT_UNMOUNT_ACTION] and not args.mountpoint:
+        raise ValueError("--mountpoint option is required for %s action" % args.action)
+
+    if args.tracked_block_kb < 4 or args.tracked_block_kb * 1024 % IMAGE_ALIGNMENT:
+        raise ValueError("--tracked-block-kb should be a positive multiple of %s" % (IMAGE_ALIGNMENT // 1024))
+
+    if args.hash_workers < 1:
+        raise ValueError("--hash-workers should be a positive number")
+
+    set_actions = [SNAPSHOT_SET_MOUNT_ACTION, SNAPSHOT_SET_UNMOUNT_ACTION]
+    if args.action in set_actions:
+        if not args.source_lvm_vg or not args.snapshot_set_lv:
+            raise ValueError("--source-lvm-vg and --snapshot-set-lv options are required for %s action" % args.action)
+        if args.source_lvm_lv or args.lvm_snapshot_name or args.mountpoint:
+            raise ValueError("--source-lvm-lv, --lvm-snapshot-name and --mountpoint options are given for every "
+                             "volume by --snapshot-set-lv option during %s action" % args.action)
+        if args.snapshot_history_file:
+            raise ValueError("--snapshot-history-file option is not supported for %s action" % args.action)
+        for member in snapshot_set_members(args):
+            if not (member.source_lvm_lv and member.lvm_snapshot_name and os.path.isabs(member.mountpoint)):
+                raise ValueError("Argument passed to --snapshot-set-lv option should be LV:SNAPSHOT_NAME:MOUNTPOINT, "
+                                 "where MOUNTPOINT is an absolute path")
+    elif args.snapshot_set_lv:
+        raise ValueError("--snapshot-set-lv option is valid only for %s and %s actions" % tuple(set_actions))
+    elif args.action != IMAGE_APPLY_DELTA_ACTION \
+            and not (args.source_lvm_vg and args.source_lvm_lv and args.lvm_snapshot_name):
+        raise ValueError("--source-lvm-vg, --source-lvm-lv and --lvm-snapshot-name options are required for %s action"
+                         % args.action)
+
+    if args.action not in [SNAPSHOT_IMAGE_ACTION, IMAGE_APPLY_DELTA_ACTION] and args.image_file:
+        raise ValueError("--image-file option is valid only for %s and %s actions"
+                         % (SNAPSHOT_IMAGE_ACTION, IMAGE_APPLY_DELTA_ACTION))
+
+    if args.action != SNAPSHOT_IMAGE_ACTION and (args.image_skip_free_blocks or args.block_index_file):
+        raise ValueError("--image-skip-free-blocks and --block-index-file options are valid only for %s action"
+                         % SNAPSHOT_IMAGE_ACTION)
+
+    if args.action != IMAGE_APPLY_DELTA_ACTION and args.delta_file:
+        raise ValueError("--delta-file option is valid only for %s action" % IMAGE_APPLY_DELTA_ACTION)
+
+    if args.auto_size and not args.snapshot_history_file:
+        raise ValueError("--auto-size option requires --snapshot-history-file option")
+
+    if args.write_sample_seconds <= 0 or args.auto_size_margin < 1:
+        raise ValueError("--write-sample-seconds should be positive, and --auto-size-margin should be at least 1")
+
+    if args.watch_interval_seconds <= 0 or args.extend_step_mb < 1:
+        raise ValueError("--watch-interval-seconds and --extend-step-mb should be positive numbers")
+
+    if not 0 < args.extend_threshold_percent < 100:
+        raise ValueError("--extend-threshold-percent should be between 0 and 100")
+
+    if args.action != SNAPSHOT_WATCH_ACTION and args.watch_metrics_file:
+        raise ValueError("--watch-metrics-file option is valid only for %s action" % SNAPSHOT_WATCH_ACTION)
+
     if args.action == SNAPSHOT_MOUNT_ACTION:
         # Quick validation
         if args.remove_mountpoint:
             raise ValueError("--remove-mountpoint flag is not applicable during mount")
     elif args.action == SNAPSHOT_UNMOUNT_ACTION:
         pass
+    elif args.action == SNAPSHOT_IMAGE_ACTION:
+        if not args.image_file:
+            raise ValueError("--image-file option is required for %s action" % SNAPSHOT_IMAGE_ACTION)
+        if args.mountpoint or args.remove_mountpoint:
+            raise ValueError("Snapshot is not mounted during %s action" % SNAPSHOT_IMAGE_ACTION)
+    elif args.action == IMAGE_APPLY_DELTA_ACTION:
+        if not args.image_file or not args.delta_file:
+            raise ValueError("--image-file and --delta-file options are required for %s action"
+                             % IMAGE_APPLY_DELTA_ACTION)
+    elif args.action == SNAPSHOT_WATCH_ACTION:
+        pass
+    elif args.action == SNAPSHOT_SET_MOUNT_ACTION:
+        if args.remove_mountpoint:
+            raise ValueError("--remove-mountpoint flag is not applicable during mount")
+    elif args.action == SNAPSHOT_SET_UNMOUNT_ACTION:
+        pass
     else:
         raise ValueError("Unknown action %s" % args.action)
 
 
 def mount_snapshot(args):
     print("Performing %s action" % SNAPSHOT_MOUNT_ACTION)
+    snapshot_dev = take_snapshot(args)
+    mountpoint = os.path.abspath(args.mountpoint)
+    mount(snapshot_dev, mountpoint)
+
+
+def image_snapshot(args):
+    print("Performing %s action" % SNAPSHOT_IMAGE_ACTION)
+    snapshot_dev = take_snapshot(args)
+    write_image(snapshot_dev, args.image_file, args.image_read_mb * 1024 * 1024, args.image_skip_free_blocks,
+                args.block_index_file, args.tracked_block_kb * 1024, args.hash_workers)
+
+
+def take_snapshot(args):
+    """
+    Creates a snapshot of the source volume, extending the volume group with a tmp file if requested
+    :return: path to the snapshot device
+    """
     snapshot_dev = lvm_mapper_dev_name(args.source_lvm_vg, args.lvm_snapshot_name)
     source_lv_dev = lvm_mapper_dev_name(args.source_lvm_vg, args.source_lvm_lv)
 
@@ -101,31 +350,143 @@ def mount_snapshot(args):
     if not os.path.exists(source_lv_dev):
         raise EnvironmentError("Source logical volume device %s does not exist" % source_lv_dev)
 
+    thin_pool = find_thin_pool(args.source_lvm_vg, args.source_lvm_lv)
+    if thin_pool:
+        # Thin snapshot needs no preallocated space, and is not invalidated until the pool is exhausted
+        pool_report = lv_report(args.source_lvm_vg, thin_pool, ["data_percent", "metadata_percent"])
+        print("Source logical volume is thin provisioned at pool {0}/{1} (data {2}%, metadata {3}% used)"
+              .format(args.source_lvm_vg, thin_pool, pool_report["data_percent"], pool_report["metadata_percent"]))
+        if args.lvm_snapshot_tmp_file:
+            print("Thin snapshot takes space from the thin pool, not allocating tmp file %s"
+                  % args.lvm_snapshot_tmp_file)
+        create_thin_snapshot(args)
+        return snapshot_dev
+
+    if args.snapshot_history_file:
+        # The size of the tmp file depends on the size of the snapshot
+        args.lvm_volume_size_mb = size_snapshot(args)
+
     if args.lvm_snapshot_tmp_file:
         allocate_tmp_file(args)
         create_pv_based_on_tmp_file(args)
 
     create_snapshot(args)
-    mountpoint = os.path.abspath(args.mountpoint)
-    mount(snapshot_dev, mountpoint)
+    return snapshot_dev
+
+
+def size_snapshot(args):
+    """
+    Chooses the size of a snapshot, and records the run into the snapshot history.
+    With --auto-size, the snapshot should hold the larger of the peak usage of previous runs, and of the amount
+    written during the longest previous run at the current write rate, with a safety margin
+    :return: size in megabytes
+    """
+    snapshot_volume_id = "%s/%s" % (args.source_lvm_vg, args.lvm_snapshot_name)
+    history = read_snapshot_history(args.snapshot_history_file)
+    size_mb = args.lvm_volume_size_mb
+    write_rate = None
+    if args.auto_size:
+        source_lv_dev = lvm_mapper_dev_name(args.source_lvm_vg, args.source_lvm_lv)
+        print("Measuring write rate of {0} for {1:.0f} seconds".format(source_lv_dev, args.write_sample_seconds))
+        write_rate = sample_write_rate(source_lv_dev, args.write_sample_seconds)
+        runs = [run for run in history if run["snapshot"] == snapshot_volume_id and run["duration_seconds"]]
+        if runs:
+            longest_duration = max(run["duration_seconds"] for run in runs)
+            peak_used_mb = max(run["peak_used_mb"] for run in runs)
+            size_mb = max(math.ceil(args.auto_size_margin * max(peak_used_mb, write_rate * longest_duration)),
+                          AUTO_SIZE_MIN_MB)
+            print("Predicted snapshot size is {0} mb: write rate is {1:.2f} mb/s, the longest of {2} previous runs "
+                  "took {3:.0f} seconds, peak usage was {4:.0f} mb"
+                  .format(size_mb, write_rate, len(runs), longest_duration, peak_used_mb))
+        else:
+            print("Write rate is {0:.2f} mb/s. There are no previous runs of snapshot {1} to learn from, using "
+                  "--lvm-volume-size-mb of {2} mb".format(write_rate, snapshot_volume_id, size_mb))
+
+    history.append({"snapshot": snapshot_volume_id, "created_at": time.time(), "size_mb": size_mb,
+                    "write_rate_mb_per_second": write_rate, "duration_seconds": None, "peak_used_mb": None})
+    write_snapshot_history(args.snapshot_history_file, history)
+    return size_mb
+
+
+def record_snapshot_usage(args):
+    """
+    Records the duration of the current run and the peak usage of its snapshot into the snapshot history.
+    Snapshot usage only grows, so its current usage is the peak one
+    """
+    snapshot_volume_id = "%s/%s" % (args.source_lvm_vg, args.lvm_snapshot_name)
+    history = read_snapshot_history(args.snapshot_history_file)
+    run = next((run for run in reversed(history)
+                if run["snapshot"] == snapshot_volume_id and run["duration_seconds"] is None), None)
+    if run is None:
+        print("No record of snapshot %s at the snapshot history, not recording its usage" % snapshot_volume_id)
+        return
+    invalidate_lvm_reports()  # Usage changes without LVM commands
+    try:
+        report = lv_report(args.source_lvm_vg, args.lvm_snapshot_name, ["lv_size", "data_percent"])
+    except subprocess.CalledProcessError as e:
+        # Removal of the snapshot should go on anyway
+        print("Could not get usage of snapshot {0}: {1}".format(snapshot_volume_id, e))
+        return
+    run["duration_seconds"] = round(time.time() - run["created_at"], 1)
+    run["peak_used_mb"] = round(float(report["lv_size"]) * float(report["data_percent"]) / 100, 1)
+    print("Snapshot {0} of {1} mb had peak usage of {2:.0f} mb ({3}%) after {4:.0f} seconds"
+          .format(snapshot_volume_id, run["size_mb"], run["peak_used_mb"], report["data_percent"],
+                  run["duration_seconds"]))
+    write_snapshot_history(args.snapshot_history_file, history)
+
+
+def read_snapshot_history(snapshot_history_file):
+    if not os.path.exists(snapshot_history_file):
+        return []
+    with open(snapshot_history_file) as history_file:
+        return json.load(history_file)
+
+
+def write_snapshot_history(snapshot_history_file, history):
+    runs_per_snapshot = collections.Counter()
+    kept_runs = []
+    for run in reversed(history):
+        runs_per_snapshot[run["snapshot"]] += 1
+        if runs_per_snapshot[run["snapshot"]] <= SNAPSHOT_HISTORY_RUNS:
+            kept_runs.append(run)
+    tmp_file = snapshot_history_file + ".tmp"
+    with open(tmp_file, "w") as history_file:
+        json.dump(kept_runs[::-1], history_file, indent=1)
+    os.replace(tmp_file, snapshot_history_file)
+
+
+def sample_write_rate(device, seconds):
+    """
+    Measures write throughput of a device from its statistics at /sys/block
+    :param device: path to the device, e.g. /dev/mapper/vg-lv
+    :param seconds: duration of measurement
+    :return: megabytes per second
+    """
+    # /dev/mapper entries are links to /dev/dm-N
+    stat_file = "/sys/block/%s/stat" % os.path.basename(os.path.realpath(device))
+    sectors_written = read_sectors_written(stat_file)
+    time.sleep(seconds)
+    return (read_sectors_written(stat_file) - sectors_written) * SECTOR_SIZE / 1024 / 1024 / seconds
+
+
+def read_sectors_written(stat_file):
+    with open(stat_file) as stat:
+        # The 7th field is the number of sectors written, see Documentation/block/stat.rst of the kernel
+        return int(stat.read().split()[6])
 
 
 def allocate_tmp_file(args):
     dev_mapper_src_lv = lvm_mapper_dev_name(args.source_lvm_vg, args.source_lvm_lv)
     tmp_file = args.lvm_snapshot_tmp_file
     dir_containing_tmp_file = os.path.dirname(tmp_file)
-    size = args.lvm_volume_size_mb + 16  # At least 1 more 4mb extent is required for LVM physical volume metadata
-    use_fallocate = args.use_fallocate
+    # At least 1 more 4mb extent is required for LVM physical volume metadata
+    size = round_up(args.lvm_volume_size_mb + 16, ALLOCATION_BLOCK_MB)
 
     # Perform checks first
     if os.path.exists(tmp_file):
         raise EnvironmentError("tmp file %s already exists" % tmp_file)
 
-    mounts = list_mounts()
-    fs_containing_tmp_file = find_mount_point(dir_containing_tmp_file)
-    if fs_containing_tmp_file in mounts and mounts[fs_containing_tmp_file] == dev_mapper_src_lv:
-        raise EnvironmentError("Looks like you are trying to allocate tmp file on a logical volume that is being "
-                               "snapshoted. That would lead to system freeze")
+    check_tmp_file_location(tmp_file, dev_mapper_src_lv)
 
     statvfs_for_dir = os.statvfs(dir_containing_tmp_file)
     free_space = statvfs_for_dir.f_bavail * statvfs_for_dir.f_bsize / 1024 / 1024
@@ -137,45 +498,180 @@ def allocate_tmp_file(args):
     print("Trying to allocate tmp file at {0} of size {1:.0f} mb. Free space "
           "available: {2:.0f} mb. Watchdog timer: will cancel operation if takes more then {3} seconds"
           .format(tmp_file, size, free_space, INCREASED_TIMEOUT))
-    if use_fallocate:
-        print("Using fallocate to create a temporary file")
-        fallocate_cmd = ['/usr/bin/fallocate', '-l', "%sM" % size, tmp_file]
-        subprocess.run(fallocate_cmd, timeout=INCREASED_TIMEOUT, check=True)
+    allocate_file_space(tmp_file, 0, size, choose_allocation_strategy(args, dir_containing_tmp_file))
+
+
+def check_tmp_file_location(tmp_file, source_lv_dev):
+    mounts = list_mounts()
+    fs_containing_tmp_file = find_mount_point(os.path.dirname(tmp_file))
+    if fs_containing_tmp_file in mounts and mounts[fs_containing_tmp_file] == source_lv_dev:
+        raise EnvironmentError("Looks like you are trying to allocate tmp file on a logical volume that is being "
+                               "snapshoted. That would lead to system freeze")
+
+
+def choose_allocation_strategy(args, directory):
+    """
+    :return: allocation strategy of tmp file, resolving 'auto' by the type of the filesystem containing the directory
+    """
+    if args.use_fallocate:
+        return TMP_FILE_ALLOCATION_FALLOCATE
+    if args.tmp_file_allocation != TMP_FILE_ALLOCATION_AUTO:
+        return args.tmp_file_allocation
+    fs_type = filesystem_type(directory)
+    strategy = TMP_FILE_ALLOCATION_FALLOCATE if fs_type in FALLOCATE_FILESYSTEMS else TMP_FILE_ALLOCATION_ZERO_FILL
+    print("Filesystem at {0} has type {1}, using {2} allocation".format(directory, fs_type, strategy))
+    return strategy
+
+
+def allocate_file_space(path, offset, size_mb, strategy):
+    """
+    Allocates space of a file in process. Zeros are written with direct I/O, so that the page cache
+    is not flooded by them
+    :param path: path to the file, that is created if it does not exist
+    :param offset: offset of the allocated space in bytes, aligned to a megabyte
+    :param size_mb: size of the allocated space in megabytes
+    :param strategy: one of TMP_FILE_ALLOCATION_* values except TMP_FILE_ALLOCATION_AUTO
+    """
+    size = size_mb * 1024 * 1024
+    started_at = time.monotonic()
+    if strategy == TMP_FILE_ALLOCATION_ZERO_FILL:
+        write_zeros(path, offset, size, started_at)
     else:
-        print("Using dd with %s mb block size to create a temporary file" % DD_BLOCK_SIZE)
-        dd_blocks = math.ceil(size / DD_BLOCK_SIZE)
-        dd_cmd = ['/bin/dd', "if=/dev/zero", "of=%s" % tmp_file,
-                  "bs=%sM" % DD_BLOCK_SIZE, "count=%s" % dd_blocks]
-        subprocess.run(dd_cmd, timeout=INCREASED_TIMEOUT, check=True)
+        fd = os.open(path, os.O_WRONLY | os.O_CREAT, 0o600)
+        try:
+            if strategy == TMP_FILE_ALLOCATION_FALLOCATE:
+                os.posix_fallocate(fd, offset, size)
+            else:
+                os.ftruncate(fd, offset + size)
+            os.fsync(fd)
+        finally:
+            os.close(fd)
+    elapsed = time.monotonic() - started_at
+    print("Allocated {0} mb of file {1} with {2} allocation in {3:.1f} seconds ({4:.0f} mb/s)"
+          .format(size_mb, path, strategy, elapsed, size_mb / max(elapsed, 0.001)))
+
+
+def write_zeros(path, offset, size, started_at):
+    try:
+        fd = os.open(path, os.O_WRONLY | os.O_CREAT | os.O_DIRECT, 0o600)
+        direct = True
+    except OSError:
+        # Some filesystems do not support direct I/O
+        print("Direct I/O is not supported for %s, writing through the page cache" % path)
+        fd = os.open(path, os.O_WRONLY | os.O_CREAT, 0o600)
+        direct = False
+    buffer = mmap.mmap(-1, ALLOCATION_BLOCK_MB * 1024 * 1024)  # Page aligned and filled with zeros
+    try:
+        written = 0
+        reported_at = started_at
+        while written < size:
+            with memoryview(buffer) as view, view[:min(len(buffer), size - written)] as chunk:
+                count = os.pwrite(fd, chunk, offset + written)
+            if not direct:
+                # Do not evict the working set of the host with zeros
+                os.fdatasync(fd)
+                os.posix_fadvise(fd, offset + written, count, os.POSIX_FADV_DONTNEED)
+            written += count
+            now = time.monotonic()
+            if now - started_at > INCREASED_TIMEOUT:
+                raise EnvironmentError("Allocation of file {0} took more then {1} seconds, cancelling it"
+                                       .format(path, INCREASED_TIMEOUT))
+            if now - reported_at >= PROGRESS_INTERVAL_SECONDS:
+                print("Written {0:.0f} of {1:.0f} mb of file {2} ({3:.0f} mb/s)"
+                      .format(written / 1024 / 1024, size / 1024 / 1024, path,
+                              written / 1024 / 1024 / (now - started_at)))
+                reported_at = now
+        os.fsync(fd)
+    finally:
+        buffer.close()
+        os.close(fd)
 
 
 def create_pv_based_on_tmp_file(args):
     tmp_file = args.lvm_snapshot_tmp_file
     loop_device = args.loop_device
 
-    if not pathlib.Path(loop_device).is_block_device():
+    if loop_device and not pathlib.Path(loop_device).is_block_device():
         raise EnvironmentError("There is no block device at path %s. "
                                "Please check that it is an absolute path to device" % loop_device)
 
-    print("Attaching tmp file to loop device %s" % loop_device)
-    loop_dev_setup = ['/sbin/losetup', loop_device, tmp_file]
-    subprocess.run(loop_dev_setup, timeout=TIMEOUT, check=True)
+    loop_device = attach_loop_device(tmp_file, loop_device)
+    args.loop_device = loop_device  # For cleanup if something fails later
 
     print("Creating lvm physical volume on a loop device %s" % loop_device)
-    pvcreate_cmd = ['/sbin/pvcreate', loop_device]
-    subprocess.run(pvcreate_cmd, timeout=TIMEOUT, check=True)
+    pvcreate_cmd = ['pvcreate', loop_device]
+    run_lvm_command(pvcreate_cmd)
 
     print("Adding this physical volume to volume group %s" % args.source_lvm_vg)
-    vgextend_cmd = ['/sbin/vgextend', args.source_lvm_vg, loop_device]
-    subprocess.run(vgextend_cmd, timeout=TIMEOUT, check=True)
+    vgextend_cmd = ['vgextend', args.source_lvm_vg, loop_device]
+    run_lvm_command(vgextend_cmd)
+
+
+def attach_loop_device(tmp_file, loop_device):
+    """
+    Attaches a tmp file to a loop device with direct I/O, so that the data of the snapshot is not cached twice, for
+    the loop device and for the tmp file. The loop device is recorded next to the tmp file for cleanup
+    :param tmp_file: path to the tmp file
+    :param loop_device: path to a free loop device, or None to take any free one
+    :return: path to the loop device
+    """
+    target = [loop_device] if loop_device else ['--find']
+    direct_io_options = ['--direct-io=on']
+    # Direct I/O requires the loop device to have the logical block size of the device under the tmp file
+    sector_size = logical_block_size(os.path.dirname(tmp_file))
+    if sector_size:
+        direct_io_options += ['--sector-size', str(sector_size)]
+    print("Attaching tmp file {0} to loop device {1}".format(tmp_file, loop_device or "(first free one)"))
+    try:
+        losetup_result = subprocess.run(['/sbin/losetup', '--show'] + direct_io_options + target + [tmp_file],
+                                        stdout=subprocess.PIPE, timeout=TIMEOUT, check=True, universal_newlines=True)
+    except subprocess.CalledProcessError:
+        print("Could not attach tmp file with direct I/O, attaching it through the page cache")
+        losetup_result = subprocess.run(['/sbin/losetup', '--show'] + target + [tmp_file], stdout=subprocess.PIPE,
+                                        timeout=TIMEOUT, check=True, universal_newlines=True)
+    loop_device = losetup_result.stdout.strip()
+    print("Tmp file is attached to loop device %s" % loop_device)
+    with open(tmp_file + LOOP_DEVICE_RECORD_SUFFIX, "w") as record_file:
+        json.dump({"loop_device": loop_device, "tmp_file": tmp_file}, record_file)
+    return loop_device
+
+
+def find_loop_device(args):
+    """
+    :return: loop device given by --loop-device option, or the one recorded during mount, or the one the tmp file
+    is attached to, or None
+    """
+    if args.loop_device:
+        return args.loop_device
+    record_path = args.lvm_snapshot_tmp_file + LOOP_DEVICE_RECORD_SUFFIX
+    if os.path.exists(record_path):
+        with open(record_path) as record_file:
+            return json.load(record_file)["loop_device"]
+    for loop_device, backing_file in list_loop_devices().items():
+        if backing_file == args.lvm_snapshot_tmp_file:
+            return loop_device
+    return None
 
 
 def create_snapshot(args):
+    print("Creating snapshot %s/%s" % (args.source_lvm_vg, args.source_lvm_lv))
+    run_lvm_command(snapshot_creation_cmd(args))
+
+
+def snapshot_creation_cmd(args):
     source_volume_id = "%s/%s" % (args.source_lvm_vg, args.source_lvm_lv)
-    print("Creating snapshot %s" % source_volume_id)
-    snapshot_creation_cmd = ['/sbin/lvcreate', '-s', '-n', args.lvm_snapshot_name,
-                             "-L", "%sm" % args.lvm_volume_size_mb, source_volume_id]
-    subprocess.run(snapshot_creation_cmd, timeout=TIMEOUT, check=True)
+    return ['lvcreate', '-s', '-n', args.lvm_snapshot_name, "-L", "%sm" % args.lvm_volume_size_mb, source_volume_id]
+
+
+def create_thin_snapshot(args):
+    print("Creating thin snapshot %s/%s" % (args.source_lvm_vg, args.source_lvm_lv))
+    run_lvm_command(thin_snapshot_creation_cmd(args))
+
+
+def thin_snapshot_creation_cmd(args):
+    source_volume_id = "%s/%s" % (args.source_lvm_vg, args.source_lvm_lv)
+    # Thin snapshots are skipped during activation by default, so their devices would not appear
+    return ['lvcreate', '-s', '--setactivationskip', 'n', '-n', args.lvm_snapshot_name, source_volume_id]
 
 
 def mount(snapshot_dev, mountpoint):
@@ -209,12 +705,543 @@ def mount(snapshot_dev, mountpoint):
     subprocess.run(mount_cmd, timeout=TIMEOUT, check=True)
 
 
+def mount_snapshot_set(args):
+    print("Performing %s action" % SNAPSHOT_SET_MOUNT_ACTION)
+    members = snapshot_set_members(args)
+    take_snapshot_set(args, members)
+    with concurrent.futures.ThreadPoolExecutor(max_workers=len(members)) as executor:
+        mounts = [executor.submit(mount, lvm_mapper_dev_name(member.source_lvm_vg, member.lvm_snapshot_name),
+                                  member.mountpoint) for member in members]
+        for future in mounts:
+            future.result()
+
+
+def take_snapshot_set(args, members):
+    """
+    Creates snapshots of several volumes at the same moment. Everything that takes time is done in advance, and then
+    the filesystems of the volumes are frozen only while the snapshots are created one right after another
+    :param members: arguments of the volumes, see snapshot_set_members()
+    """
+    mounts = list_mounts()
+    creation_cmds = []
+    classic_members = []
+    for member in members:
+        snapshot_dev = lvm_mapper_dev_name(member.source_lvm_vg, member.lvm_snapshot_name)
+        source_lv_dev = lvm_mapper_dev_name(member.source_lvm_vg, member.source_lvm_lv)
+        if os.path.exists(snapshot_dev):
+            raise EnvironmentError("Device at %s already exists" % snapshot_dev)
+        if not os.path.exists(source_lv_dev):
+            raise EnvironmentError("Source logical volume device %s does not exist" % source_lv_dev)
+        if member.mountpoint in mounts:
+            raise ValueError("Mountpoint %s seems to be already mounted" % member.mountpoint)
+        if find_thin_pool(member.source_lvm_vg, member.source_lvm_lv):
+            creation_cmds.append(thin_snapshot_creation_cmd(member))
+        else:
+            creation_cmds.append(snapshot_creation_cmd(member))
+            classic_members.append(member)
+
+    if args.lvm_snapshot_tmp_file and classic_members:
+        for member in classic_members:
+            check_tmp_file_location(args.lvm_snapshot_tmp_file,
+                                    lvm_mapper_dev_name(member.source_lvm_vg, member.source_lvm_lv))
+        # A single tmp file holds all classic snapshots of the set
+        tmp_file_args = argparse.Namespace(**vars(args))
+        tmp_file_args.source_lvm_lv = classic_members[0].source_lvm_lv
+        tmp_file_args.lvm_volume_size_mb = args.lvm_volume_size_mb * len(classic_members)
+        allocate_tmp_file(tmp_file_args)
+        create_pv_based_on_tmp_file(args)
+
+    source_devs = [lvm_mapper_dev_name(member.source_lvm_vg, member.source_lvm_lv) for member in members]
+    # A filesystem may be mounted several times (e.g. bind mounts), but can be frozen only once
+    frozen_mountpoints = {}
+    for mountpoint, device in sorted(mounts.items()):
+        if device in source_devs and device not in frozen_mountpoints:
+            frozen_mountpoints[device] = mountpoint
+    frozen_mountpoints = list(frozen_mountpoints.values())
+    if frozen_mountpoints and kernel_version() < NESTED_FREEZE_MIN_KERNEL:
+        print("Kernel {0} can not create snapshots of frozen filesystems, at least {1}.{2} is required. Snapshots "
+              "are created one right after another without freezing filesystems, so each snapshot is consistent "
+              "only on its own".format(os.uname().release, *NESTED_FREEZE_MIN_KERNEL))
+        frozen_mountpoints = []
+    for mountpoint in frozen_mountpoints:
+        print("Filesystem mounted at %s will be frozen while snapshots are created" % mountpoint)
+    print("Creating snapshots %s" % ", ".join("%s/%s" % (member.source_lvm_vg, member.source_lvm_lv)
+                                              for member in members))
+    # Nothing is printed while filesystems are frozen, since output may go to one of them
+    freeze_seconds = run_lvm_commands_frozen(frozen_mountpoints, creation_cmds)
+    if freeze_seconds is not None:
+        print("Filesystems were frozen for {0:.0f} ms".format(freeze_seconds * 1000))
+
+    # Metadata backup of LVM is written to /etc, that could be frozen during creation
+    run_lvm_command(['vgcfgbackup', args.source_lvm_vg])
+
+
+def run_lvm_commands_frozen(mountpoints, cmds):
+    """
+    Freezes filesystems, runs LVM commands one by one and thaws filesystems
+    :param mountpoints: mountpoints of filesystems to freeze
+    :param cmds: LVM commands that should not write LVM metadata backups
+    :return: duration of the freeze in seconds, or None if filesystems were not frozen
+    """
+    cmds = [cmd[:1] + ['--autobackup', 'n', '--config', 'backup/archive=0'] + cmd[1:] for cmd in cmds]
+    fds = [os.open(mountpoint, os.O_RDONLY | os.O_DIRECTORY) for mountpoint in mountpoints]
+    frozen_fds = []
+    completed_cmds = 0
+    try:
+        started_at = time.monotonic()
+        for fd in fds:
+            fcntl.ioctl(fd, FIFREEZE, 0)
+            frozen_fds.append(fd)
+        try:
+            for cmd in cmds:
+                run_lvm_command(cmd)
+                completed_cmds += 1
+        finally:
+            for fd in frozen_fds:
+                fcntl.ioctl(fd, FITHAW, 0)
+            freeze_seconds = time.monotonic() - started_at
+    except subprocess.CalledProcessError as e:
+        # Device mapper suspends the origin of a snapshot with lockfs, that fails with EBUSY on a frozen filesystem
+        # if the kernel does not support nested freezes
+        if not frozen_fds or completed_cmds or "suspend" not in str(e.output):
+            raise
+        print("Could not create a snapshot of a frozen filesystem ({0}). Looks like the kernel does not support "
+              "nested freezes. Creating snapshots one right after another without freezing filesystems, so each "
+              "snapshot is consistent only on its own".format(str(e.output).strip()))
+        for cmd in cmds:
+            run_lvm_command(cmd)
+        return None
+    finally:
+        for fd in fds:
+            os.close(fd)
+    return freeze_seconds if frozen_fds else None
+
+
+def write_image(device, image_file, read_size, skip_free_blocks, block_index_file=None, tracked_block_size=None,
+                hash_workers=None):
+    """
+    Copies a block device into a sparse image file. The device is read with large aligned O_DIRECT reads, bypassing
+    the page cache, and all-zero blocks are left as holes of the image.
+    If a block index is given, blocks are hashed, and if the index already exists, only blocks that changed since
+    it was written are stored into a delta file instead of an image. The index is updated in both cases
+    :param device: path to the block device
+    :param image_file: path to the image or delta file, that should not exist
+    :param read_size: size of a single read in bytes
+    :param skip_free_blocks: do not read blocks that are free according to the filesystem on the device
+    :param block_index_file: path to the block index, or None
+    :param tracked_block_size: size of blocks hashed at the block index
+    :param hash_workers: number of processes that hash blocks
+    """
+    alignment = tracked_block_size if block_index_file else IMAGE_ALIGNMENT
+    read_size = round_up(read_size, alignment)
+    started_at = time.monotonic()
+    try:
+        device_fd = os.open(device, os.O_RDONLY | os.O_DIRECT)
+    except OSError:
+        # Some filesystems do not support direct I/O
+        print("Direct I/O is not supported for %s, reading through the page cache" % device)
+        device_fd = os.open(device, os.O_RDONLY)
+    try:
+        device_size = os.lseek(device_fd, 0, os.SEEK_END)
+        ranges = None
+        if skip_free_blocks:
+            ranges = list_used_ext_ranges(device_fd, device_size, alignment)
+        if ranges is None:
+            ranges = [(0, device_size)]
+        chunks = read_ranges(device_fd, device, ranges, read_size)
+        previous_index = None
+        if block_index_file:
+            previous_index = read_block_index(block_index_file, device_size, tracked_block_size)
+        if previous_index is None:
+            print("Copying device {0} of size {1:.0f} mb into image {2}"
+                  .format(device, device_size / 1024 / 1024, image_file))
+        else:
+            print("Copying blocks of device {0} changed since the last run into delta {1}".format(device, image_file))
+        image_fd = os.open(image_file, os.O_WRONLY | os.O_CREAT | os.O_EXCL, 0o600)
+        try:
+            if block_index_file:
+                index, bytes_written = write_tracked_image(image_fd, chunks, device_size, ranges, previous_index,
+                                                           tracked_block_size, hash_workers)
+            else:
+                index = None
+                bytes_written = sum(write_non_zero_blocks(image_fd, chunk, len(chunk), offset)
+                                    for offset, chunk in chunks)
+            if previous_index is None:
+                os.ftruncate(image_fd, device_size)
+            os.fsync(image_fd)
+        finally:
+            os.close(image_fd)
+        if index is not None:
+            # Written only when the image is safely stored, otherwise the next delta would miss changes
+            write_block_index(block_index_file, device_size, tracked_block_size, index)
+    finally:
+        os.close(device_fd)
+    elapsed = time.monotonic() - started_at
+    bytes_read = sum(end - start for start, end in ranges)
+    print("Copied device {0} into {1} in {2:.1f} seconds: read {3:.0f} mb ({4:.0f} mb/s), wrote {5:.0f} mb, "
+          "skipped {6:.0f} mb of free blocks"
+          .format(device, image_file, elapsed, bytes_read / 1024 / 1024,
+                  bytes_read / 1024 / 1024 / max(elapsed, 0.001), bytes_written / 1024 / 1024,
+                  (device_size - bytes_read) / 1024 / 1024))
+
+
+def read_ranges(device_fd, device, ranges, read_size):
+    """
+    Reads ranges of a device sequentially with aligned reads into a single page aligned buffer
+    :param device_fd: descriptor of the device, that may be opened for direct I/O
+    :param device: path to the device, for messages
+    :param ranges: sorted list of (start, end) tuples with aligned starts
+    :param read_size: size of a single read, aligned
+    :return: generator of (offset, memoryview) tuples. A view is valid only until the next one is requested
+    """
+    buffer = mmap.mmap(-1, read_size)  # Anonymous maps are page aligned, as direct I/O requires
+    try:
+        for start, end in ranges:
+            for offset in range(start, end, read_size):
+                # The size of a direct read should stay aligned even at the end of a range
+                with memoryview(buffer) as view, \
+                        view[:min(read_size, round_up(end - offset, IMAGE_ALIGNMENT))] as chunk:
+                    length = os.preadv(device_fd, [chunk], offset)
+                if length < min(read_size, end - offset):
+                    raise EnvironmentError("Short read of {0} bytes at offset {1} of device {2}"
+                                           .format(length, offset, device))
+                with memoryview(buffer) as view, view[:min(length, end - offset)] as chunk:
+                    yield offset, chunk
+    finally:
+        buffer.close()
+
+
+def write_non_zero_blocks(image_fd, buffer, length, offset):
+    """
+    Writes the beginning of a buffer into the image, leaving holes in place of all-zero blocks
+    :param image_fd: descriptor of the image file
+    :param buffer: buffer or memory view with data read from the device
+    :param length: number of bytes at the beginning of the buffer to write
+    :param offset: offset of the data in the image
+    :return: number of bytes written
+    """
+    written = 0
+    run_start = None
+    for block_start in range(0, length + IMAGE_ZERO_BLOCK_SIZE, IMAGE_ZERO_BLOCK_SIZE):
+        block_end = min(block_start + IMAGE_ZERO_BLOCK_SIZE, length)
+        # Comparing bytes is much faster than comparing memory views
+        if block_start < length and bytes(buffer[block_start:block_end]) != IMAGE_ZERO_BLOCK[:block_end - block_start]:
+            if run_start is None:
+                run_start = block_start
+        elif run_start is not None:
+            run_end = min(block_start, length)
+            with memoryview(buffer) as view:
+                position = run_start
+                while position < run_end:
+                    with view[position:run_end] as data:
+                        position += os.pwrite(image_fd, data, offset + position)
+            written += run_end - run_start
+            run_start = None
+    return written
+
+
+def write_tracked_image(image_fd, chunks, device_size, ranges, previous_index, block_size, workers):
+    """
+    Hashes blocks of the device in a pool of processes while it is read, and writes either a full image or, if
+    a previous index is given, a delta with blocks whose hashes changed
+    :param image_fd: descriptor of the image or delta file
+    :param chunks: generator of (offset, memoryview) tuples with data of the device, aligned to blocks
+    :param device_size: size of the device in bytes
+    :param ranges: list of (start, end) tuples of the device that are read, other blocks are considered zero
+    :param previous_index: hashes of blocks from the previous run, or None
+    :param block_size: size of a block in bytes
+    :param workers: number of hashing processes
+    :return: tuple of the new index, and the number of bytes written
+    """
+    blocks_count = math.ceil(device_size / block_size)
+    # Blocks that are not read are holes of the image, so their hashes are the ones of zero blocks
+    index = bytearray(hashlib.sha256(bytes(block_size)).digest() * blocks_count)
+    if device_size % block_size:
+        index[-BLOCK_HASH_SIZE:] = hashlib.sha256(bytes(device_size % block_size)).digest()
+    written = 0
+    delta = None
+    if previous_index is not None:
+        delta = open(image_fd, "wb", closefd=False)
+        header = {"version": DELTA_VERSION, "device_size": device_size, "block_size": block_size}
+        delta.write(json.dumps(header).encode() + b"\n")
+
+    def store(offset, data, digests):
+        nonlocal written
+        first_block = offset // block_size
+        index[first_block * BLOCK_HASH_SIZE:first_block * BLOCK_HASH_SIZE + len(digests)] = digests
+        if delta is None:
+            written += write_non_zero_blocks(image_fd, data, len(data), offset)
+            return
+        for block in range(first_block, first_block + len(digests) // BLOCK_HASH_SIZE):
+            if index[block * BLOCK_HASH_SIZE:(block + 1) * BLOCK_HASH_SIZE] != \
+                    previous_index[block * BLOCK_HASH_SIZE:(block + 1) * BLOCK_HASH_SIZE]:
+                start = (block - first_block) * block_size
+                written += write_delta_record(delta, block, data[start:start + block_size])
+
+    with concurrent.futures.ProcessPoolExecutor(max_workers=workers) as executor:
+        # Reading goes on while previous chunks are hashed, but only a few chunks are kept in memory
+        pending = collections.deque()
+        for offset, chunk in chunks:
+            data = bytes(chunk)
+            pending.append((offset, data, executor.submit(hash_blocks, data, block_size)))
+            if len(pending) > workers * 2:
+                offset, data, future = pending.popleft()
+                store(offset, data, future.result())
+        while pending:
+            offset, data, future = pending.popleft()
+            store(offset, data, future.result())
+
+    if delta is not None:
+        # Blocks that became free since the previous run
+        position = 0
+        for start, end in ranges + [(device_size, device_size)]:
+            for block in range(position // block_size, start // block_size):
+                if index[block * BLOCK_HASH_SIZE:(block + 1) * BLOCK_HASH_SIZE] != \
+                        previous_index[block * BLOCK_HASH_SIZE:(block + 1) * BLOCK_HASH_SIZE]:
+                    written += write_delta_record(delta, block, b"")
+            position = end
+        delta.close()
+    return index, written
+
+
+def hash_blocks(data, block_size):
+    """
+    Runs at worker processes
+    :return: concatenated hashes of blocks of data
+    """
+    with memoryview(data) as view:
+        return b"".join(hashlib.sha256(view[offset:offset + block_size]).digest()
+                        for offset in range(0, len(data), block_size))
+
+
+def write_delta_record(delta, block, data):
+    """
+    Writes a changed block into a delta, all-zero blocks are written without data
+    :return: number of bytes written
+    """
+    if data.count(0) == len(data):
+        data = b""
+    delta.write(DELTA_RECORD.pack(block, len(data)))
+    delta.write(data)
+    return DELTA_RECORD.size + len(data)
+
+
+def read_block_index(block_index_file, device_size, block_size):
+    """
+    Reads hashes of blocks written by the previous run
+    :return: bytes with hashes, or None if there is no index or it was written for another device or block size
+    """
+    if not os.path.exists(block_index_file):
+        print("Block index %s does not exist, it will be created" % block_index_file)
+        return None
+    with open(block_index_file, "rb") as index_file:
+        header = json.loads(index_file.readline().decode())
+        if header["version"] != BLOCK_INDEX_VERSION:
+            raise EnvironmentError("Unsupported version {0} of block index {1}".format(header["version"],
+                                                                                       block_index_file))
+        if (header["device_size"], header["block_size"]) != (device_size, block_size):
+            print("Block index {0} was written for device size {1} and block size {2}, it will be recreated"
+                  .format(block_index_file, header["device_size"], header["block_size"]))
+            return None
+        index = index_file.read()
+    if len(index) != math.ceil(device_size / block_size) * BLOCK_HASH_SIZE:
+        raise EnvironmentError("Block index %s is truncated" % block_index_file)
+    return index
+
+
+def write_block_index(block_index_file, device_size, block_size, index):
+    tmp_file = block_index_file + ".tmp"
+    with open(tmp_file, "wb") as index_file:
+        header = {"version": BLOCK_INDEX_VERSION, "device_size": device_size, "block_size": block_size}
+        index_file.write(json.dumps(header).encode() + b"\n")
+        index_file.write(index)
+        index_file.flush()
+        os.fsync(index_file.fileno())
+    os.replace(tmp_file, block_index_file)
+
+
+def apply_deltas(image_file, delta_files):
+    """
+    Restores an image of a later run by writing changed blocks of deltas over the image
+    :param image_file: path to the image, that is modified in place
+    :param delta_files: paths to deltas in the order they were created
+    """
+    image_fd = os.open(image_file, os.O_WRONLY)
+    try:
+        image_size = os.fstat(image_fd).st_size
+        for delta_file in delta_files:
+            blocks_count = 0
+            with open(delta_file, "rb") as delta:
+                header = json.loads(delta.readline().decode())
+                if header["version"] != DELTA_VERSION:
+                    raise EnvironmentError("Unsupported version {0} of delta {1}".format(header["version"],
+                                                                                         delta_file))
+                if header["device_size"] != image_size:
+                    raise EnvironmentError("Delta {0} was created for a device of size {1}, but image {2} has size "
+                                           "{3}".format(delta_file, header["device_size"], image_file, image_size))
+                block_size = header["block_size"]
+                while True:
+                    record = delta.read(DELTA_RECORD.size)
+                    if not record:
+                        break
+                    if len(record) < DELTA_RECORD.size:
+                        raise EnvironmentError("Delta %s is truncated" % delta_file)
+                    block, length = DELTA_RECORD.unpack(record)
+                    data = delta.read(length)
+                    if len(data) < length:
+                        raise EnvironmentError("Delta %s is truncated" % delta_file)
+                    if not data:
+                        data = bytes(min(block_size, image_size - block * block_size))
+                    with memoryview(data) as view:
+                        position = 0
+                        while position < len(data):
+                            position += os.pwrite(image_fd, view[position:], block * block_size + position)
+                    blocks_count += 1
+            print("Applied delta {0} with {1} changed blocks to image {2}".format(delta_file, blocks_count,
+                                                                                 image_file))
+        os.fsync(image_fd)
+    finally:
+        os.close(image_fd)
+
+
+def watch_snapshot(args):
+    """
+    Polls usage of a snapshot until it is removed, and extends it before it fills up and gets invalidated
+    """
+    print("Performing %s action" % SNAPSHOT_WATCH_ACTION)
+    snapshot_dev = lvm_mapper_dev_name(args.source_lvm_vg, args.lvm_snapshot_name)
+    snapshot_volume_id = "%s/%s" % (args.source_lvm_vg, args.lvm_snapshot_name)
+    if not os.path.exists(snapshot_dev):
+        raise EnvironmentError("Snapshot device %s does not exist" % snapshot_dev)
+    if find_thin_pool(args.source_lvm_vg, args.lvm_snapshot_name):
+        print("Thin snapshot %s is not invalidated when data changes, nothing to watch" % snapshot_volume_id)
+        return
+
+    started_at = time.monotonic()
+    previous_check = None
+    first_used_mb = None
+    peak_used_mb = 0
+    peak_rate = 0
+    extended_mb = 0
+    while True:
+        invalidate_lvm_reports()  # Usage changes without LVM commands
+        try:
+            report = lv_report(args.source_lvm_vg, args.lvm_snapshot_name, ["lv_size", "data_percent"])
+        except subprocess.CalledProcessError:
+            report = None
+        if report is None or not os.path.exists(snapshot_dev):
+            print("Snapshot %s is removed, stopping" % snapshot_volume_id)
+            break
+        now = time.monotonic()
+        size_mb = float(report["lv_size"])
+        used_percent = float(report["data_percent"])
+        used_mb = size_mb * used_percent / 100
+        rate = 0
+        if previous_check:
+            rate = max(used_mb - previous_check[1], 0) / (now - previous_check[0])
+        if first_used_mb is None:
+            first_used_mb = used_mb
+        peak_used_mb = max(peak_used_mb, used_mb)
+        peak_rate = max(peak_rate, rate)
+        previous_check = (now, used_mb)
+        print("Snapshot {0} uses {1:.0f} of {2:.0f} mb ({3:.1f}%), filling at {4:.2f} mb/s"
+              .format(snapshot_volume_id, used_mb, size_mb, used_percent, rate))
+        if args.watch_metrics_file:
+            with open(args.watch_metrics_file, "a") as metrics_file:
+                metrics_file.write(json.dumps({"time": time.time(), "snapshot": snapshot_volume_id,
+                                               "size_mb": size_mb, "used_mb": round(used_mb, 1),
+                                               "fill_rate_mb_per_second": round(rate, 3)}) + "\n")
+        if used_percent >= 100:
+            raise EnvironmentError("Snapshot %s is full and got invalidated" % snapshot_volume_id)
+        if used_percent >= args.extend_threshold_percent:
+            # Twice the amount it fills during an interval, so that the next check happens before it is full
+            step_mb = max(args.extend_step_mb, math.ceil(rate * args.watch_interval_seconds * 2))
+            extended_mb += extend_snapshot(args, step_mb)
+        time.sleep(args.watch_interval_seconds)
+
+    elapsed = time.monotonic() - started_at
+    if first_used_mb is not None:
+        print("Snapshot {0} was watched for {1:.0f} seconds: peak usage {2:.0f} mb, average fill rate {3:.2f} mb/s, "
+              "peak fill rate {4:.2f} mb/s, extended by {5} mb"
+              .format(snapshot_volume_id, elapsed, peak_used_mb, (peak_used_mb - first_used_mb) / max(elapsed, 1),
+                      peak_rate, extended_mb))
+
+
+def extend_snapshot(args, step_mb):
+    """
+    Extends a snapshot, growing the tmp file that backs a physical volume of the group if there is no free space
+    :return: number of megabytes the snapshot is extended by
+    """
+    snapshot_volume_id = "%s/%s" % (args.source_lvm_vg, args.lvm_snapshot_name)
+    vg_free_mb = float(vg_report(args.source_lvm_vg, ["vg_free"])["vg_free"])
+    if vg_free_mb < step_mb and args.lvm_snapshot_tmp_file:
+        grow_pv_based_on_tmp_file(args, step_mb - math.floor(vg_free_mb))
+        vg_free_mb = float(vg_report(args.source_lvm_vg, ["vg_free"])["vg_free"])
+    step_mb = min(step_mb, math.floor(vg_free_mb))
+    if step_mb < 1:
+        print("Volume group %s has no free space, can not extend snapshot" % args.source_lvm_vg)
+        return 0
+    print("Extending snapshot {0} by {1} mb".format(snapshot_volume_id, step_mb))
+    lvextend_cmd = ['lvextend', '-L', "+%sm" % step_mb, snapshot_volume_id]
+    run_lvm_command(lvextend_cmd)
+    return step_mb
+
+
+def grow_pv_based_on_tmp_file(args, size_mb):
+    tmp_file = args.lvm_snapshot_tmp_file
+    loop_device = find_loop_device(args)
+    dir_containing_tmp_file = os.path.dirname(tmp_file)
+    # The physical volume takes whole extents, so one more extent may be required
+    size_mb = round_up(size_mb + 4, ALLOCATION_BLOCK_MB)
+
+    statvfs_for_dir = os.statvfs(dir_containing_tmp_file)
+    free_space = statvfs_for_dir.f_bavail * statvfs_for_dir.f_bsize / 1024 / 1024
+    if size_mb / free_space > 0.9:
+        raise EnvironmentError(
+            "Growing tmp file {0} by {1:.0f} mb will take more then 90% of available space ({2:.0f} mb) "
+            "at directory {3}. Refusing to grow tmp file".format(tmp_file, size_mb, free_space,
+                                                                  dir_containing_tmp_file))
+
+    print("Growing tmp file {0} by {1} mb".format(tmp_file, size_mb))
+    allocate_file_space(tmp_file, os.path.getsize(tmp_file), size_mb,
+                        choose_allocation_strategy(args, dir_containing_tmp_file))
+
+    print("Updating size of loop device %s and its physical volume" % loop_device)
+    losetup_cmd = ['/sbin/losetup', '--set-capacity', loop_device]
+    subprocess.run(losetup_cmd, timeout=TIMEOUT, check=True)
+    pvresize_cmd = ['pvresize', loop_device]
+    run_lvm_command(pvresize_cmd)
+
+
 def unmount_snapshot(args):
     print("Performing %s action" % SNAPSHOT_UNMOUNT_ACTION)
     snapshot_dev = lvm_mapper_dev_name(args.source_lvm_vg, args.lvm_snapshot_name)
     mountpoint = os.path.abspath(args.mountpoint)
     unmount(args.source_lvm_vg, args.lvm_snapshot_name, mountpoint, args)
+    remove_snapshot(args, snapshot_dev)
+
+
+def unmount_snapshot_set(args):
+    print("Performing %s action" % SNAPSHOT_SET_UNMOUNT_ACTION)
+    members = snapshot_set_members(args)
+    with concurrent.futures.ThreadPoolExecutor(max_workers=len(members)) as executor:
+        unmounts = [executor.submit(unmount, member.source_lvm_vg, member.lvm_snapshot_name, member.mountpoint,
+                                    member) for member in members]
+        for future in unmounts:
+            future.result()
+
+    for member in members:
+        remove_snapshot_lv(member, lvm_mapper_dev_name(member.source_lvm_vg, member.lvm_snapshot_name))
+
+    if args.lvm_snapshot_tmp_file:
+        remove_pv_based_on_tmp_file(args)
+        remove_tmp_file(args)
 
+
+def remove_snapshot(args, snapshot_dev):
+    if args.snapshot_history_file and os.path.exists(snapshot_dev) \
+            and not find_thin_pool(args.source_lvm_vg, args.lvm_snapshot_name):
+        record_snapshot_usage(args)
     remove_snapshot_lv(args, snapshot_dev)
 
     if args.lvm_snapshot_tmp_file:
@@ -226,8 +1253,8 @@ def remove_snapshot_lv(args, snapshot_dev):
     snapshot_volume_id = "%s/%s" % (args.source_lvm_vg, args.lvm_snapshot_name)
     if os.path.exists(snapshot_dev):
         print("Removing snapshot volume %s" % snapshot_volume_id)
-        snapshot_removal_cmd = ['/sbin/lvremove', '--force', snapshot_volume_id]
-        subprocess.run(snapshot_removal_cmd, timeout=TIMEOUT, check=True)
+        snapshot_removal_cmd = ['lvremove', '--force', snapshot_volume_id]
+        run_lvm_command(snapshot_removal_cmd)
     else:
         print("Looks like snapshot volume %s does not exist" % snapshot_volume_id)
 
@@ -260,20 +1287,24 @@ def unmount(vg_name, snapshot_name, mountpoint, args):
 
 
 def remove_pv_based_on_tmp_file(args):
-    pvs = list_pvs()
-    loop_device = args.loop_device
+    loop_device = find_loop_device(args)
     vg_name = args.source_lvm_vg
     tmp_file = args.lvm_snapshot_tmp_file
+    if loop_device is None:
+        print("No loop device is recorded for tmp file %s, looks like it was not attached" % tmp_file)
+        return
+    pvs = list_pvs()
 
     if loop_device in pvs and pvs[loop_device] == vg_name:
         print("Removing physical volume {0} from volume group {1}".format(loop_device, vg_name))
-        vgreduce_cmd = ['/sbin/vgreduce', vg_name, loop_device]
-        subprocess.run(vgreduce_cmd, timeout=TIMEOUT, check=True)
+        vgreduce_cmd = ['vgreduce', vg_name, loop_device]
+        run_lvm_command(vgreduce_cmd)
+        pvs = list_pvs()
 
-    if loop_device in pvs and pvs[loop_device] == loop_device:  # when pv is not in vg, it displays as its path
+    if loop_device in pvs and not pvs[loop_device]:  # when pv is not in vg, its vg name is empty
         print("Destroying physical volume {0}".format(loop_device))
-        pvremove_cmd = ['/sbin/pvremove', loop_device]
-        subprocess.run(pvremove_cmd, timeout=TIMEOUT, check=True)
+        pvremove_cmd = ['pvremove', loop_device]
+        run_lvm_command(pvremove_cmd)
 
     loop_devices = list_loop_devices()
     if loop_device in loop_devices:
@@ -285,6 +1316,10 @@ def remove_pv_based_on_tmp_file(args):
             print("Looks like something other then tmp file {0} is attached to loop device {1}. Not detaching "
                   "file {2} from loop device {1}.".format(tmp_file, loop_device, loop_devices[loop_device]))
 
+    record_path = tmp_file + LOOP_DEVICE_RECORD_SUFFIX
+    if os.path.exists(record_path):
+        os.remove(record_path)
+
 
 def remove_tmp_file(args):
     tmp_file = args.lvm_snapshot_tmp_file
@@ -303,46 +1338,96 @@ def list_mounts():
     Lists system mounts
     :return: dictionary {mountpoint -> device}
     """
-    cmd_result = subprocess.run(['/bin/findmnt', '-P'], stdout=subprocess.PIPE, timeout=TIMEOUT,
-                                universal_newlines=True)
-    # Example of mount output:
-    # TARGET="/" SOURCE="/dev/sda1" FSTYPE="ext4" OPTIONS="rw,noatime,errors=remount-ro,data=ordered"
-    result = {}
-    for line in cmd_result.stdout.splitlines():
-        if not line:
-            continue
-        target = None
-        source = None
-        for kv in line.split():
-            if kv.startswith("TARGET="):
-                target = kv.split('"')[1]
-            elif kv.startswith("SOURCE="):
-                source = kv.split('"')[1]
-        if target and source:
-            result[target] = source
-        else:
-            raise EnvironmentError("Could not parse findmnt output %s " % line)
+    return {mountpoint: source for mountpoint, source, _ in read_mountinfo()}
+
+
+def read_mountinfo():
+    """
+    Reads mounts of the current process from /proc, that is much faster than running findmnt
+    :return: list of (mountpoint, source, filesystem type) tuples in the order of mounting
+    """
+    # Example of a line, see proc(5):
+    # 36 35 98:0 / /mnt/data rw,noatime master:1 - ext4 /dev/mapper/vg-data rw,errors=continue
+    result = []
+    with open("/proc/self/mountinfo") as mountinfo:
+        for line in mountinfo:
+            fields = line.split()
+            separator = fields.index("-", 6)
+            mountpoint = unescape_mountinfo(fields[4])
+            fs_type = fields[separator + 1]
+            source = unescape_mountinfo(fields[separator + 2])
+            result.append((mountpoint, source, fs_type))
     return result
 
 
+def unescape_mountinfo(field):
+    # Spaces, tabs, newlines and backslashes are escaped as octal numbers, e.g. \040
+    return re.sub(r"\\([0-7]{3})", lambda match: chr(int(match.group(1), 8)), field)
+
+
+def filesystem_type(path):
+    """
+    :param path: path to some file/directory
+    :return: type of the filesystem containing the path, e.g. ext4, or None if it is not known
+    """
+    mountpoint = find_mount_point(path)
+    # Later mounts hide earlier ones at the same mountpoint
+    return next((fs_type for mount, _, fs_type in reversed(read_mountinfo()) if mount == mountpoint), None)
+
+
+def logical_block_size(path):
+    """
+    :param path: path to some file/directory
+    :return: logical block size of the block device containing the path, or None if it is not on a block device
+    """
+    st_dev = os.stat(path).st_dev
+    device_dir = "/sys/dev/block/{0}:{1}".format(os.major(st_dev), os.minor(st_dev))
+    # Partitions do not have queue parameters, their disks do
+    for queue_dir in [os.path.join(device_dir, "queue"), os.path.join(device_dir, os.pardir, "queue")]:
+        block_size_path = os.path.join(queue_dir, "logical_block_size")
+        if os.path.exists(block_size_path):
+            with open(block_size_path) as block_size_file:
+                return int(block_size_file.read())
+    return None
+
+
 def find_mount_point(path):
     """
-    Finds the nearest directory in path that is a mountpoint
-    Source: https://stackoverflow.com/a/38326779
+    Finds the nearest directory in path that is a mountpoint. Mountpoints are looked up at /proc/self/mountinfo
+    instead of checking every directory of the path
     :param path: path to some file/directory
     :return: path to mountpoint
     """
-    if not os.path.islink(path):
-        path = os.path.abspath(path)
-    elif os.path.islink(path) and os.path.lexists(os.readlink(path)):
-        path = os.path.realpath(path)
-    while not os.path.ismount(path):
+    mountpoints = set(list_mounts())
+    path = os.path.realpath(path)
+    # In a chroot, "/" may be missing from mountinfo
+    while path not in mountpoints and path != "/":
         path = os.path.dirname(path)
-        if os.path.islink(path) and os.path.lexists(os.readlink(path)):
-            path = os.path.realpath(path)
     return path
 
 
+def snapshot_set_members(args):
+    """
+    :return: copies of args for every volume of --snapshot-set-lv option, with --source-lvm-lv,
+    --lvm-snapshot-name and --mountpoint options of the volume
+    """
+    members = []
+    for spec in args.snapshot_set_lv:
+        member = argparse.Namespace(**vars(args))
+        member.source_lvm_lv, _, rest = spec.partition(":")
+        member.lvm_snapshot_name, _, member.mountpoint = rest.partition(":")
+        members.append(member)
+    return members
+
+
+def kernel_version():
+    """
+    :return: tuple of major and minor versions of the running kernel, e.g. (6, 6)
+    """
+    match = re.match(r"(\d+)\.(\d+)", os.uname().release)
+    return int(match.group(1)), int(match.group(2))
+
+
 def lvm_mapper_dev_name(vg_name, lv_name):
     """
     Returns path to lvm lv device as /dev/mapper/my--vg-my--lv.
@@ -368,39 +1453,333 @@ def list_pvs():
     Lists LVM physical volumes
     :return: dictionary {physical volume -> volume group}
     """
-    cmd_result = subprocess.run(['/sbin/pvs', '-o', 'pv_name,vg_name', '--noheadings',
-                                 '--separator', ';'], stdout=subprocess.PIPE, timeout=TIMEOUT,
-                                universal_newlines=True)
+    report = lvm_report(['pvs', '-o', 'pv_name,vg_name'])
     # Example of output:
-    #     /dev/loop5;main-vg
-    result = {}
-    for line in cmd_result.stdout.splitlines():
-        if line.strip():
-            parts = line.split(";")
-            pv_name = parts[0].strip()
-            vg_name = parts[1].strip()
-            result[pv_name] = vg_name
-    return result
+    # {"report": [{"pv": [{"pv_name": "/dev/loop5", "vg_name": "main-vg"}]}]}
+    return {pv["pv_name"]: pv["vg_name"] for pv in report["report"][0]["pv"]}
+
+
+def lv_report(vg_name, lv_name, fields):
+    """
+    Reports attributes of an LVM logical volume
+    :param vg_name: name of the volume group
+    :param lv_name: name of the logical volume
+    :param fields: list of lvs field names, e.g. ["segtype", "pool_lv"]. Sizes are in megabytes
+    :return: dictionary {field -> value}
+    """
+    report = lvm_report(['lvs', '-o', ",".join(fields), '--units', 'm', '--nosuffix', "%s/%s" % (vg_name, lv_name)])
+    # Example of output:
+    # {"report": [{"lv": [{"segtype": "thin", "pool_lv": "pool0"}]}]}
+    return report["report"][0]["lv"][0]
+
+
+def vg_report(vg_name, fields):
+    """
+    Reports attributes of an LVM volume group. Sizes are in megabytes
+    :param vg_name: name of the volume group
+    :param fields: list of vgs field names, e.g. ["vg_free"]
+    :return: dictionary {field -> value}
+    """
+    report = lvm_report(['vgs', '-o', ",".join(fields), '--units', 'm', '--nosuffix', vg_name])
+    # Example of output:
+    # {"report": [{"vg": [{"vg_free": "1024.00"}]}]}
+    return report["report"][0]["vg"][0]
+
+
+def find_thin_pool(vg_name, lv_name):
+    """
+    :param vg_name: name of the volume group
+    :param lv_name: name of the logical volume
+    :return: name of the thin pool of a thin provisioned volume, or None for other volumes
+    """
+    report = lv_report(vg_name, lv_name, ["segtype", "pool_lv"])
+    if report["segtype"] == "thin" and report["pool_lv"]:
+        return report["pool_lv"]
+    return None
 
 
 def list_loop_devices():
     """
-    Lists active loop devices
+    Lists active loop devices from /sys, that is much faster than running losetup
     :return: dictionary {loop device -> file}
     """
-    cmd_result = subprocess.run(['/sbin/losetup', '-a'], stdout=subprocess.PIPE, timeout=TIMEOUT,
-                                universal_newlines=True)
-    # Example of output:
-    # /dev/loop5: [0052]:8651046 (/media/raw/1.tmp)
     result = {}
-    for line in cmd_result.stdout.splitlines():
-        if line.strip():
-            parts = line.split()
-            loop_device_name = parts[0].strip()[0:-1]
-            attached_file = parts[2].strip()[1:-1]
-            result[loop_device_name] = attached_file
+    for backing_file_path in glob.glob("/sys/block/loop*/loop/backing_file"):
+        loop_device_name = "/dev/" + backing_file_path.split("/")[3]
+        with open(backing_file_path) as backing_file:
+            result[loop_device_name] = backing_file.read().rstrip("\n")
+    return result
+
+
+def list_used_ext_ranges(device_fd, device_size, alignment=IMAGE_ALIGNMENT):
+    """
+    Lists byte ranges of a device that may be used by an ext2/ext3/ext4 filesystem, according to its block bitmaps.
+    Ranges are aligned to the given alignment. For groups with uninitialized bitmaps, the place of a superblock backup
+    and the metadata of the group are considered used
+    :param device_fd: descriptor of the device opened for reading
+    :param device_size: size of the device in bytes
+    :param alignment: alignment of range starts and ends, except for the end of the device
+    :return: sorted list of (start, end) tuples, or None if the filesystem is not supported
+    """
+    superblock = read_aligned(device_fd, EXT_SUPERBLOCK_OFFSET, 1024)
+    if len(superblock) < 1024 or struct.unpack_from("<H", superblock, 0x38)[0] != EXT_MAGIC:
+        print("No ext2/ext3/ext4 filesystem found on the device, reading the whole device")
+        return None
+    blocks_count_lo, _, _, _, first_data_block, log_block_size, _, blocks_per_group = \
+        struct.unpack_from("<8I", superblock, 0x4)
+    feature_incompat, feature_ro_compat = struct.unpack_from("<2I", superblock, 0x60)
+    if feature_ro_compat & EXT_FEATURE_RO_COMPAT_BIGALLOC:
+        # Bits of block bitmaps stand for clusters of blocks
+        print("Filesystems with bigalloc feature are not supported, reading the whole device")
+        return None
+    if feature_incompat & ~EXT_KNOWN_FEATURES_INCOMPAT or feature_ro_compat & ~EXT_KNOWN_FEATURES_RO_COMPAT:
+        print("Filesystem has unknown features (incompat {0:#x}, ro_compat {1:#x}), reading the whole device"
+              .format(feature_incompat & ~EXT_KNOWN_FEATURES_INCOMPAT,
+                      feature_ro_compat & ~EXT_KNOWN_FEATURES_RO_COMPAT))
+        return None
+    if feature_incompat & EXT_FEATURE_INCOMPAT_RECOVER:
+        # Blocks allocated by journal transactions that are not replayed yet are free at on-disk bitmaps
+        print("Filesystem journal needs recovery, so block bitmaps are not reliable. Reading the whole device")
+        return None
+    if feature_incompat & EXT_FEATURE_INCOMPAT_META_BG:
+        print("Filesystems with meta_bg feature are not supported, reading the whole device")
+        return None
+    block_size = 1024 << log_block_size
+    blocks_count = blocks_count_lo
+    descriptor_size = 32
+    if feature_incompat & EXT_FEATURE_INCOMPAT_64BIT:
+        blocks_count |= struct.unpack_from("<I", superblock, 0x150)[0] << 32
+        descriptor_size = struct.unpack_from("<H", superblock, 0xFE)[0]
+    groups_count = math.ceil((blocks_count - first_data_block) / blocks_per_group)
+    descriptors = read_aligned(device_fd, (first_data_block + 1) * block_size, groups_count * descriptor_size)
+    inodes_per_group = struct.unpack_from("<I", superblock, 0x28)[0]
+    inode_size = 128
+    if struct.unpack_from("<I", superblock, 0x4C)[0] > 0:
+        inode_size = struct.unpack_from("<H", superblock, 0x58)[0]
+    inode_table_blocks = math.ceil(inodes_per_group * inode_size / block_size)
+    # Superblock, group descriptors and blocks reserved for their growth
+    superblock_area_blocks = 1 + math.ceil(groups_count * descriptor_size / block_size) + \
+        struct.unpack_from("<H", superblock, 0xCE)[0]
+
+    used_ranges = [(0, first_data_block * block_size + block_size)]
+    for group in range(groups_count):
+        descriptor_offset = group * descriptor_size
+        group_start = first_data_block + group * blocks_per_group
+        group_end = min(group_start + blocks_per_group, blocks_count)
+        bitmap_block, inode_bitmap_block, inode_table_block = struct.unpack_from("<3I", descriptors,
+                                                                                 descriptor_offset)
+        flags = struct.unpack_from("<H", descriptors, descriptor_offset + 0x12)[0]
+        if descriptor_size >= 64:
+            bitmap_block_hi, inode_bitmap_block_hi, inode_table_block_hi = \
+                struct.unpack_from("<3I", descriptors, descriptor_offset + 0x20)
+            bitmap_block |= bitmap_block_hi << 32
+            inode_bitmap_block |= inode_bitmap_block_hi << 32
+            inode_table_block |= inode_table_block_hi << 32
+        if flags & EXT_BG_BLOCK_UNINIT:
+            # Superblock backups are present only at some groups, assume the worst
+            used_ranges.append((group_start * block_size,
+                                min(group_start + superblock_area_blocks, group_end) * block_size))
+            used_ranges.append((bitmap_block * block_size, (bitmap_block + 1) * block_size))
+            used_ranges.append((inode_bitmap_block * block_size, (inode_bitmap_block + 1) * block_size))
+            used_ranges.append((inode_table_block * block_size, (inode_table_block + inode_table_blocks) * block_size))
+            continue
+        bitmap = read_aligned(device_fd, bitmap_block * block_size, math.ceil((group_end - group_start) / 8))
+        # A byte of bitmap is considered used if any of its 8 blocks is used. Runs of non-zero bytes are found by
+        # the regex engine much faster than bits can be checked in Python
+        for match in re.finditer(b"[^\x00]+", bitmap):
+            used_ranges.append(((group_start + match.start() * 8) * block_size,
+                                min(group_start + match.end() * 8, group_end) * block_size))
+
+    result = []
+    for start, end in sorted(used_ranges):
+        start = start // alignment * alignment
+        end = min(round_up(end, alignment), device_size)
+        if result and start <= result[-1][1]:
+            result[-1] = (result[-1][0], max(result[-1][1], end))
+        elif start < end:
+            result.append((start, end))
     return result
 
+
+def read_aligned(fd, offset, size):
+    """
+    Reads bytes from a descriptor that may be opened for direct I/O, aligning the read as it requires
+    :param fd: file descriptor
+    :param offset: offset of the first byte
+    :param size: number of bytes to read
+    :return: bytes read, less than requested at the end of the file
+    """
+    aligned_offset = offset // IMAGE_ALIGNMENT * IMAGE_ALIGNMENT
+    aligned_size = round_up(offset + size, IMAGE_ALIGNMENT) - aligned_offset
+    buffer = mmap.mmap(-1, aligned_size)
+    try:
+        with memoryview(buffer) as view:
+            length = os.preadv(fd, [view], aligned_offset)
+        return buffer[offset - aligned_offset:min(offset - aligned_offset + size, length)]
+    finally:
+        buffer.close()
+
+
+def round_up(value, alignment):
+    return (value + alignment - 1) // alignment * alignment
+
+
+def lvm_report(cmd):
+    """
+    Runs an LVM reporting command. Every run of a reporting command scans all block devices, so its output is cached
+    until an LVM command changes something
+    :param cmd: LVM command and its arguments, e.g. ['pvs', '-o', 'pv_name']
+    :return: parsed JSON output of the command
+    """
+    key = tuple(cmd)
+    if key not in lvm_report_cache:
+        lvm_report_cache[key] = run_lvm(cmd)
+    return lvm_report_cache[key]
+
+
+def run_lvm_command(cmd):
+    """
+    Runs an LVM command that changes something, and invalidates cached LVM reports
+    :param cmd: LVM command and its arguments, e.g. ['lvremove', '--force', 'vg/lv']
+    """
+    try:
+        run_lvm(cmd)
+    finally:
+        invalidate_lvm_reports()
+
+
+def invalidate_lvm_reports():
+    lvm_report_cache.clear()
+
+
+def run_lvm(cmd):
+    """
+    Runs an LVM command at the LVM shell if it is started, or as a separate process otherwise
+    :param cmd: LVM command and its arguments
+    :return: parsed JSON output of the command
+    """
+    if lvm_shell is not None:
+        return lvm_shell.run(cmd)
+    cmd_result = subprocess.run([lvm_binary] + cmd + ['--reportformat', 'json'], stdout=subprocess.PIPE,
+                                timeout=TIMEOUT, check=True, universal_newlines=True)
+    if not cmd_result.stdout.strip():
+        return {}
+    return json.loads(cmd_result.stdout)
+
+
+def start_lvm_shell(binary):
+    """
+    Starts the LVM shell, and checks that it runs a command and reports its status at the command log. Otherwise
+    LVM commands run as separate processes, that report failures by exit codes
+    :param binary: path to the lvm binary
+    """
+    global lvm_shell, lvm_binary
+    lvm_binary = binary
+    shell = None
+    try:
+        shell = LvmShell(binary)
+        document = shell.run(['vgs', '-o', 'vg_name'])
+        if not any(entry["log_type"] == "status" for entry in document.get("log", [])):
+            raise EnvironmentError("no command log in the output of vgs")
+    except (EnvironmentError, subprocess.CalledProcessError, ValueError) as e:
+        print("LVM shell can not be used ({0}), running LVM commands as separate processes".format(e))
+        if shell is not None:
+            shell.close()
+        return
+    lvm_shell = shell
+
+
+def stop_lvm_shell():
+    global lvm_shell
+    if lvm_shell is not None:
+        lvm_shell.close()
+        lvm_shell = None
+
+
+class LvmShell:
+    """
+    A long-lived 'lvm' shell process that runs LVM commands one by one. LVM configuration is read, and the LVM
+    context is set up, once per run instead of once per command.
+    Every command gets --reportformat json and log/report_command_log=1, so it prints a single JSON document that
+    also holds the command log with the status of the command. Commands that change something print nothing but the
+    log, and nothing at all if the log is not supported, so the output of a command ends at the next prompt
+    """
+
+    def __init__(self, lvm_binary):
+        self.process = subprocess.Popen([lvm_binary], stdin=subprocess.PIPE, stdout=subprocess.PIPE,
+                                        env=dict(os.environ, LVM_SUPPRESS_FD_WARNINGS="1"))
+        self.decoder = codecs.getincrementaldecoder("utf-8")()
+        self.output = ""
+        self.read_output("start")
+
+    def run(self, cmd):
+        """
+        :param cmd: LVM command and its arguments, that should not contain whitespace
+        :return: parsed JSON output of the command, or {} if it printed nothing
+        :raises subprocess.CalledProcessError: if the command fails
+        """
+        self.process.stdin.write((self.command_line(cmd) + "\n").encode())
+        self.process.stdin.flush()
+        output = self.read_output("command " + " ".join(cmd))
+        # Messages that are not a part of the document are skipped
+        start = output.find("{")
+        document = json.JSONDecoder().raw_decode(output, start)[0] if start >= 0 else {}
+        log = document.get("log", [])
+        if any(entry["log_type"] == "status" and entry["log_ret_code"] != "1" for entry in log):
+            errors = [entry["log_message"] for entry in log if entry["log_type"] == "error"]
+            raise subprocess.CalledProcessError(5, cmd, output="\n".join(errors))
+        return document
+
+    @staticmethod
+    def command_line(cmd):
+        """
+        Adds options of the shell session to a command. lvm does not allow to repeat --config, so settings of the
+        command are merged into a single option, quoted as the shell splits lines at whitespace
+        :return: line for the shell
+        """
+        settings = ["log/report_command_log=1"]
+        args = []
+        cmd_args = iter(cmd)
+        for arg in cmd_args:
+            if arg == "--config":
+                settings.append(next(cmd_args))
+            else:
+                args.append(arg)
+        return " ".join(args[:1] + ["--config", '"%s"' % " ".join(settings)] + args[1:] + ["--reportformat", "json"])
+
+    def read_output(self, what):
+        """
+        Reads output of the shell until the next prompt
+        :param what: what the shell is doing, for the error message
+        :return: output before the prompt
+        """
+        deadline = time.monotonic() + TIMEOUT
+        while True:
+            end = self.output.find(LVM_SHELL_PROMPT)
+            if end >= 0:
+                output = self.output[:end]
+                self.output = self.output[end + len(LVM_SHELL_PROMPT):]
+                return output
+            remaining = deadline - time.monotonic()
+            if remaining <= 0:
+                raise EnvironmentError("LVM shell did not complete {0} in {1} seconds".format(what, TIMEOUT))
+            ready, _, _ = select.select([self.process.stdout], [], [], remaining)
+            if ready:
+                data = os.read(self.process.stdout.fileno(), 65536)
+                if not data:
+                    raise EnvironmentError("LVM shell exited with code %s" % self.process.wait())
+                self.output += self.decoder.decode(data)
+
+    def close(self):
+        try:
+            self.process.stdin.write(b"exit\n")
+            self.process.stdin.close()
+            self.process.wait(TIMEOUT)
+        except (OSError, subprocess.TimeoutExpired):
+            self.process.kill()
+            self.process.wait()
+        self.process.stdout.close()
+
 # endregion
 
 
@@ -409,19 +1788,45 @@ def main():
     args, unknown_args = parser.parse_known_args()
     validate_args(args)
 
+    if args.action == IMAGE_APPLY_DELTA_ACTION:
+        apply_deltas(args.image_file, args.delta_file)
+        return
+
     if os.geteuid() != 0:
         raise EnvironmentError("This script requires root permissions, effective user id=%s" % os.geteuid())
 
-    if args.action == SNAPSHOT_MOUNT_ACTION:
-        try:
-            mount_snapshot(args)
-        except Exception as e:
-            print("Mounting snapshot failed, trying to clean things up")
+    start_lvm_shell(args.lvm_binary)
+    try:
+        if args.action == SNAPSHOT_MOUNT_ACTION:
+            try:
+                mount_snapshot(args)
+            except Exception as e:
+                print("Mounting snapshot failed, trying to clean things up")
+                unmount_snapshot(args)
+                print("Clean things up, raising the original exception")
+                raise e
+        elif args.action == SNAPSHOT_UNMOUNT_ACTION:
             unmount_snapshot(args)
-            print("Clean things up, raising the original exception")
-            raise e
-    elif args.action == SNAPSHOT_UNMOUNT_ACTION:
-        unmount_snapshot(args)
+        elif args.action == SNAPSHOT_WATCH_ACTION:
+            watch_snapshot(args)
+        elif args.action == SNAPSHOT_SET_MOUNT_ACTION:
+            try:
+                mount_snapshot_set(args)
+            except Exception as e:
+                print("Mounting snapshot set failed, trying to clean things up")
+                unmount_snapshot_set(args)
+                print("Clean things up, raising the original exception")
+                raise e
+        elif args.action == SNAPSHOT_SET_UNMOUNT_ACTION:
+            unmount_snapshot_set(args)
+        elif args.action == SNAPSHOT_IMAGE_ACTION:
+            try:
+                image_snapshot(args)
+            finally:
+                print("Removing snapshot")
+                remove_snapshot(args, lvm_mapper_dev_name(args.source_lvm_vg, args.lvm_snapshot_name))
+    finally:
+        stop_lvm_shell()
 
 
 if __name__ == "__main__":
@@ -1,23 +1,130 @@
 #!/usr/bin/env python3
 
 import argparse
+import bisect
+import collections
+import concurrent.futures
+import errno
+import fcntl
+import functools
+import gzip
+import hashlib
+import heapq
+import io
+import json
+import operator
 import os
+import queue
 import re
+import struct
 import sys
+import tarfile
+import threading
+import time
+import traceback
+import zlib
 from datetime import datetime
 
 GENERATE_NAME_ACTION = 'generate-name'
 AUTO_CLEAN_ACTION = 'auto-clean'
 REMOVE_UNSUCCESSFUL_ACTION = 'remove-unsuccessful'
+RUN_BACKUP_ACTION = 'run-backup'
+CAT_BACKUP_ACTION = 'cat-backup'
+VERIFY_ACTION = 'verify'
 
 DATE_STRING_FORMAT = '%Y%m%d_%H%M%S'
 
-# Constant strings for dict
-PATH = "PATH"
-FILENAME = "FILENAME"
-TIMESTAMP = "TIMESTAMP"
-POSITION_RATING = "POSITION_RATING"
-OVERALL_RATING = "OVERALL_RATING"
+
+DAY_SECONDS = 24 * 3600
+# Ages (in days) where daily, weekly and monthly periods end. Yearly period covers everything older
+DAILY_PERIOD_DAYS = 7
+WEEKLY_PERIOD_DAYS = 31
+MONTHLY_PERIOD_DAYS = 365
+
+CATALOG_VERSION = 2
+# Regex of a filename of any backup. Groups are prefix, date formatted as DATE_STRING_FORMAT, and extension
+ANY_BACKUP_FILENAME_REGEX = re.compile('(.*)__(20\\d{6}_\\d{6})(.*)\\Z', re.DOTALL)
+# Keys of a backup set at a policy file
+POLICY_SET_KEYS = ("backup_dest_dir", "prefix", "extension", "catalog_file", "daily_backups_max_count",
+                   "weekly_backups_max_count", "monthly_backups_max_count", "yearly_backups_max_count",
+                   "max_total_size_mb", "min_free_space_mb", "min_count_per_period", "dedup_store",
+                   "delete_workers", "gentle_delete_rate_mb", "gentle_delete_step_mb", "gentle_delete_min_size_mb")
+
+# Files being removed gently are renamed to start with this prefix
+GENTLE_REMOVAL_PREFIX = ".removing."
+
+# Checksums of a backup file written by run-backup are stored at a sidecar file with this suffix
+CHECKSUM_SIDECAR_SUFFIX = ".checksums"
+CHECKSUM_SIDECAR_VERSION = 1
+
+# Backups are verified by reads of this size
+VERIFY_READ_SIZE = 4 * 1024 * 1024
+# Verification progress is saved at least that often
+VERIFY_CHECKPOINT_SECONDS = 60
+
+# Incremental backups have this marker between the date and the extension
+INCREMENTAL_MARKER = ".incremental"
+# Top-level member of an incremental archive that lists archive members deleted since the previous backup
+DELETED_PATHS_MEMBER = "BACKUP_DELETED_PATHS"
+CHANGE_INDEX_VERSION = 1
+
+DEDUP_MANIFEST_VERSION = 1
+# Record of a dedup store index: sha256 of a chunk, pack number, offset and length of the compressed chunk
+DEDUP_INDEX_RECORD = struct.Struct("<32sIQI")
+# A new pack file is started once the current one reaches this size
+DEDUP_PACK_SIZE = 256 * 1024 * 1024
+# The tree walker sorts this many records at a time by inode numbers
+WALK_ORDER_WINDOW = 65536
+# Max number of directory listings the tree walker holds before the consumer takes them
+WALK_QUEUE_SIZE = 1024
+
+# Garbage collection rewrites packs where live chunks take less than this share
+DEDUP_PACK_LIVE_RATIO = 0.5
+# Offsets of preceding bytes that the hash of chunk boundaries is computed from, and random values of bytes for every
+# offset. They must never change, or chunks stop matching
+DEDUP_HASH_TAPS = (0, 2, 5, 11, 23)
+DEDUP_HASH_TABLES = tuple(bytes(hashlib.sha256(bytes([k, i])).digest()[0] for i in range(256))
+                          for k in range(len(DEDUP_HASH_TAPS)))
+
+# Records after the snapshot of a catalog are replayed one by one, so the catalog is rewritten into a new snapshot
+# once they outnumber this share of live entries, plus a few so that small catalogs are not rewritten on every run
+CATALOG_TAIL_RATIO = 0.25
+CATALOG_MIN_TAIL_RECORDS = 8
+
+
+class BackupEntry(object):
+  """
+  A backup file. Catalogs may hold millions of entries, so they are kept compact: no per-instance dict, and the
+  directory string is shared by all entries of a directory
+  """
+  __slots__ = ("directory", "filename", "timestamp", "size", "incremental", "position_rating", "overall_rating")
+
+  def __init__(self, directory, filename, timestamp, size=None, incremental=False):
+    self.directory = directory
+    self.filename = filename
+    self.timestamp = timestamp
+    self.size = size
+    # Incremental backups depend on all previous backups back to the nearest full one
+    self.incremental = incremental
+    self.position_rating = None
+    self.overall_rating = None
+
+  @property
+  def path(self):
+    return os.path.join(self.directory, self.filename)
+
+  def __eq__(self, other):
+    return isinstance(other, BackupEntry) and (self.directory, self.filename, self.timestamp) == \
+        (other.directory, other.filename, other.timestamp)
+
+  def __hash__(self):
+    return hash((self.directory, self.filename))
+
+  def __repr__(self):
+    return "BackupEntry(%r, %r, %r)" % (self.directory, self.filename, self.timestamp)
+
+
+BACKUP_TIMESTAMP_KEY = operator.attrgetter("timestamp")
 
 
 def configure_parser():
@@ -27,19 +134,74 @@ def configure_parser():
     epilog='Use at your own risk',
     formatter_class=argparse.RawTextHelpFormatter
   )
-  parser.add_argument('--backup-dest-dir', type=str, required=True,
+  parser.add_argument('--backup-dest-dir', type=str,
                       help="A destination directory where backups should be stored. Will be created recursively if "
-                           "does not exist")
+                           "does not exist. Required unless --policy-file option is used")
   parser.add_argument('-v', '--verbose', action="count",
                       help="controls verbosity. May be specified multiple times")
-  parser.add_argument("--prefix", type=str, required=True,
-                      help="String that should be prepended to a name of the backup file")
-  parser.add_argument("--extension", type=str, required=True,
-                      help="String that should be appended to a name of the backup file")
+  parser.add_argument("--prefix", type=str,
+                      help="String that should be prepended to a name of the backup file. Required unless \n"
+                           "--policy-file option is used")
+  parser.add_argument("--extension", type=str,
+                      help="String that should be appended to a name of the backup file. Required unless \n"
+                           "--policy-file option is used")
+  parser.add_argument("--catalog-file", type=str,
+                      help="Path to an append-only catalog of the --backup-dest-dir contents. If specified, all \n"
+                           "actions keep the catalog up to date, and the directory is rescanned only when its \n"
+                           "modification time changes. Even then, only entries unknown to the catalog are \n"
+                           "stat'ed. The catalog may be placed inside the backup directory. All invocations \n"
+                           "working with the same directory should use the same catalog file \n")
+  parser.add_argument("--verify-state-file", type=str,
+                      help="Path to a JSON file where the \"%s\" action keeps verification progress and \n"
+                           "results. If passed to the \"%s\" action, backups found corrupt are kept for \n"
+                           "inspection and do not count against limits, so that their good siblings are not \n"
+                           "removed \n" % (VERIFY_ACTION, AUTO_CLEAN_ACTION))
+  parser.add_argument("--dedup-store", type=str,
+                      help="Directory of a deduplicating chunk store. With this option, the \"%s\" action \n"
+                           "splits the archive into content-defined chunks, writes only chunks that are not at \n"
+                           "the store yet, and the backup file becomes a manifest listing the chunks. The \n"
+                           "\"%s\" action removes chunks that are no longer referenced by any manifest. Use \n"
+                           "the \"%s\" action to get the archive back \n" % (RUN_BACKUP_ACTION, AUTO_CLEAN_ACTION,
+                                                                          CAT_BACKUP_ACTION))
 
   auto_clean_group = parser.add_argument_group('Options for an "%s" action' % AUTO_CLEAN_ACTION,
                                                'Auto-clean old backup files')
+  auto_clean_group.add_argument("--policy-file", type=str,
+                                help="Path to a JSON file listing many backup sets (directory, prefix, extension \n"
+                                     "and limits), to auto-clean all of them in one invocation. Every directory is \n"
+                                     "scanned once. Options omitted at the policy file are taken from the command \n"
+                                     "line. See _load_policy() for the format \n")
   auto_clean_group.add_argument("--dry-mode", help="Don't perform any actions. Just show what would be done \n")
+  auto_clean_group.add_argument("--max-total-size-mb", type=int,
+                                help="Max total size of preserved backups (matching --prefix and --extension). \n"
+                                     "If preserved backups are larger, the least valuable of them are removed \n"
+                                     "as well, see also --min-count-per-period \n")
+  auto_clean_group.add_argument("--min-free-space-mb", type=int,
+                                help="Free space that should remain at the backup filesystem after auto-clean. \n"
+                                     "If there's less, the least valuable of preserved backups are removed \n"
+                                     "as well, see also --min-count-per-period \n")
+  auto_clean_group.add_argument("--min-count-per-period", type=int, default=1,
+                                help="Number of backups that every period (daily, weekly, monthly, yearly) keeps \n"
+                                     "even if that exceeds --max-total-size-mb or --min-free-space-mb. The most \n"
+                                     "recent backup is always kept. The default value is 1. \n")
+  auto_clean_group.add_argument("--delete-workers", type=int, default=4,
+                                help="Number of old backup files that are removed concurrently. Removal of a large \n"
+                                     "file may take seconds on network filesystems. The default value is 4. \n")
+  auto_clean_group.add_argument("--gentle-delete-rate-mb", type=float,
+                                help="Enables gentle removal of old backups. Large files are shrunk step by step \n"
+                                     "at most at this rate (in megabytes per second, shared by all removals), \n"
+                                     "and unlinked only at the end. That avoids latency spikes caused by \n"
+                                     "freeing hundreds of gigabytes at once \n")
+  auto_clean_group.add_argument("--gentle-delete-step-mb", type=int, default=64,
+                                help="Size of a single shrinking step for gentle removal. The default value is 64. \n")
+  auto_clean_group.add_argument("--gentle-delete-min-size-mb", type=int, default=1024,
+                                help="Files smaller than this size are unlinked at once even during gentle removal. \n"
+                                     "The default value is 1024. \n")
+  auto_clean_group.add_argument("--gentle-delete-in-background", action="store_true",
+                                help="Remove old backups at a detached background process, and exit right after \n"
+                                     "choosing them. Useful with gentle removal that may take a long time \n")
+  auto_clean_group.add_argument("--background-log", type=str,
+                                help="File to append the report of background removal to \n")
   auto_clean_group.add_argument("--daily-backups-max-count", type=int, default=5,
                                 help="Max number of daily backups (performed during last 7 days) that can be \n"
                                      "stored at a location specified by the --backup-dest-dir parameter. \n"
@@ -57,6 +219,66 @@ def configure_parser():
                                      "stored at a location specified by the --backup-dest-dir parameter. \n"
                                      "The default value is 0. \n")
 
+  run_backup_group = parser.add_argument_group('Options for a "%s" action' % RUN_BACKUP_ACTION,
+                                               'Archive a directory into a new backup file. Options of the \n'
+                                               '"%s" action are used to clean up afterwards' % AUTO_CLEAN_ACTION)
+  run_backup_group.add_argument("--source-dir", type=str,
+                                help="Directory to archive, e.g. a mountpoint produced by the snapshot-mount \n"
+                                     "action of lvm_snaphot.py. Like with tar, leading slashes are stripped from \n"
+                                     "names of archive members \n")
+  run_backup_group.add_argument("--compress-workers", type=int, default=os.cpu_count() or 1,
+                                help="Number of processes that compress the archive. The default value is the \n"
+                                     "number of CPUs. \n")
+  run_backup_group.add_argument("--compress-level", type=int, default=5, choices=range(1, 10),
+                                help="Gzip compression level. The default value is 5. \n")
+  run_backup_group.add_argument("--compress-chunk-mb", type=int, default=4,
+                                help="Size of a chunk of the archive that is compressed by one worker as a \n"
+                                     "separate gzip member. Larger chunks compress slightly better. The default \n"
+                                     "value is 4. \n")
+  run_backup_group.add_argument("--write-buffer-mb", type=int, default=16,
+                                help="Compressed data is written to the backup file in blocks of this size. \n"
+                                     "The default value is 16. \n")
+  run_backup_group.add_argument("--checksum-block-mb", type=int, default=16,
+                                help="The backup file is hashed with SHA-256 while it's written, as a whole and \n"
+                                     "in blocks of this size. Checksums are stored at a sidecar file named like \n"
+                                     "the backup file with a '%s' suffix. The default value is 16. \n"
+                                     % CHECKSUM_SIDECAR_SUFFIX)
+  run_backup_group.add_argument("--walk-workers", type=int, default=8,
+                                help="Number of threads that list and stat --source-dir. Listing a tree of \n"
+                                     "millions of small files is dominated by metadata latency, so more threads \n"
+                                     "than CPUs may help. The default value is 8. \n")
+  run_backup_group.add_argument("--dedup-chunk-kb", type=int, default=1024,
+                                help="Average size of a chunk written to --dedup-store. Chunks are 4 times \n"
+                                     "smaller to 4 times larger. Backups written with different values share \n"
+                                     "few chunks. The default value is 1024. \n")
+  run_backup_group.add_argument("--change-index-file", type=str,
+                                help="Enables incremental backups. The file keeps an index of entries of \n"
+                                     "--source-dir (path, inode, size, mtime and ctime) as of the latest backup. \n"
+                                     "If it exists, only new and changed entries are archived, along with a \n"
+                                     "list of deleted ones. Incremental backups get an '%s' marker before \n"
+                                     "the extension. Auto-clean keeps all backups that preserved incremental \n"
+                                     "ones depend on \n" % INCREMENTAL_MARKER)
+  run_backup_group.add_argument("--max-incremental-chain", type=int, default=6,
+                                help="Max number of incremental backups after a full one. The next backup is a \n"
+                                     "full one. The default value is 6. \n")
+
+  verify_group = parser.add_argument_group('Options for a "%s" action' % VERIFY_ACTION,
+                                           'Verify backups against their checksum sidecars')
+  verify_group.add_argument("--verify-rate-mb", type=float,
+                            help="Max total read rate of verification, in megabytes per second \n")
+  verify_group.add_argument("--verify-iops", type=float,
+                            help="Max total number of reads per second of verification. Every read is %s MiB \n"
+                                 % (VERIFY_READ_SIZE // (1024 * 1024)))
+  verify_group.add_argument("--verify-max-seconds", type=int,
+                            help="Stop verification after this time. Progress is saved to \n"
+                                 "--verify-state-file, and the next run resumes from there \n")
+
+  cat_backup_group = parser.add_argument_group('Options for a "%s" action' % CAT_BACKUP_ACTION,
+                                               'Write a backup stored at a dedup store to stdout')
+  cat_backup_group.add_argument("--backup-file", type=str,
+                                help="Path to a manifest written by the \"%s\" action with --dedup-store \n"
+                                     % RUN_BACKUP_ACTION)
+
   remove_unsuccessful_group = parser.add_argument_group('Options for a "%s" action' % REMOVE_UNSUCCESSFUL_ACTION,
                                                         'Remove leftovers after a previous unsuccessful backup')
   remove_unsuccessful_group.add_argument("--remove-file", type=str,
@@ -64,7 +286,8 @@ def configure_parser():
                                               "unsuccessful backup (it will be removed if exists) \n")
 
   parser.add_argument('action', metavar="ACTION",
-                      choices=[GENERATE_NAME_ACTION, AUTO_CLEAN_ACTION, REMOVE_UNSUCCESSFUL_ACTION],
+                      choices=[GENERATE_NAME_ACTION, AUTO_CLEAN_ACTION, REMOVE_UNSUCCESSFUL_ACTION, RUN_BACKUP_ACTION,
+                               CAT_BACKUP_ACTION, VERIFY_ACTION],
                       help=(
                         'The "{0}" action generates an absolute filename for a backup file and \n'
                         'writes it to stdout. Filename includes date formatted as {1}\n'
@@ -82,13 +305,45 @@ def configure_parser():
                         'unsuccessful backup (if it exists). If the file does not exist, action just exits \n'
                         'with a zero exit code. If any other error occurs, the action exits with a non-zero \n'
                         'exit code \n'
-                      ).format(GENERATE_NAME_ACTION, DATE_STRING_FORMAT, AUTO_CLEAN_ACTION, REMOVE_UNSUCCESSFUL_ACTION))
+                        ' \n'
+                        'The "{4}" action archives --source-dir into a new backup file (a tar archive, \n'
+                        'compressed in parallel into a multi-member gzip file), like "{0}" followed by \n'
+                        'tar and pigz would do. If archiving succeeds, old backups are removed like "{2}" \n'
+                        'does, otherwise the new backup file is removed like "{3}" does \n'
+                        ' \n'
+                        'The "{5}" action writes the tar archive of a backup stored at --dedup-store \n'
+                        'to stdout \n'
+                        ' \n'
+                        'The "{6}" action re-reads backups and compares them with their checksum \n'
+                        'sidecars. Backups that were verified least recently go first, and backups at \n'
+                        'different disks are read in parallel. Exits with a non-zero exit code if any \n'
+                        'backup is corrupt \n'
+                      ).format(GENERATE_NAME_ACTION, DATE_STRING_FORMAT, AUTO_CLEAN_ACTION, REMOVE_UNSUCCESSFUL_ACTION,
+                               RUN_BACKUP_ACTION, CAT_BACKUP_ACTION, VERIFY_ACTION))
   return parser
 
 
 def validate_args(args):
   if args.remove_file and not args.action == REMOVE_UNSUCCESSFUL_ACTION:
     raise ValueError("--remove-file option is only valid for action '%s'" % REMOVE_UNSUCCESSFUL_ACTION)
+  if args.policy_file and args.action not in (AUTO_CLEAN_ACTION, VERIFY_ACTION):
+    raise ValueError("--policy-file option is only valid for actions '%s' and '%s'" % (AUTO_CLEAN_ACTION,
+                                                                                       VERIFY_ACTION))
+  if bool(args.source_dir) != (args.action == RUN_BACKUP_ACTION):
+    raise ValueError("--source-dir option is required for action '%s', and is not valid for other "
+                     "actions" % RUN_BACKUP_ACTION)
+  if bool(args.backup_file) != (args.action == CAT_BACKUP_ACTION):
+    raise ValueError("--backup-file option is required for action '%s', and is not valid for other "
+                     "actions" % CAT_BACKUP_ACTION)
+  if not args.policy_file and not args.action == CAT_BACKUP_ACTION:
+    for option, value in (("--backup-dest-dir", args.backup_dest_dir), ("--prefix", args.prefix),
+                          ("--extension", args.extension)):
+      if not value:
+        raise ValueError("%s option is required unless --policy-file option is used" % option)
+
+
+def _normalize_extension(extension):
+  return extension if extension.startswith(".") else ".%s" % extension
 
 
 def generate_name(args):
@@ -116,29 +371,340 @@ def generate_name(args):
   if not os.path.exists(args.backup_dest_dir):
     os.makedirs(args.backup_dest_dir)
 
+  if args.catalog_file:
+    # Catch up with the directory before the backup file is written, so that the next auto-clean
+    # only has to pick up the new backup
+    _sync_catalog(args)
+
   return full_path, 0
 
 
 def auto_clean(args):
+  if args.policy_file:
+    return auto_clean_policy(args)
+
   if not os.path.isdir(args.backup_dest_dir):
     msg = "Path %s is not a directory" % args.backup_dest_dir
     return msg, 1
 
-  backups = _list_backup_files(args)
-  files_to_preserve = _choose_valuable_backups(backups, args)
+  stdout = []
+  backups = _exclude_corrupt_backups(args, _list_backup_files(args), stdout)
+  backups_to_remove = _choose_backups_to_remove(backups, args)
+  if args.dry_mode:
+    stdout.extend("Would remove old backup %s" % backup.filename for backup in backups_to_remove)
+    return "\n".join(stdout), 0
+
+  if args.gentle_delete_rate_mb:
+    # Pick up files left by gentle removal that was interrupted
+    backups_to_remove.extend(_list_unfinished_removals(args))
+
+  def remove():
+    removal_stdout, removed_paths, reclaimed_bytes, exit_code = _remove_old_backups(args, backups_to_remove)
+    stdout.extend(removal_stdout)
+    stdout.append("Removed %s old backup files, reclaimed %s." % (len(removed_paths), _format_size(reclaimed_bytes)))
+    if args.dedup_store:
+      stdout.append(_collect_dedup_garbage(args.dedup_store, removed_paths))
+    return "\n".join(stdout), exit_code
+
+  if args.gentle_delete_in_background:
+    pid = _run_in_background(args, remove)
+    stdout.append("Removing %s old backup files in background process %s" % (len(backups_to_remove), pid))
+    return "\n".join(stdout), 0
+  return remove()
+
 
+def auto_clean_policy(args):
+  """
+  Auto-cleans all backup sets listed at a policy file. Every backup directory is scanned once, no matter how
+  many backup sets it contains.
+  :param args: application args
+  :return: tuple (combined report, exit_code)
+  """
+  backup_sets = _load_policy(args)
   stdout = []
-  backups_to_remove = [backup for backup in backups if backup not in files_to_preserve]
-  for backup in backups_to_remove:
-    if backup not in files_to_preserve:
+  exit_code = 0
+  removals = []
+  for dir_sets in _group_backup_sets_by_dir(backup_sets):
+    if not os.path.isdir(dir_sets[0].backup_dest_dir):
+      stdout.append("Path %s is not a directory" % dir_sets[0].backup_dest_dir)
+      exit_code = 1
+      continue
+    listings, unfinished_removals = _list_backup_sets(dir_sets)
+    for set_args, backups, unfinished in zip(dir_sets, listings, unfinished_removals):
+      backups = _exclude_corrupt_backups(set_args, backups, stdout)
+      backups_to_remove = _choose_backups_to_remove(backups, set_args)
       if args.dry_mode:
-        stdout.append("Would remove old backup %s" % backup[FILENAME])
+        stdout.append(_backup_set_title(set_args))
+        stdout.extend("Would remove old backup %s" % backup.filename for backup in backups_to_remove)
+      elif set_args.gentle_delete_rate_mb:
+        removals.append((set_args, backups_to_remove + unfinished))
       else:
-        stdout.append("Removing old backup %s" % backup[FILENAME])
-        os.remove(backup[PATH])
-  if not args.dry_mode:
-    stdout.append("Removed %s old backup files." % len(backups_to_remove))
-  return "\n".join(stdout), 0
+        removals.append((set_args, backups_to_remove))
+  if args.dry_mode:
+    return "\n".join(stdout), exit_code
+
+  def remove():
+    total_removed_paths = []
+    total_reclaimed_bytes = 0
+    total_exit_code = exit_code
+    for set_args, backups_to_remove in removals:
+      set_stdout, removed_paths, reclaimed_bytes, set_exit_code = _remove_old_backups(set_args, backups_to_remove)
+      stdout.append(_backup_set_title(set_args))
+      stdout.extend(set_stdout)
+      stdout.append("Removed %s old backup files, reclaimed %s." % (len(removed_paths),
+                                                                    _format_size(reclaimed_bytes)))
+      total_removed_paths.extend(removed_paths)
+      total_reclaimed_bytes += reclaimed_bytes
+      total_exit_code = total_exit_code or set_exit_code
+    stdout.append("Processed %s backup sets, removed %s old backup files, reclaimed %s."
+                  % (len(backup_sets), len(total_removed_paths), _format_size(total_reclaimed_bytes)))
+    # Stores may be shared by backup sets, so they are cleaned once all backup sets are
+    for store in sorted({set_args.dedup_store for set_args in backup_sets if set_args.dedup_store}):
+      stdout.append(_collect_dedup_garbage(store, total_removed_paths))
+    return "\n".join(stdout), total_exit_code
+
+  if args.gentle_delete_in_background:
+    pid = _run_in_background(args, remove)
+    stdout.append("Removing old backup files of %s backup sets in background process %s" % (len(removals), pid))
+    return "\n".join(stdout), exit_code
+  return remove()
+
+
+def _exclude_corrupt_backups(args, backups, stdout):
+  """
+  Leaves out backups that the "verify" action found corrupt: they are neither removed nor counted against limits
+  :param stdout: list of report lines, a warning is appended for every corrupt backup
+  :return: a list of backups that are not known to be corrupt
+  """
+  if not args.verify_state_file:
+    return backups
+  state = _read_verify_state(args.verify_state_file)
+  result = []
+  for backup in backups:
+    record = state.get(backup.path)
+    if record and record["status"] == "corrupt":
+      stdout.append("Backup %s is corrupt (%s), keeping it for inspection" % (backup.filename, record["error"]))
+    else:
+      result.append(backup)
+  return result
+
+
+def _choose_backups_to_remove(backups, args):
+  files_to_preserve = _choose_valuable_backups(backups, args)
+  if _size_budget_enabled(args):
+    files_to_preserve = _apply_size_budget(backups, files_to_preserve, args)
+  # All backups are at the same directory, so filenames are enough to tell them apart
+  filenames_to_preserve = {backup.filename for backup in files_to_preserve}
+  _preserve_chain_dependencies(backups, filenames_to_preserve)
+  return [backup for backup in backups if backup.filename not in filenames_to_preserve]
+
+
+def _preserve_chain_dependencies(backups, filenames_to_preserve):
+  """
+  Makes sure that every preserved incremental backup keeps all previous backups of its chain, back to the
+  nearest full backup.
+  :param backups: all backups, sorted ascending by timestamps
+  :param filenames_to_preserve: set of filenames of preserved backups, updated in place
+  """
+  needed = False
+  for backup in reversed(backups):
+    if needed:
+      filenames_to_preserve.add(backup.filename)
+    # A full backup ends the chain of newer incremental backups
+    needed = backup.incremental and (needed or backup.filename in filenames_to_preserve)
+
+
+def _remove_old_backups(args, backups_to_remove):
+  """
+  Removes backups and reports results.
+  :return: tuple (list of report lines, paths of removed backups, reclaimed bytes, exit_code). Paths of gentle
+  removal leftovers are reported without the prefix, as backups were named
+  """
+  dir_mtime_ns = None
+  if args.catalog_file:
+    dir_mtime_ns = os.stat(args.backup_dest_dir).st_mtime_ns
+
+  stdout = []
+  removed_names = []
+  removed_paths = []
+  reclaimed_bytes = 0
+  exit_code = 0
+  for backup, (size, seconds, error) in zip(backups_to_remove, _remove_backups(args, backups_to_remove)):
+    if error:
+      stdout.append("Failed to remove old backup %s: %s" % (backup.filename, error))
+      exit_code = 1
+      continue
+    stdout.append("Removed old backup %s (%s in %.3f s)" % (backup.filename, _format_size(size), seconds))
+    removed_names.extend((backup.filename, _checksum_sidecar_name(backup.filename)))
+    removed_paths.append(os.path.join(os.path.dirname(backup.path), _backup_name(backup.filename)))
+    reclaimed_bytes += size
+  if args.catalog_file:
+    _update_catalog(args, removed_names, dir_mtime_ns)
+  return stdout, removed_paths, reclaimed_bytes, exit_code
+
+
+def _remove_backups(args, backups):
+  """
+  Removes backup files in parallel. The backup directory is opened once, and files are unlinked relative to it,
+  so that every removal does not have to resolve the full path again.
+  :param args: application args
+  :param backups: backups to remove
+  :return: a list of tuples (size_in_bytes, seconds_taken, error_or_None), in the order of backups
+  """
+  gentle_removal = None
+  if args.gentle_delete_rate_mb:
+    gentle_removal = (_Throttle(args.gentle_delete_rate_mb * 1024 * 1024),
+                      args.gentle_delete_step_mb * 1024 * 1024,
+                      args.gentle_delete_min_size_mb * 1024 * 1024)
+  dir_fd = os.open(os.path.abspath(args.backup_dest_dir), os.O_RDONLY | os.O_DIRECTORY)
+  try:
+    with concurrent.futures.ThreadPoolExecutor(max_workers=max(args.delete_workers, 1)) as executor:
+      return list(executor.map(lambda backup: _remove_backup_file(backup.filename, dir_fd, gentle_removal),
+                               backups))
+  finally:
+    os.close(dir_fd)
+
+
+def _remove_backup_file(filename, dir_fd, gentle_removal=None):
+  started = time.monotonic()
+  try:
+    if gentle_removal:
+      size = _remove_file_gently(filename, dir_fd, *gentle_removal)
+    else:
+      size = os.stat(filename, dir_fd=dir_fd, follow_symlinks=False).st_size
+      os.unlink(filename, dir_fd=dir_fd)
+  except FileNotFoundError:
+    # Already removed by someone else
+    size = 0
+  except OSError as e:
+    return 0, time.monotonic() - started, e
+  # The sidecar goes last: an interrupted removal leaves a backup with checksums, or a gentle removal leftover
+  try:
+    os.unlink(_checksum_sidecar_name(filename), dir_fd=dir_fd)
+  except FileNotFoundError:
+    pass
+  except OSError as e:
+    return size, time.monotonic() - started, e
+  return size, time.monotonic() - started, None
+
+
+def _checksum_sidecar_name(filename):
+  return _backup_name(filename) + CHECKSUM_SIDECAR_SUFFIX
+
+
+def _backup_name(filename):
+  """
+  :return: name of the backup, whose gentle removal left the file
+  """
+  if filename.startswith(GENTLE_REMOVAL_PREFIX):
+    return filename[len(GENTLE_REMOVAL_PREFIX):]
+  return filename
+
+
+def _remove_file_gently(filename, dir_fd, throttle, step, min_size):
+  """
+  Shrinks a large file step by step under the throttle budget before unlinking it, so that the filesystem frees
+  extents gradually instead of issuing a storm of journal writes and discards at once.
+  The file is renamed first, so that a half-truncated file is never mistaken for a backup, even if the removal is
+  interrupted. Such leftovers are picked up by the next removal, see _list_unfinished_removals().
+  :return: size of the file in bytes
+  """
+  if filename.startswith(GENTLE_REMOVAL_PREFIX):
+    removal_name = filename
+  else:
+    removal_name = GENTLE_REMOVAL_PREFIX + filename
+    os.rename(filename, removal_name, src_dir_fd=dir_fd, dst_dir_fd=dir_fd)
+  fd = os.open(removal_name, os.O_WRONLY | os.O_NOFOLLOW, dir_fd=dir_fd)
+  try:
+    file_stat = os.fstat(fd)
+    # Truncating a file that has other hard links would destroy the data visible through them
+    if file_stat.st_nlink == 1 and file_stat.st_size >= min_size:
+      remaining = file_stat.st_size
+      while remaining > 0:
+        throttle.consume(min(step, remaining))
+        remaining = max(remaining - step, 0)
+        os.ftruncate(fd, remaining)
+  finally:
+    os.close(fd)
+  os.unlink(removal_name, dir_fd=dir_fd)
+  return file_stat.st_size
+
+
+def _list_unfinished_removals(args):
+  """
+  Lists backup files that were renamed for gentle removal, but were not removed
+  :param args: application args
+  :return: a list of backups
+  """
+  backup_dir = os.path.abspath(args.backup_dest_dir)
+  match = _backup_filename_regex(args.prefix, args.extension).match
+  filenames = _sync_catalog(args) if args.catalog_file else os.listdir(backup_dir)
+  result = []
+  for filename in filenames:
+    if filename.startswith(GENTLE_REMOVAL_PREFIX):
+      matched = match(filename[len(GENTLE_REMOVAL_PREFIX):])
+      if matched:
+        result.append(_backup_entry(backup_dir, filename, matched.group(1)))
+  return result
+
+
+class _Throttle(object):
+  """
+  Limits the rate of an operation shared by several threads. Every consume() call reserves the next slot of the
+  budget and sleeps until that slot begins
+  """
+
+  def __init__(self, amount_per_second):
+    self.amount_per_second = amount_per_second
+    self._lock = threading.Lock()
+    self._next_slot = time.monotonic()
+
+  def consume(self, amount):
+    with self._lock:
+      now = time.monotonic()
+      slot = max(self._next_slot, now)
+      self._next_slot = slot + amount / self.amount_per_second
+    if slot > now:
+      time.sleep(slot - now)
+
+
+def _run_in_background(args, function):
+  """
+  Runs a function at a detached child process. Standard output and error of the child process go to the file
+  specified by --background-log option (if any)
+  :param function: function returning a tuple (output, exit_code)
+  :return: pid of the child process
+  """
+  pid = os.fork()
+  if pid:
+    return pid
+  exit_code = 1
+  try:
+    os.setsid()
+    devnull_fd = os.open(os.devnull, os.O_RDWR)
+    log_fd = devnull_fd
+    if args.background_log:
+      log_fd = os.open(args.background_log, os.O_WRONLY | os.O_CREAT | os.O_APPEND, 0o644)
+    # Detach from the pipes of the caller, so that shell scripts and CI jobs do not wait for the child
+    os.dup2(devnull_fd, 0)
+    os.dup2(log_fd, 1)
+    os.dup2(log_fd, 2)
+    output, exit_code = function()
+    print(output)
+  except BaseException:
+    traceback.print_exc()
+  finally:
+    sys.stdout.flush()
+    sys.stderr.flush()
+    os._exit(exit_code)
+
+
+def _format_size(size):
+  for unit in ("bytes", "KiB", "MiB", "GiB"):
+    if size < 1024:
+      return ("%d %s" if unit == "bytes" else "%.1f %s") % (size, unit)
+    size /= 1024
+  return "%.1f TiB" % size
 
 
 def _list_backup_files(args):
@@ -147,74 +713,342 @@ def _list_backup_files(args):
   :param args: application args
   :return: a list of backups sorted ascending by timestamps, e.g. the most recent backup is last
   """
-  result = []
-  # Regex of expected filename
-  regex_str = '^%s__(20\\d{6}_\\d{6})%s$' % (re.escape(args.prefix), re.escape(args.extension))
-  regex = re.compile(regex_str)
+  return sorted(_iter_backup_files(args), key=BACKUP_TIMESTAMP_KEY)
 
-  for filename in os.listdir(args.backup_dest_dir):
-    full_path = os.path.join(os.path.abspath(args.backup_dest_dir), filename)
-    if not os.path.isfile(full_path):
-      continue
-    match = re.search(regex, filename)
-    if not match:
-      continue
-    date_str = match.group(1)
-    file_time = datetime.strptime(date_str, DATE_STRING_FORMAT)
-    entry = {
-      PATH: full_path,
-      FILENAME: filename,
-      TIMESTAMP: file_time.timestamp()
-    }
-    result.append(entry)
-  return sorted(result, key=lambda item: item[TIMESTAMP])
+
+def _iter_backup_files(args):
+  """
+  Lazily yields backup files at a directory in no particular order. Directory is read in a single pass,
+  file types are taken from directory entries, so no file is stat'ed (unless the filesystem does not report
+  entry types).
+  :param args: application args
+  """
+  backup_dir = os.path.abspath(args.backup_dest_dir)
+  match = _backup_filename_regex(args.prefix, args.extension).match
+  for filename, size, matched in _scan_backup_dir(args, match):
+    yield _backup_entry(backup_dir, filename, matched.group(1), size, bool(matched.group(2)))
+
+
+def _scan_backup_dir(args, match):
+  """
+  Lazily yields regular files at the backup directory whose names are accepted by the match function
+  :param args: application args
+  :param match: function that takes a filename and returns a match object, or None for unrelated files
+  :return: generator of tuples (filename, size_or_None, match_object). Sizes are gathered only if a size budget
+  is configured (see _size_budget_enabled()) or if the catalog is used
+  """
+  need_sizes = _size_budget_enabled(args)
+  if args.catalog_file:
+    backup_dir = os.path.abspath(args.backup_dest_dir)
+    # The catalog only lists regular files
+    for filename, size in _sync_catalog(args).items():
+      matched = match(filename)
+      if matched:
+        if need_sizes:
+          # The catalog records sizes once, and a file may have been still written at that moment. Writes to a
+          # file do not change the modification time of the directory, so its size is never refreshed otherwise
+          try:
+            size = os.stat(os.path.join(backup_dir, filename)).st_size
+          except FileNotFoundError:
+            continue
+        yield filename, size, matched
+    return
+
+  with os.scandir(os.path.abspath(args.backup_dest_dir)) as dir_entries:
+    for dir_entry in dir_entries:
+      # Name check goes first: it does not involve any system calls
+      matched = match(dir_entry.name)
+      if matched and dir_entry.is_file():
+        yield dir_entry.name, dir_entry.stat().st_size if need_sizes else None, matched
+
+
+def _list_backup_sets(dir_sets):
+  """
+  Lists backups of several backup sets located at the same directory in a single pass. Every filename is parsed
+  once, and dispatched to its backup set by prefix and extension.
+  :param dir_sets: args of backup sets that share a backup directory
+  :return: tuple (list of backup lists, list of lists of unfinished gentle removals), one item per backup set.
+  Backup lists are sorted ascending by timestamps
+  """
+  set_indices = {(set_args.prefix, set_args.extension): index for index, set_args in enumerate(dir_sets)}
+  scan_args = argparse.Namespace(**vars(dir_sets[0]))
+  for set_args in dir_sets:
+    if _size_budget_enabled(set_args):
+      scan_args.max_total_size_mb = set_args.max_total_size_mb
+      scan_args.min_free_space_mb = set_args.min_free_space_mb
+
+  def match(filename):
+    if filename.startswith(GENTLE_REMOVAL_PREFIX):
+      filename = filename[len(GENTLE_REMOVAL_PREFIX):]
+    matched = ANY_BACKUP_FILENAME_REGEX.match(filename)
+    if matched and (matched.group(1), _strip_incremental_marker(matched.group(3))) in set_indices:
+      return matched
+    return None
+
+  listings = [[] for _ in dir_sets]
+  unfinished_removals = [[] for _ in dir_sets]
+  backup_dir = os.path.abspath(dir_sets[0].backup_dest_dir)
+  for filename, size, matched in _scan_backup_dir(scan_args, match):
+    extension = _strip_incremental_marker(matched.group(3))
+    index = set_indices[(matched.group(1), extension)]
+    target = unfinished_removals if filename.startswith(GENTLE_REMOVAL_PREFIX) else listings
+    target[index].append(_backup_entry(backup_dir, filename, matched.group(2), size,
+                                       extension != matched.group(3)))
+  for backups in listings:
+    backups.sort(key=BACKUP_TIMESTAMP_KEY)
+  return listings, unfinished_removals
+
+
+def _backup_entry(backup_dir, filename, date_str, size=None, incremental=False):
+  return BackupEntry(backup_dir, filename, _decode_timestamp(date_str), size, incremental)
+
+
+@functools.lru_cache(maxsize=None)
+def _backup_filename_regex(prefix, extension):
+  """
+  :return: compiled anchored regex of a backup filename. Group 1 is a date formatted as DATE_STRING_FORMAT,
+  group 2 is INCREMENTAL_MARKER for incremental backups
+  """
+  pattern = '%s__(20\\d{6}_\\d{6})(%s)?%s\\Z' % (re.escape(prefix), re.escape(INCREMENTAL_MARKER), re.escape(extension))
+  return re.compile(pattern)
+
+
+def _strip_incremental_marker(extension):
+  return extension[len(INCREMENTAL_MARKER):] if extension.startswith(INCREMENTAL_MARKER) else extension
+
+
+def _decode_timestamp(date_str):
+  """
+  Fast equivalent of datetime.strptime(date_str, DATE_STRING_FORMAT).timestamp(). Date string has a fixed
+  width, so fields are taken by slicing. Conversion of local time to epoch is the expensive part, and it is
+  cached per hour (DST switches happen at hour boundaries).
+  :param date_str: date formatted as DATE_STRING_FORMAT, e.g. 20181101_031401
+  :return: POSIX timestamp
+  """
+  minutes = int(date_str[11:13])
+  seconds = int(date_str[13:15])
+  if minutes > 59 or seconds > 59:
+    raise ValueError("Invalid time in date string %s" % date_str)
+  return _hour_timestamp(date_str[:11]) + minutes * 60 + seconds
+
+
+@functools.lru_cache(maxsize=65536)
+def _hour_timestamp(hour_str):
+  """
+  :param hour_str: date and hour formatted as %Y%m%d_%H
+  :return: POSIX timestamp of the beginning of the hour in local time
+  """
+  return datetime(int(hour_str[0:4]), int(hour_str[4:6]), int(hour_str[6:8]), int(hour_str[9:11])).timestamp()
 
 
 def _choose_valuable_backups(backups, args):
   """
+  Chooses backups to preserve. Each period (daily, weekly, monthly and yearly) keeps at most the configured number
+  of backups, spread over the period as evenly as possible (the idea is similar to RRD file format). The period
+  is divided into equal buckets, one per backup slot, and every bucket keeps the backup that is the closest to its
+  end. Slots of empty buckets are given to backups that split the widest remaining gaps in coverage.
+  Chosen backups get a position_rating (0..1, how close the backup is to the ideal point of its slot) and
+  an overall_rating (the share of the period that would become uncovered without this backup).
   :param backups: source list of backups (sorted ascending by timestamps, e.g. the most recent backup is last)
-  :return: a list of backups that are valuable and should be preserved
+  :param args: application args
+  :return: a list of backups that are valuable and should be preserved (sorted ascending by timestamps)
   """
+  now_timestamp = datetime.now().timestamp()
+  timestamps = [backup.timestamp for backup in backups]
+  periods = _split_backups(backups, now_timestamp, timestamps)
+  max_counts = (args.daily_backups_max_count, args.weekly_backups_max_count,
+                args.monthly_backups_max_count, args.yearly_backups_max_count)
+  oldest_timestamp = timestamps[0] if timestamps else now_timestamp
+  bounds = _period_bounds(now_timestamp, oldest_timestamp)
+
+  result = []
+  # Periods go from the most recent one, so iterate backwards to keep the result sorted
+  for (low, high), (start, end), max_count in reversed(list(zip(periods, bounds, max_counts))):
+    result.extend(_choose_from_period(backups, timestamps, low, high, start, end, max_count))
+  return result
+
 
-  # TODO: sparingly balance daily, weekly and monthly backups between periods
-  # TODO: cleanup lists to follow limits and distribute uniformly
+def _choose_from_period(backups, timestamps, low, high, start, end, max_count):
+  """
+  Chooses up to max_count backups that give the best coverage of a period. Takes O(max_count * log(n)) time.
+  :param backups: all backups, sorted ascending by timestamps
+  :param timestamps: timestamps of all backups
+  :param low: index of the first backup of the period
+  :param high: index past the last backup of the period
+  :param start: timestamp of the beginning of the period
+  :param end: timestamp of the end of the period
+  :param max_count: max number of backups to choose
+  :return: chosen backups, sorted ascending by timestamps
+  """
+  if max_count <= 0 or low == high:
+    return []
+  start = min(start, timestamps[low])
+  end = max(end, timestamps[high - 1])
+  length = max(end - start, 1.0)
 
-  # entry = {
-  #   "path": "",
-  #   "timestamp": 4343,
-  #   "position_rating": 0,
-  #   "overall_rating": 0,
-  # }
+  position_ratings = {}
+  if high - low <= max_count:
+    for index in range(low, high):
+      position_ratings[index] = 1.0
+  else:
+    # Every bucket (bucket_start, bucket_end] keeps its latest backup
+    width = length / max_count
+    for slot in range(max_count):
+      bucket_start = start + slot * width
+      bucket_end = end if slot == max_count - 1 else bucket_start + width
+      index = bisect.bisect_right(timestamps, bucket_end, low, high) - 1
+      if index >= low and (timestamps[index] > bucket_start or slot == 0):
+        position_ratings[index] = 1.0 - (bucket_end - timestamps[index]) / width
+    _fill_coverage_gaps(timestamps, low, high, start, end, max_count, position_ratings)
 
   result = []
-  daily_backups, weekly_backups, monthly_backups, yearly_backups = _split_backups(backups)
-  max_count = args.daily_backups_max_count + args.weekly_backups_max_count + \
-      args.monthly_backups_max_count + args.yearly_backups_max_count
-  for backup in reversed(yearly_backups + monthly_backups + weekly_backups + daily_backups):
-    if len(result) >= max_count:
-      break
-    result.append(backup)
-  result.reverse()
+  for index in sorted(position_ratings):
+    backups[index].position_rating = position_ratings[index]
+    result.append(backups[index])
+  _rate_coverage(result, start, end)
   return result
 
 
-def _split_backups(backups):
-  daily_backups = []
-  weekly_backups = []
-  monthly_backups = []
-  yearly_backups = []
-  now_timestamp = datetime.now().timestamp()
-  day_seconds = 24 * 3600
+def _rate_coverage(chosen, start, end):
+  """
+  Sets overall_rating of chosen backups of a period: the share of the period between neighbours of a backup (or
+  period bounds), that is the share that would become uncovered without this backup.
+  :param chosen: chosen backups of a period, sorted ascending by timestamps
+  """
+  if not chosen:
+    return
+  start = min(start, chosen[0].timestamp)
+  end = max(end, chosen[-1].timestamp)
+  length = max(end - start, 1.0)
+  for i, backup in enumerate(chosen):
+    previous_timestamp = chosen[i - 1].timestamp if i > 0 else start
+    next_timestamp = chosen[i + 1].timestamp if i + 1 < len(chosen) else end
+    backup.overall_rating = (next_timestamp - previous_timestamp) / length
+
+
+def _fill_coverage_gaps(timestamps, low, high, start, end, max_count, position_ratings):
+  """
+  Chooses more backups of a period until there are max_count of them. Each time, the widest gap between chosen
+  backups (or period bounds) is split by the backup nearest to its middle.
+  :param timestamps: sorted timestamps of backups
+  :param low: index of the first backup of the period
+  :param high: index past the last backup of the period
+  :param position_ratings: dict {index of a chosen backup -> position rating}, updated in place
+  """
+  # Chosen backups, with period bounds acting as chosen backups with indices low - 1 and high
+  points = [(low - 1, start)] + [(index, timestamps[index]) for index in sorted(position_ratings)] + [(high, end)]
+  # Heap of gaps (-gap_width, gap_start, gap_end, first_candidate_index, candidates_end_index)
+  gaps = []
+  for (left_index, left_timestamp), (right_index, right_timestamp) in zip(points, points[1:]):
+    if right_index - left_index > 1:
+      gaps.append((left_timestamp - right_timestamp, left_timestamp, right_timestamp, left_index + 1, right_index))
+  heapq.heapify(gaps)
+
+  while gaps and len(position_ratings) < max_count:
+    _, gap_start, gap_end, gap_low, gap_high = heapq.heappop(gaps)
+    middle = (gap_start + gap_end) / 2
+    index = bisect.bisect_left(timestamps, middle, gap_low, gap_high)
+    if index == gap_high or (index > gap_low and middle - timestamps[index - 1] < timestamps[index] - middle):
+      index -= 1
+    half_width = max((gap_end - gap_start) / 2, 1.0)
+    position_ratings[index] = max(0.0, 1.0 - abs(timestamps[index] - middle) / half_width)
+    if index > gap_low:
+      heapq.heappush(gaps, (gap_start - timestamps[index], gap_start, timestamps[index], gap_low, index))
+    if index + 1 < gap_high:
+      heapq.heappush(gaps, (timestamps[index] - gap_end, timestamps[index], gap_end, index + 1, gap_high))
+
+
+def _size_budget_enabled(args):
+  return args.max_total_size_mb is not None or args.min_free_space_mb is not None
+
+
+def _apply_size_budget(backups, preserved, args):
+  """
+  Drops preserved backups with the lowest overall_rating until preserved backups take no more than
+  --max-total-size-mb, and removal leaves at least --min-free-space-mb of free space. Every period keeps at least
+  --min-count-per-period backups, and the most recent backup is never dropped.
+  :param backups: all backups (sorted ascending by timestamps) with known sizes
+  :param preserved: backups chosen by _choose_valuable_backups()
+  :param args: application args
+  :return: a list of backups to preserve (sorted ascending by timestamps)
+  """
+  if not preserved:
+    return preserved
   for backup in backups:
-    if backup[TIMESTAMP] >= now_timestamp - 7 * day_seconds:
-      daily_backups.append(backup)
-    elif now_timestamp - 7 * day_seconds > backup[TIMESTAMP] >= now_timestamp - 31 * day_seconds:
-      weekly_backups.append(backup)
-    elif now_timestamp - 31 * day_seconds > backup[TIMESTAMP] >= now_timestamp - 365 * day_seconds:
-      monthly_backups.append(backup)
-    elif now_timestamp - 365 * day_seconds > backup[TIMESTAMP]:
-      yearly_backups.append(backup)
-  return daily_backups, weekly_backups, monthly_backups, yearly_backups
+    if backup.size is None:
+      # Catalogs written by older versions have no sizes
+      backup.size = os.stat(backup.path).st_size
+  preserved_names = {backup.filename for backup in preserved}
+  kept_bytes = sum(backup.size for backup in preserved)
+  freed_bytes = sum(backup.size for backup in backups if backup.filename not in preserved_names)
+  max_kept_bytes = None if args.max_total_size_mb is None else args.max_total_size_mb * 1024 * 1024
+  free_bytes = None
+  if args.min_free_space_mb is not None:
+    statvfs = os.statvfs(os.path.abspath(args.backup_dest_dir))
+    free_bytes = statvfs.f_bavail * statvfs.f_frsize
+
+  def over_budget():
+    if max_kept_bytes is not None and kept_bytes > max_kept_bytes:
+      return True
+    return free_bytes is not None and free_bytes + freed_bytes < args.min_free_space_mb * 1024 * 1024
+
+  now_timestamp = datetime.now().timestamp()
+  bounds = _period_bounds(now_timestamp, backups[0].timestamp)
+  periods = [preserved[low:high] for low, high in _split_backups(preserved, now_timestamp)]
+  newest = preserved[-1]
+  while over_budget():
+    victim = None
+    for period_index, period_backups in enumerate(periods):
+      if len(period_backups) <= args.min_count_per_period:
+        continue
+      for backup in period_backups:
+        if backup is not newest and (victim is None or backup.overall_rating < victim[1].overall_rating):
+          victim = period_index, backup
+    if victim is None:
+      sys.stderr.write("Warning: backups %s__*%s at %s do not fit into the size budget even after keeping only "
+                       "the minimal number of backups\n" % (args.prefix, args.extension, args.backup_dest_dir))
+      break
+    period_index, backup = victim
+    periods[period_index].remove(backup)
+    kept_bytes -= backup.size
+    freed_bytes += backup.size
+    # Neighbours of the dropped backup now cover a larger part of the period
+    start, end = bounds[period_index]
+    _rate_coverage(periods[period_index], start, end)
+  # Periods go from the most recent one
+  return [backup for period_backups in reversed(periods) for backup in period_backups]
+
+
+def _period_bounds(now_timestamp, oldest_timestamp):
+  """
+  :return: (start, end) timestamps of daily, weekly, monthly and yearly periods
+  """
+  daily_start = now_timestamp - DAILY_PERIOD_DAYS * DAY_SECONDS
+  weekly_start = now_timestamp - WEEKLY_PERIOD_DAYS * DAY_SECONDS
+  monthly_start = now_timestamp - MONTHLY_PERIOD_DAYS * DAY_SECONDS
+  return ((daily_start, now_timestamp),
+          (weekly_start, daily_start),
+          (monthly_start, weekly_start),
+          (min(oldest_timestamp, monthly_start), monthly_start))
+
+
+def _split_backups(backups, now_timestamp=None, timestamps=None):
+  """
+  Splits backups into periods without copying them.
+  :param backups: list of backups sorted ascending by timestamps
+  :param now_timestamp: current time
+  :param timestamps: timestamps of backups, if already extracted
+  :return: index ranges (low, high) of daily, weekly, monthly and yearly backups
+  """
+  if now_timestamp is None:
+    now_timestamp = datetime.now().timestamp()
+  if timestamps is None:
+    timestamps = [backup.timestamp for backup in backups]
+  (daily_start, _), (weekly_start, _), (monthly_start, _), _ = _period_bounds(now_timestamp, now_timestamp)
+  daily_low = bisect.bisect_left(timestamps, daily_start)
+  weekly_low = bisect.bisect_left(timestamps, weekly_start, 0, daily_low)
+  monthly_low = bisect.bisect_left(timestamps, monthly_start, 0, weekly_low)
+  return (daily_low, len(timestamps)), (weekly_low, daily_low), (monthly_low, weekly_low), (0, monthly_low)
 
 
 def remove_unsuccessful(args):
@@ -242,17 +1076,1247 @@ def remove_unsuccessful(args):
     msg = "Target file is at directory %s, and backup destination dir is %s. Probably you " \
           "specified a wrong path." % (target_dir, backups_dir)
     return msg, 1
-  # If all checks passed, remove the file
+  # If all checks passed, remove the file along with its checksums
   os.remove(args.remove_file)
+  sidecar_path = args.remove_file + CHECKSUM_SIDECAR_SUFFIX
+  if os.path.isfile(sidecar_path):
+    os.remove(sidecar_path)
+  if args.catalog_file:
+    _update_catalog(args, [filename, filename + CHECKSUM_SIDECAR_SUFFIX])
+  if args.dedup_store:
+    # Garbage collection keeps chunks of manifests that are missing, unless it is told they were removed
+    store = _DedupStore(args.dedup_store)
+    try:
+      store.forget_roots([args.remove_file])
+    finally:
+      store.close()
   return "Removed %s" % args.remove_file, 0
 
 
+def run_backup(args):
+  """
+  Archives --source-dir into a new backup file, then auto-cleans old backups. If archiving fails, the new backup
+  file is removed.
+  :return: tuple (stdout_str, exit_code)
+  """
+  if not os.path.isdir(args.source_dir):
+    return "Path %s is not a directory" % args.source_dir, 1
+
+  change_index = None
+  name_args = args
+  if args.change_index_file:
+    change_index = _read_change_index(args)
+    if change_index:
+      # Incremental backups are told apart by a marker, so that auto-clean knows about their dependencies
+      name_args = argparse.Namespace(**vars(args))
+      name_args.extension = INCREMENTAL_MARKER + args.extension
+  backup_file, exit_code = generate_name(name_args)
+  if exit_code:
+    return "Can not create a backup file", exit_code
+
+  started = time.monotonic()
+  try:
+    if args.change_index_file:
+      source_bytes, backup_bytes = _write_archive(
+        args, backup_file, lambda tar: _archive_changes(args, tar, backup_file, change_index))
+    else:
+      source_bytes, backup_bytes = _write_archive(args, backup_file, lambda tar: _archive_tree(args, tar))
+  except Exception:
+    traceback.print_exc()
+    cleanup_args = argparse.Namespace(**vars(args))
+    cleanup_args.remove_file = backup_file
+    stdout, _ = remove_unsuccessful(cleanup_args)
+    return "Failed to archive %s\n%s" % (args.source_dir, stdout), 1
+  seconds = time.monotonic() - started
+
+  stdout = ["Created %s backup %s: archived %s into %s in %.1f s (%s/s)" % (
+    "incremental" if change_index else "full", backup_file, _format_size(source_bytes), _format_size(backup_bytes),
+    seconds, _format_size(source_bytes / max(seconds, 0.001)))]
+  clean_stdout, exit_code = auto_clean(args)
+  if clean_stdout:
+    stdout.append(clean_stdout)
+  return "\n".join(stdout), exit_code
+
+
+def _write_archive(args, backup_file, fill):
+  """
+  Writes a compressed tar archive. The archive is produced by this process, and compressed by a pool of worker
+  processes.
+  :param fill: function that takes a tarfile.TarFile and adds members to it
+  :return: tuple (size of the uncompressed archive, size of the backup file)
+  """
+  fd = os.open(backup_file, os.O_WRONLY | os.O_CREAT | os.O_EXCL, 0o640)
+  output = _ChecksumOutput(fd, args.checksum_block_mb * 1024 * 1024)
+  store = None
+  try:
+    with concurrent.futures.ProcessPoolExecutor(max_workers=args.compress_workers) as executor:
+      if args.dedup_store:
+        store = _DedupStore(args.dedup_store)
+        store.add_root(backup_file)
+        writer = _DedupWriter(output, executor, args.compress_workers, store, args.compress_level,
+                              args.dedup_chunk_kb * 1024)
+      else:
+        writer = _ParallelGzipWriter(output, executor, args.compress_workers, args.compress_level,
+                                     args.compress_chunk_mb * 1024 * 1024, args.write_buffer_mb * 1024 * 1024)
+      with tarfile.open(fileobj=writer, mode="w|", format=tarfile.PAX_FORMAT,
+                        bufsize=args.compress_chunk_mb * 1024 * 1024) as tar:
+        fill(tar)
+      writer.close()
+    # Older backups are removed next, so make sure the new one survives a crash
+    os.fsync(fd)
+    _write_checksum_sidecar(backup_file, output)
+    return writer.bytes_in, writer.bytes_out
+  finally:
+    os.close(fd)
+    if store:
+      store.close()
+
+
+class _ChecksumOutput(object):
+  """
+  Writes data to a file descriptor, and hashes it with SHA-256 on the way: as a whole, and in blocks of the given
+  size. The backup file is verified without reading it twice.
+  """
+
+  def __init__(self, fd, block_size):
+    self._fd = fd
+    self._block_size = block_size
+    self._file_hash = hashlib.sha256()
+    self._block_hash = hashlib.sha256()
+    self._block_remaining = block_size
+    self.block_hashes = []
+    self.size = 0
+
+  def write(self, data):
+    _write_fully(self._fd, data)
+    self._file_hash.update(data)
+    self.size += len(data)
+    with memoryview(data) as view:
+      offset = 0
+      while offset < len(view):
+        part = view[offset:offset + self._block_remaining]
+        self._block_hash.update(part)
+        offset += len(part)
+        self._block_remaining -= len(part)
+        if not self._block_remaining:
+          self._finish_block()
+
+  def checksums(self):
+    """
+    :return: a dict that is stored at a checksum sidecar
+    """
+    if self._block_remaining < self._block_size:
+      self._finish_block()
+    return {"version": CHECKSUM_SIDECAR_VERSION, "size": self.size, "sha256": self._file_hash.hexdigest(),
+            "block_size": self._block_size, "block_sha256": self.block_hashes}
+
+  def _finish_block(self):
+    self.block_hashes.append(self._block_hash.hexdigest())
+    self._block_hash = hashlib.sha256()
+    self._block_remaining = self._block_size
+
+
+def _write_checksum_sidecar(backup_file, output):
+  """
+  Atomically writes checksums gathered by a _ChecksumOutput next to the backup file
+  """
+  checksums = output.checksums()
+  checksums["file"] = os.path.basename(backup_file)
+  sidecar_path = backup_file + CHECKSUM_SIDECAR_SUFFIX
+  tmp_path = sidecar_path + ".tmp"
+  with open(tmp_path, "w") as sidecar:
+    json.dump(checksums, sidecar, sort_keys=True)
+    sidecar.flush()
+    os.fsync(sidecar.fileno())
+  os.replace(tmp_path, sidecar_path)
+
+
+class _ParallelGzipWriter(object):
+  """
+  A write-only file object that compresses data at a process pool. Data is cut into chunks, every chunk is
+  compressed into a separate gzip member, and members are written in order. The result is a regular multi-member
+  gzip file (like the one produced by pigz --independent) that gzip, pigz and Python's gzip module can read.
+  Compressed data is written in whole multiples of the write buffer size, except for the tail.
+  """
+
+  def __init__(self, output, executor, workers, level, chunk_size, write_buffer_size):
+    self._file = output
+    self._executor = executor
+    self._level = level
+    self._chunk_size = chunk_size
+    self._write_buffer_size = write_buffer_size
+    # Enough chunks in flight to keep all workers busy while the oldest one is being waited for
+    self._max_pending = 2 * workers
+    self._pending = collections.deque()
+    self._chunk = bytearray()
+    self._output = bytearray()
+    self.bytes_in = 0
+    self.bytes_out = 0
+
+  def write(self, data):
+    self._chunk += data
+    self.bytes_in += len(data)
+    if len(self._chunk) >= self._chunk_size:
+      self._submit_chunk()
+    return len(data)
+
+  def close(self):
+    if self._chunk:
+      self._submit_chunk()
+    while self._pending:
+      self._collect_member()
+    self._file.write(self._output)
+    self._output = bytearray()
+
+  def _submit_chunk(self):
+    self._pending.append(self._executor.submit(_compress_chunk, bytes(self._chunk), self._level))
+    self._chunk = bytearray()
+    while len(self._pending) > self._max_pending:
+      self._collect_member()
+
+  def _collect_member(self):
+    member = self._pending.popleft().result()
+    self.bytes_out += len(member)
+    self._output += member
+    aligned_size = len(self._output) - len(self._output) % self._write_buffer_size
+    if aligned_size:
+      self._file.write(memoryview(self._output)[:aligned_size])
+      # Only the tail is copied
+      self._output = self._output[aligned_size:]
+
+
+def _archive_tree(args, tar):
+  """
+  Archives all entries of --source-dir
+  """
+  source_dir = os.path.abspath(args.source_dir)
+  for relpath, _ in _walk_tree(source_dir, args.walk_workers):
+    tar.add(os.path.join(source_dir, relpath) if relpath else source_dir, recursive=False)
+
+
+def _archive_changes(args, tar, backup_file, change_index):
+  """
+  Archives entries of --source-dir that are new or changed since the backup recorded at the change index, plus
+  the DELETED_PATHS_MEMBER listing archive members that were deleted since then. Without a change index, all
+  entries are archived. Then the index is replaced with the one describing the new backup. If archiving fails
+  after that, the backup file is removed, and the next backup is a full one, since the index refers to a missing
+  file.
+  :param change_index: the change index returned by _read_change_index(), or None for a full backup
+  """
+  source_dir = os.path.abspath(args.source_dir)
+  old_entries = change_index["entries"] if change_index else {}
+  entries = {}
+  for relpath, stat in _walk_tree(source_dir, args.walk_workers):
+    # Snapshots of the same filesystem keep inode numbers and change times, so they can be compared
+    entry = (stat.st_ino, stat.st_size, stat.st_mtime_ns, stat.st_ctime_ns)
+    entries[relpath] = entry
+    if old_entries.get(relpath) != entry:
+      tar.add(os.path.join(source_dir, relpath) if relpath else source_dir, recursive=False)
+
+  if change_index:
+    # Names are the same as tar gives to members
+    deleted_relpaths = old_entries.keys() - entries.keys()
+    deleted = sorted(os.path.join(source_dir, relpath).lstrip("/") for relpath in deleted_relpaths)
+    content = os.fsencode("".join(name + "\0" for name in deleted))
+    info = tarfile.TarInfo(DELETED_PATHS_MEMBER)
+    info.size = len(content)
+    info.mtime = time.time()
+    tar.addfile(info, io.BytesIO(content))
+
+  header = {"version": CHANGE_INDEX_VERSION, "prefix": args.prefix, "extension": args.extension,
+            "backup": os.path.basename(backup_file),
+            "chain_length": change_index["header"]["chain_length"] + 1 if change_index else 0}
+  _write_change_index(args, header, entries)
+
+
+def _walk_tree(root, workers, window=WALK_ORDER_WINDOW):
+  """
+  Walks a directory tree at a pool of threads without following symlinks, see _TreeWalker. Records are yielded
+  as they come, in batches of up to window records sorted by inode numbers: on filesystems that place inodes near
+  their data (like ext4), reading files in this order is mostly sequential. Entries are stat'ed by the walker,
+  so later stat calls of consumers (e.g. tarfile) are served from the inode cache.
+  :return: generator of tuples (path relative to root, lstat result), including root itself with an empty
+  relative path
+  """
+  walker = _TreeWalker(root, workers)
+  try:
+    batch = [("", os.lstat(root))]
+    for records in walker:
+      batch.extend(records)
+      if len(batch) >= window:
+        batch.sort(key=lambda record: record[1].st_ino)
+        yield from batch
+        batch = []
+    batch.sort(key=lambda record: record[1].st_ino)
+    yield from batch
+  finally:
+    walker.stop()
+
+
+class _TreeWalker(object):
+  """
+  Lists directories of a tree at a pool of threads. Every thread takes directories from the top of its own stack,
+  which keeps related directories together, and steals from the bottom of other stacks (where the largest
+  subtrees are, most likely) when it runs out of work. Iterating the walker gives lists of records of listed
+  directories, see _walk_tree(). Listings are queued, so slow consumers hold walking back.
+  """
+
+  def __init__(self, root, workers):
+    self._root = root
+    self._stacks = [collections.deque() for _ in range(workers)]
+    self._stacks[0].append("")
+    self._lock = threading.Lock()
+    self._work_available = threading.Condition(self._lock)
+    # Directories that are queued or being listed
+    self._pending = 1
+    self._stopped = False
+    self._results = queue.Queue(maxsize=WALK_QUEUE_SIZE)
+    self._threads = [threading.Thread(target=self._work, args=(index,), daemon=True) for index in range(workers)]
+    for thread in self._threads:
+      thread.start()
+
+  def __iter__(self):
+    while True:
+      item = self._results.get()
+      if item is None:
+        return
+      if isinstance(item, BaseException):
+        raise item
+      yield item
+
+  def stop(self):
+    with self._lock:
+      self._stopped = True
+      self._work_available.notify_all()
+    for thread in self._threads:
+      thread.join()
+
+  def _work(self, index):
+    try:
+      while True:
+        reldir = self._take(index)
+        if reldir is None:
+          return
+        records = []
+        subdirs = []
+        with os.scandir(os.path.join(self._root, reldir)) as dir_entries:
+          for dir_entry in dir_entries:
+            relpath = os.path.join(reldir, dir_entry.name)
+            records.append((relpath, dir_entry.stat(follow_symlinks=False)))
+            if dir_entry.is_dir(follow_symlinks=False):
+              subdirs.append(relpath)
+        # Records go first, so that all of them are queued once nothing is pending
+        self._put(records)
+        with self._lock:
+          self._stacks[index].extend(subdirs)
+          self._pending += len(subdirs) - 1
+          finished = self._pending == 0
+          self._work_available.notify_all()
+        if finished:
+          self._put(None)
+    except BaseException as e:
+      self._put(e)
+      with self._lock:
+        self._stopped = True
+        self._work_available.notify_all()
+
+  def _take(self, index):
+    with self._lock:
+      while not self._stopped and self._pending:
+        if self._stacks[index]:
+          return self._stacks[index].pop()
+        for stack in self._stacks:
+          if stack:
+            return stack.popleft()
+        self._work_available.wait()
+      return None
+
+  def _put(self, item):
+    while not self._stopped:
+      try:
+        self._results.put(item, timeout=0.1)
+        return
+      except queue.Full:
+        pass
+
+
+def _compress_chunk(chunk, level):
+  return gzip.compress(chunk, level)
+
+
+def _write_fully(fd, data):
+  view = memoryview(data)
+  written = 0
+  while written < len(view):
+    written += os.write(fd, view[written:])
+
+
+# region Policy
+
+def _load_policy(args):
+  """
+  Reads a policy file. It's a JSON document listing backup sets, e.g.
+    {"backup_sets": [
+      {"backup_dest_dir": "/media/backups", "prefix": "system_dump", "extension": "tar.gz"},
+      {"backup_dest_dir": "/media/backups", "prefix": "db_dump", "extension": "sql.gz", "daily_backups_max_count": 7}
+    ]}
+  Keys of a backup set are names of command line options with dashes replaced by underscores (see POLICY_SET_KEYS).
+  Options that are omitted for a backup set are taken from the command line.
+  :param args: application args
+  :return: a list of args, one per backup set
+  """
+  with open(args.policy_file) as policy_file:
+    policy = json.load(policy_file)
+
+  backup_sets = []
+  for index, backup_set in enumerate(policy.get("backup_sets", [])):
+    unknown_keys = set(backup_set) - set(POLICY_SET_KEYS)
+    if unknown_keys:
+      raise ValueError("Backup set #%s at policy file %s has unknown keys: %s"
+                       % (index, args.policy_file, ", ".join(sorted(unknown_keys))))
+    set_args = argparse.Namespace(**vars(args))
+    for key, value in backup_set.items():
+      setattr(set_args, key, value)
+    for key in ("backup_dest_dir", "prefix", "extension"):
+      if not getattr(set_args, key):
+        raise ValueError("Backup set #%s at policy file %s does not specify %s" % (index, args.policy_file, key))
+    set_args.extension = _normalize_extension(set_args.extension)
+    set_args.policy_file = None
+    backup_sets.append(set_args)
+  if not backup_sets:
+    raise ValueError("Policy file %s does not list any backup sets" % args.policy_file)
+  return backup_sets
+
+
+def _group_backup_sets_by_dir(backup_sets):
+  """
+  :return: a list of lists of backup sets sharing a directory, in the order of first appearance
+  """
+  groups = collections.OrderedDict()
+  for set_args in backup_sets:
+    groups.setdefault(os.path.abspath(set_args.backup_dest_dir), []).append(set_args)
+  for backup_dir, dir_sets in groups.items():
+    if len({(set_args.prefix, set_args.extension) for set_args in dir_sets}) != len(dir_sets):
+      raise ValueError("Policy lists the same prefix and extension twice for directory %s" % backup_dir)
+    if len({set_args.catalog_file for set_args in dir_sets}) != 1:
+      raise ValueError("All backup sets at directory %s should use the same catalog file" % backup_dir)
+  return list(groups.values())
+
+
+def _backup_set_title(set_args):
+  return "Backup set %s__*%s at %s:" % (set_args.prefix, set_args.extension, set_args.backup_dest_dir)
+
+# endregion
+
+
+# region Catalog
+
+# The catalog is a JSON-lines file. Records are only ever appended, and the state is rebuilt by replaying them:
+#   {"op": "header", "version": 2, "dir": "/abs/backup/dir"}
+#   {"op": "snapshot", "files": {"...": 123}, "others": ["..."], "mtime_ns": 123}  the whole state, as written by
+#                                    compaction. It is parsed at once, so loading costs little per live entry
+#   {"op": "add", "name": "...", "size": 123}  a regular file of this size appeared at the directory
+#   {"op": "skip", "name": "..."}    an entry that is not a regular file (it's remembered to avoid stat'ing it again)
+#   {"op": "remove", "name": "..."}  an entry disappeared from the directory
+#   {"op": "sync", "mtime_ns": 123}  the records above describe the directory with this modification time
+
+def _sync_catalog(args):
+  """
+  Brings the catalog in line with the contents of the backup directory. The directory is listed only if its
+  modification time differs from the one recorded in the catalog, and only types of entries that are new to the
+  catalog are examined.
+  :param args: application args
+  :return: a dict {name -> size in bytes} of regular files at the backup directory. Sizes are recorded when files
+  are added to the catalog, so they are stale for files that were still being written at that moment
+  """
+  backup_dir = os.path.abspath(args.backup_dest_dir)
+  catalog = _open_locked_catalog(args.catalog_file)
+  try:
+    state = _read_catalog(catalog, backup_dir)
+    # Remember mtime before listing, so that changes made while listing trigger a rescan next time
+    dir_mtime_ns = os.stat(backup_dir).st_mtime_ns
+    if dir_mtime_ns == state["mtime_ns"]:
+      return state["files"]
+
+    records = []
+    known_names = state["files"].keys() | state["others"]
+    seen_names = set()
+    with os.scandir(backup_dir) as dir_entries:
+      for dir_entry in dir_entries:
+        if dir_entry.name in known_names:
+          seen_names.add(dir_entry.name)
+        else:
+          if dir_entry.is_file():
+            records.append({"op": "add", "name": dir_entry.name, "size": dir_entry.stat().st_size})
+          else:
+            records.append({"op": "skip", "name": dir_entry.name})
+    for name in known_names - seen_names:
+      records.append({"op": "remove", "name": name})
+    records.append({"op": "sync", "mtime_ns": dir_mtime_ns})
+    _append_catalog_records(catalog, state, records)
+    return state["files"]
+  finally:
+    catalog.close()
+
+
+def _update_catalog(args, removed_names, dir_mtime_ns=None):
+  """
+  Records files removed by this script.
+  :param args: application args
+  :param removed_names: names of removed files
+  :param dir_mtime_ns: modification time of the backup directory right before the files were removed. If the
+  catalog was in sync with the directory at that moment, it is marked as being in sync after removal as well
+  """
+  backup_dir = os.path.abspath(args.backup_dest_dir)
+  catalog = _open_locked_catalog(args.catalog_file)
+  try:
+    state = _read_catalog(catalog, backup_dir)
+    records = [{"op": "remove", "name": name} for name in removed_names
+               if name in state["files"] or name in state["others"]]
+    if dir_mtime_ns is not None and dir_mtime_ns == state["mtime_ns"]:
+      # A file created by someone else between our removals and this stat would be missed until the next
+      # change of the directory. That is harmless: such file is just not considered for removal for a while
+      records.append({"op": "sync", "mtime_ns": os.stat(backup_dir).st_mtime_ns})
+    if records:
+      _append_catalog_records(catalog, state, records)
+  finally:
+    catalog.close()
+
+
+def _open_locked_catalog(catalog_path):
+  """
+  Opens the catalog file for appending and takes an exclusive lock on it. Retries if the catalog has been
+  compacted (replaced with a new file) by another process while we were waiting for the lock.
+  """
+  while True:
+    catalog = open(catalog_path, 'a+')
+    fcntl.flock(catalog, fcntl.LOCK_EX)
+    try:
+      if os.fstat(catalog.fileno()).st_ino == os.stat(catalog_path).st_ino:
+        return catalog
+    except FileNotFoundError:
+      pass
+    catalog.close()
+
+
+def _read_catalog(catalog, backup_dir):
+  """
+  Replays catalog records.
+  :return: a dict with the "files" dict {name -> size}, the "others" set of entry names, the "mtime_ns" of the
+  directory the catalog is in sync with (None if unknown), the total count of "records" in the catalog file, and
+  the count of "tail" records after the latest snapshot
+  """
+  state = {"dir": backup_dir, "files": {}, "others": set(), "mtime_ns": None, "records": 0, "tail": 0,
+           "torn": False}
+  catalog.seek(0)
+  for line in catalog:
+    try:
+      record = json.loads(line)
+    except ValueError:
+      # A torn write of a process that was killed while appending. Records after it would be lost on replay,
+      # so the catalog gets rewritten on the next append
+      state["mtime_ns"] = None
+      state["torn"] = True
+      break
+    if record["op"] == "header" and record["dir"] != backup_dir:
+      raise ValueError("Catalog file %s belongs to directory %s, not to %s"
+                       % (catalog.name, record["dir"], backup_dir))
+    if record["op"] == "header" and record["version"] > CATALOG_VERSION:
+      raise ValueError("Unsupported version %s of catalog file %s" % (record["version"], catalog.name))
+    _apply_catalog_record(state, record)
+  if state["records"] == 0:
+    _append_catalog_records(catalog, state, [{"op": "header", "version": CATALOG_VERSION, "dir": backup_dir}])
+  return state
+
+
+def _apply_catalog_record(state, record):
+  op = record["op"]
+  state["records"] += 1
+  if op == "header":
+    return
+  if op == "snapshot":
+    state["files"] = record["files"]
+    state["others"] = set(record["others"])
+    state["mtime_ns"] = record["mtime_ns"]
+    state["tail"] = 0
+    return
+  state["tail"] += 1
+  if op == "add":
+    state["files"][record["name"]] = record.get("size")
+  elif op == "skip":
+    state["others"].add(record["name"])
+  elif op == "remove":
+    state["files"].pop(record["name"], None)
+    state["others"].discard(record["name"])
+  elif op == "sync":
+    state["mtime_ns"] = record["mtime_ns"]
+
+
+def _append_catalog_records(catalog, state, records):
+  """
+  Applies records to the state and appends them to the catalog, or rewrites the catalog into a snapshot if too
+  many records were appended since the latest one
+  """
+  for record in records:
+    _apply_catalog_record(state, record)
+
+  live_entries = len(state["files"]) + len(state["others"])
+  if not state["torn"] and state["tail"] <= CATALOG_MIN_TAIL_RECORDS + CATALOG_TAIL_RATIO * live_entries:
+    catalog.write("".join(json.dumps(record) + "\n" for record in records))
+    catalog.flush()
+    return
+
+  compacted = [{"op": "header", "version": CATALOG_VERSION, "dir": state["dir"]},
+               {"op": "snapshot", "files": state["files"], "others": sorted(state["others"]),
+                "mtime_ns": state["mtime_ns"]}]
+  tmp_path = catalog.name + ".tmp"
+  with open(tmp_path, 'w') as tmp_catalog:
+    tmp_catalog.write("".join(json.dumps(record) + "\n" for record in compacted))
+    tmp_catalog.flush()
+    os.fsync(tmp_catalog.fileno())
+  # Processes waiting for a lock on the old file notice the replacement, see _open_locked_catalog()
+  os.replace(tmp_path, catalog.name)
+  state["records"] = len(compacted)
+  state["tail"] = 0
+  state["torn"] = False
+
+# endregion
+
+
+# region Change index
+# The change index describes entries of --source-dir archived by the latest backup. It's a gzipped file with
+# a JSON header line:
+#   {"version": 1, "prefix": "...", "extension": "...", "backup": "<filename>", "chain_length": 0}
+# followed by NUL-terminated fields, five per entry: relative path, inode, size, mtime_ns and ctime_ns.
+
+def _read_change_index(args):
+  """
+  :param args: application args
+  :return: a dict with the "header" dict and the "entries" dict {relative path -> (inode, size, mtime_ns,
+  ctime_ns)}, or None if the next backup should be a full one: there's no index, the backup it describes is gone,
+  or the chain already has --max-incremental-chain incremental backups
+  """
+  try:
+    with gzip.open(args.change_index_file, "rb") as index:
+      header = json.loads(index.readline().decode())
+      fields = index.read().split(b"\0")
+  except FileNotFoundError:
+    return None
+  if header["version"] != CHANGE_INDEX_VERSION:
+    raise ValueError("Unsupported version %s of change index %s" % (header["version"], args.change_index_file))
+  if (header["prefix"], header["extension"]) != (args.prefix, args.extension):
+    raise ValueError("Change index %s belongs to backups %s__*%s" % (args.change_index_file, header["prefix"],
+                                                                     header["extension"]))
+  if header["chain_length"] >= args.max_incremental_chain or \
+      not os.path.isfile(os.path.join(args.backup_dest_dir, header["backup"])):
+    return None
+
+  entries = {}
+  # The last field is followed by a NUL as well
+  for i in range(0, len(fields) - 1, 5):
+    entries[os.fsdecode(fields[i])] = tuple(int(field) for field in fields[i + 1:i + 5])
+  return {"header": header, "entries": entries}
+
+
+def _write_change_index(args, header, entries):
+  """
+  Atomically replaces the change index.
+  """
+  tmp_path = "%s.tmp" % args.change_index_file
+  with gzip.open(tmp_path, "wb", compresslevel=1) as index:
+    index.write(json.dumps(header, sort_keys=True).encode() + b"\n")
+    for relpath, entry in entries.items():
+      index.write(b"%s\0%d\0%d\0%d\0%d\0" % ((os.fsencode(relpath),) + entry))
+  os.replace(tmp_path, args.change_index_file)
+
+# endregion
+
+
+# region Verification
+# The verify state file is a JSON object {backup path -> record}. A record has the "size" and "mtime_ns" of the
+# backup file, the "status" ("ok", "corrupt", "unverifiable", "error" or "partial"), the "offset" up to which the file
+# is verified, the "verified_at" timestamp of the last completed verification, and an "error" message. Only I/O
+# errors of the disk and mismatches with checksums make a backup "corrupt", other errors may be transient.
+
+def verify(args):
+  """
+  Verifies backups against their checksum sidecars under the rate and IOPS budget, until all backups are
+  verified or --verify-max-seconds pass. Backups at different devices are verified in parallel.
+  :return: tuple (report, exit_code)
+  """
+  backup_sets = _load_policy(args) if args.policy_file else [args]
+  state = _read_verify_state(args.verify_state_file) if args.verify_state_file else {}
+  stdout = []
+  exit_code = 0
+  backups_by_device = collections.OrderedDict()
+  for set_args in backup_sets:
+    if not os.path.isdir(set_args.backup_dest_dir):
+      stdout.append("Path %s is not a directory" % set_args.backup_dest_dir)
+      exit_code = 1
+      continue
+    device = os.stat(set_args.backup_dest_dir).st_dev
+    backups_by_device.setdefault(device, []).extend(_list_backup_files(set_args))
+
+  # Never verified backups go first, then the ones verified least recently
+  for backups in backups_by_device.values():
+    backups.sort(key=lambda backup: (state.get(backup.path) or {}).get("verified_at") or 0)
+  deadline = time.monotonic() + args.verify_max_seconds if args.verify_max_seconds else None
+  rate_throttle = _Throttle(args.verify_rate_mb * 1024 * 1024) if args.verify_rate_mb else None
+  iops_throttle = _Throttle(args.verify_iops) if args.verify_iops else None
+  lock = threading.Lock()
+
+  def checkpoint(backup, record):
+    with lock:
+      state[backup.path] = record
+      if args.verify_state_file:
+        _write_verify_state(args.verify_state_file, state)
+
+  def verify_device(backups):
+    return [(backup, _verify_backup(backup, state.get(backup.path), rate_throttle, iops_throttle, deadline,
+                                    lambda record, backup=backup: checkpoint(backup, record)))
+            for backup in backups]
+
+  counts = collections.Counter()
+  with concurrent.futures.ThreadPoolExecutor(max_workers=max(len(backups_by_device), 1)) as executor:
+    for results in executor.map(verify_device, backups_by_device.values()):
+      for backup, record in results:
+        if record is None:
+          stdout.append("Backup %s is gone, skipping it" % backup.path)
+          continue
+        counts[record["status"]] += 1
+        if record["status"] == "ok":
+          stdout.append("Verified backup %s" % backup.path)
+        elif record["status"] == "corrupt":
+          stdout.append("Backup %s is corrupt: %s" % (backup.path, record["error"]))
+          exit_code = 1
+        elif record["status"] == "unverifiable":
+          stdout.append("Can not verify backup %s: %s" % (backup.path, record["error"]))
+        elif record["status"] == "error":
+          stdout.append("Failed to verify backup %s: %s" % (backup.path, record["error"]))
+          exit_code = 1
+        else:
+          stdout.append("Verification of backup %s stopped at %s of %s" % (
+            backup.path, _format_size(record["offset"]), _format_size(record["size"])))
+
+  if args.verify_state_file:
+    # Forget backups that are gone
+    listed_paths = {backup.path for backups in backups_by_device.values() for backup in backups
+                    if os.path.exists(backup.path)}
+    with lock:
+      for path in list(state):
+        if path not in listed_paths:
+          del state[path]
+      _write_verify_state(args.verify_state_file, state)
+  stdout.append("Verified %s backups, %s corrupt, %s unverifiable, %s failed, %s not finished." % (
+    counts["ok"], counts["corrupt"], counts["unverifiable"], counts["error"], counts["partial"]))
+  return "\n".join(stdout), exit_code
+
+
+def _verify_backup(backup, record, rate_throttle, iops_throttle, deadline, checkpoint):
+  """
+  Verifies a backup block by block, resuming from the offset of a partial verification of the same file.
+  :param record: the verify state record of the backup, or None
+  :param checkpoint: function that takes an updated record and saves it
+  :return: the updated record, or None if the backup is gone (e.g. removed by auto-clean)
+  """
+  try:
+    file_stat = os.stat(backup.path)
+  except FileNotFoundError:
+    return None
+  except OSError as e:
+    record = {"size": None, "mtime_ns": None, "offset": 0, "verified_at": None, "status": "error", "error": str(e)}
+    checkpoint(record)
+    return record
+  if not record or (record["size"], record["mtime_ns"]) != (file_stat.st_size, file_stat.st_mtime_ns):
+    record = {"size": file_stat.st_size, "mtime_ns": file_stat.st_mtime_ns, "offset": 0, "verified_at": None,
+              "status": "partial", "error": None}
+  else:
+    record = dict(record)
+    if record["status"] != "partial":
+      record.update(offset=0, status="partial", error=None)
+
+  try:
+    with open(backup.path + CHECKSUM_SIDECAR_SUFFIX) as sidecar:
+      checksums = json.load(sidecar)
+  except FileNotFoundError:
+    if not os.path.exists(backup.path):
+      return None
+    record.update(status="unverifiable", error="no checksum sidecar")
+    checkpoint(record)
+    return record
+  except OSError as e:
+    record.update(status="error", error=str(e))
+    checkpoint(record)
+    return record
+  if checksums["size"] != file_stat.st_size:
+    record.update(status="corrupt", error="size is %s instead of %s" % (file_stat.st_size, checksums["size"]))
+    checkpoint(record)
+    return record
+
+  block_size = checksums["block_size"]
+  # The whole-file hash can be checked only if the file is read in one go
+  file_hash = hashlib.sha256() if record["offset"] == 0 else None
+  buffer = bytearray(min(VERIFY_READ_SIZE, block_size))
+  last_checkpoint = time.monotonic()
+  try:
+    fd = os.open(backup.path, os.O_RDONLY)
+  except FileNotFoundError:
+    return None
+  except OSError as e:
+    record.update(status="error", error=str(e))
+    checkpoint(record)
+    return record
+  try:
+    os.posix_fadvise(fd, 0, 0, os.POSIX_FADV_SEQUENTIAL)
+    os.lseek(fd, record["offset"], os.SEEK_SET)
+    while record["offset"] < file_stat.st_size:
+      if deadline is not None and time.monotonic() >= deadline:
+        checkpoint(record)
+        return record
+      block_index = record["offset"] // block_size
+      block_hash = hashlib.sha256()
+      offset = record["offset"]
+      block_end = min(offset + block_size, file_stat.st_size)
+      while offset < block_end:
+        size = min(len(buffer), block_end - offset)
+        if rate_throttle:
+          rate_throttle.consume(size)
+        if iops_throttle:
+          iops_throttle.consume(1)
+        with memoryview(buffer) as view, view[:size] as part:
+          if os.readv(fd, [part]) != size:
+            # The file shrank since it was listed
+            raise OSError("Unexpected end of file %s" % backup.path)
+          block_hash.update(part)
+          if file_hash:
+            file_hash.update(part)
+        offset += size
+      # Scrubbing a multi-TB set should not evict everything else from the page cache
+      os.posix_fadvise(fd, record["offset"], block_end - record["offset"], os.POSIX_FADV_DONTNEED)
+      if block_hash.hexdigest() != checksums["block_sha256"][block_index]:
+        record.update(status="corrupt", error="block %s (bytes %s-%s) does not match its checksum" % (
+          block_index, record["offset"], block_end - 1))
+        checkpoint(record)
+        return record
+      record["offset"] = block_end
+      if time.monotonic() - last_checkpoint >= VERIFY_CHECKPOINT_SECONDS:
+        checkpoint(record)
+        last_checkpoint = time.monotonic()
+  except OSError as e:
+    # Only errors of the disk tell that the data is damaged
+    record.update(status="corrupt" if e.errno == errno.EIO else "error", error=str(e))
+    checkpoint(record)
+    return record
+  finally:
+    os.close(fd)
+
+  if file_hash and file_hash.hexdigest() != checksums["sha256"]:
+    record.update(status="corrupt", error="file does not match its checksum")
+  else:
+    record.update(status="ok", verified_at=time.time())
+  checkpoint(record)
+  return record
+
+
+def _read_verify_state(path):
+  try:
+    with open(path) as state_file:
+      return json.load(state_file)
+  except FileNotFoundError:
+    return {}
+
+
+def _write_verify_state(path, state):
+  tmp_path = "%s.tmp" % path
+  with open(tmp_path, "w") as state_file:
+    json.dump(state, state_file, sort_keys=True)
+  os.replace(tmp_path, path)
+
+# endregion
+
+
+# region Dedup store
+# A dedup store is a directory shared by any number of backups:
+#   packs/<number>.pack  zlib-compressed chunks, one after another
+#   index                DEDUP_INDEX_RECORD records of chunks at packs
+#   roots                absolute paths of manifests that refer to the store, one per line
+#   lock                 flock'ed exclusively by writers and garbage collection, and shared by readers
+# A manifest is a backup file that has a JSON header line
+#   {"version": 1, "store": "<store directory>", "chunks": <count>, "size": <archive size>}
+# followed by sha256 digests of the chunks of the archive.
+
+def cat_backup(args):
+  """
+  Writes the archive of a backup stored at a dedup store to stdout.
+  :return: tuple (None, exit_code), since stdout is taken by the archive
+  """
+  header, digests = _read_dedup_manifest(args.backup_file)
+  store = _DedupStore(args.dedup_store or header["store"], shared=True)
+  try:
+    output = sys.stdout.buffer
+    for digest in digests:
+      output.write(store.read_chunk(digest))
+    output.flush()
+  finally:
+    store.close()
+  return None, 0
+
+
+def _read_dedup_manifest(path):
+  """
+  :return: tuple (header dict, list of chunk digests)
+  """
+  with open(path, "rb") as manifest:
+    header = json.loads(manifest.readline().decode())
+    data = manifest.read()
+  if header.get("version") != DEDUP_MANIFEST_VERSION or len(data) != header["chunks"] * 32:
+    raise ValueError("File %s is not a complete manifest" % path)
+  return header, [data[i:i + 32] for i in range(0, len(data), 32)]
+
+
+def _collect_dedup_garbage(store_path, removed_manifests):
+  """
+  Removes chunks that are not referenced by manifests of the store anymore.
+  :param removed_manifests: paths of backups removed by this process. Other manifests that are missing may be at a
+  disk that is not mounted at the moment, so their chunks are kept
+  :return: report line
+  """
+  store = _DedupStore(store_path)
+  try:
+    removed_count, reclaimed_bytes, missing_roots = store.collect_garbage(removed_manifests)
+  finally:
+    store.close()
+  if missing_roots:
+    for path in missing_roots:
+      directory = os.path.dirname(path)
+      if not os.path.isdir(directory) or not os.access(directory, os.R_OK | os.X_OK):
+        sys.stderr.write("Warning: directory %s of manifest %s is missing or unreadable (e.g. its disk is not "
+                         "mounted)\n" % (directory, path))
+      else:
+        sys.stderr.write("Warning: manifest %s is missing, but it was not removed by auto-clean. If it was removed "
+                         "on purpose, remove its line from %s\n" % (path, os.path.join(store.path, "roots")))
+    return "Not collecting garbage at dedup store %s: %s manifests are missing or unreachable, their chunks are " \
+           "kept." % (store_path, len(missing_roots))
+  return "Removed %s unreferenced chunks from dedup store %s, reclaimed %s." % (removed_count, store_path,
+                                                                            _format_size(reclaimed_bytes))
+
+
+class _DedupStore(object):
+  """
+  A directory with chunks of backups. The store is locked from opening to close().
+  """
+
+  def __init__(self, path, shared=False):
+    self.path = os.path.abspath(path)
+    os.makedirs(os.path.join(self.path, "packs"), exist_ok=True)
+    self._lock = open(os.path.join(self.path, "lock"), "a")
+    fcntl.flock(self._lock, fcntl.LOCK_SH if shared else fcntl.LOCK_EX)
+    # {digest -> (pack number, offset, length)}
+    self._index = {}
+    with open(os.path.join(self.path, "index"), "ab+") as index:
+      index.seek(0)
+      data = index.read()
+    # A torn record may be left at the end by a crash
+    for offset in range(0, len(data) - len(data) % DEDUP_INDEX_RECORD.size, DEDUP_INDEX_RECORD.size):
+      digest, pack, pack_offset, length = DEDUP_INDEX_RECORD.unpack_from(data, offset)
+      self._index[digest] = (pack, pack_offset, length)
+    pack_numbers = self._pack_numbers()
+    self._next_pack = max(pack_numbers) + 1 if pack_numbers else 0
+    self._pack_fd = None
+    self._pack = None
+    self._pack_size = 0
+    self._new_records = []
+    self._read_fds = {}
+
+  def __contains__(self, digest):
+    return digest in self._index
+
+  def add_root(self, manifest_path):
+    """
+    Registers a manifest before its chunks are written, so that garbage collection never misses them
+    """
+    with open(os.path.join(self.path, "roots"), "a") as roots:
+      roots.write(os.path.abspath(manifest_path) + "\n")
+      roots.flush()
+      os.fsync(roots.fileno())
+
+  def add_chunk(self, digest, compressed):
+    """
+    Appends a compressed chunk to the current pack. The chunk is indexed by commit()
+    :return: number of bytes written
+    """
+    if self._pack_fd is None or self._pack_size + len(compressed) > DEDUP_PACK_SIZE:
+      self._finish_pack()
+      self._pack = self._next_pack
+      self._next_pack += 1
+      self._pack_fd = os.open(self._pack_path(self._pack), os.O_WRONLY | os.O_CREAT | os.O_EXCL, 0o640)
+      self._pack_size = 0
+    _write_fully(self._pack_fd, compressed)
+    self._index[digest] = (self._pack, self._pack_size, len(compressed))
+    self._new_records.append(DEDUP_INDEX_RECORD.pack(digest, self._pack, self._pack_size, len(compressed)))
+    self._pack_size += len(compressed)
+    return len(compressed)
+
+  def commit(self):
+    """
+    Indexes added chunks once they are durable
+    """
+    self._finish_pack()
+    if self._new_records:
+      with open(os.path.join(self.path, "index"), "ab") as index:
+        index.write(b"".join(self._new_records))
+        index.flush()
+        os.fsync(index.fileno())
+      self._new_records = []
+
+  def read_chunk(self, digest):
+    """
+    :return: uncompressed chunk
+    """
+    if digest not in self._index:
+      raise ValueError("Chunk %s is missing at dedup store %s" % (digest.hex(), self.path))
+    pack, offset, length = self._index[digest]
+    chunk = zlib.decompress(os.pread(self._read_fd(pack), length, offset))
+    if hashlib.sha256(chunk).digest() != digest:
+      raise ValueError("Chunk %s at dedup store %s is corrupted" % (digest.hex(), self.path))
+    return chunk
+
+  def forget_roots(self, manifest_paths):
+    """
+    Forgets manifests that are removed, so that garbage collection does not wait for them to come back
+    """
+    forgotten = {os.path.abspath(path) for path in manifest_paths}
+    self._rewrite_file("roots", "".join(path + "\n" for path in self._read_roots() if path not in forgotten).encode())
+
+  def collect_garbage(self, removed_manifests):
+    """
+    Forgets removed manifests, drops chunks that remaining manifests do not refer to, and rewrites packs that are
+    mostly garbage. Nothing is dropped while any other manifest is missing, since it can not be told from a
+    manifest at a disk that is not mounted
+    :param removed_manifests: paths of manifests that were removed, other paths are ignored
+    :return: tuple (number of removed chunks, reclaimed bytes, list of missing manifests)
+    """
+    removed_manifests = {os.path.abspath(path) for path in removed_manifests}
+    live_roots = []
+    missing_roots = []
+    for path in self._read_roots():
+      if os.path.isfile(path):
+        live_roots.append(path)
+      elif path not in removed_manifests:
+        missing_roots.append(path)
+    if missing_roots:
+      self._rewrite_file("roots", "".join(path + "\n" for path in sorted(live_roots + missing_roots)).encode())
+      return 0, 0, missing_roots
+    live_digests = set()
+    for manifest_path in live_roots:
+      # An unreadable manifest makes collection fail rather than lose chunks of a backup
+      live_digests.update(_read_dedup_manifest(manifest_path)[1])
+
+    removed_count = len(self._index.keys() - live_digests)
+    live_bytes = collections.Counter()
+    for digest in live_digests & self._index.keys():
+      pack, _, length = self._index[digest]
+      live_bytes[pack] += length
+    pack_sizes = {pack: os.stat(self._pack_path(pack)).st_size for pack in self._pack_numbers()}
+    dead_packs = [pack for pack, size in pack_sizes.items()
+                  if not live_bytes[pack] or live_bytes[pack] < size * DEDUP_PACK_LIVE_RATIO]
+
+    index = {digest: self._index[digest] for digest in live_digests & self._index.keys()}
+    self._index = index
+    dead_pack_set = set(dead_packs)
+    # Live chunks of dead packs move to new packs
+    for digest, (pack, offset, length) in sorted(index.items(), key=lambda item: item[1]):
+      if pack in dead_pack_set:
+        compressed = os.pread(self._read_fd(pack), length, offset)
+        self.add_chunk(digest, compressed)
+    self._finish_pack()
+    self._new_records = []
+    self._rewrite_file("index", b"".join(DEDUP_INDEX_RECORD.pack(digest, *location)
+                                         for digest, location in sorted(self._index.items())))
+    self._rewrite_file("roots", "".join(path + "\n" for path in live_roots).encode())
+    reclaimed_bytes = 0
+    for pack in dead_packs:
+      self._close_read_fd(pack)
+      os.remove(self._pack_path(pack))
+      reclaimed_bytes += pack_sizes[pack] - live_bytes[pack]
+    return removed_count, reclaimed_bytes, []
+
+  def close(self):
+    self._finish_pack()
+    for pack in list(self._read_fds):
+      self._close_read_fd(pack)
+    self._lock.close()
+
+  def _read_roots(self):
+    with open(os.path.join(self.path, "roots"), "a+") as roots:
+      roots.seek(0)
+      return sorted({line.rstrip("\n") for line in roots})
+
+  def _read_fd(self, pack):
+    if pack not in self._read_fds:
+      self._read_fds[pack] = os.open(self._pack_path(pack), os.O_RDONLY)
+    return self._read_fds[pack]
+
+  def _close_read_fd(self, pack):
+    if pack in self._read_fds:
+      os.close(self._read_fds.pop(pack))
+
+  def _finish_pack(self):
+    if self._pack_fd is not None:
+      os.fsync(self._pack_fd)
+      os.close(self._pack_fd)
+      self._pack_fd = None
+
+  def _rewrite_file(self, name, content):
+    tmp_path = os.path.join(self.path, "%s.tmp" % name)
+    with open(tmp_path, "wb") as tmp:
+      tmp.write(content)
+      tmp.flush()
+      os.fsync(tmp.fileno())
+    os.replace(tmp_path, os.path.join(self.path, name))
+
+  def _pack_path(self, pack):
+    return os.path.join(self.path, "packs", "%08d.pack" % pack)
+
+  def _pack_numbers(self):
+    return [int(name[:-len(".pack")]) for name in os.listdir(os.path.join(self.path, "packs"))
+            if name.endswith(".pack")]
+
+
+class _DedupWriter(object):
+  """
+  A write-only file object that splits data into content-defined chunks, stores chunks that are new to a dedup
+  store, and writes a manifest at close(). Chunk boundaries are searched for at a process pool, segment by
+  segment, and new chunks are compressed there as well.
+  """
+
+  def __init__(self, output, executor, workers, store, level, average_chunk_size):
+    self._file = output
+    self._executor = executor
+    self._store = store
+    self._level = level
+    self._min_chunk_size = average_chunk_size // 4
+    self._max_chunk_size = average_chunk_size * 4
+    # A boundary candidate follows one byte of 2 ** bits on average
+    self._bits = max(average_chunk_size.bit_length() - 1, 8)
+    self._segment_size = max(4 * self._max_chunk_size, 4 * 1024 * 1024)
+    self._max_pending = 2 * workers
+    self._segment = bytearray()
+    self._context = b""
+    # Segments being searched for boundaries, and new chunks being compressed
+    self._segments = collections.deque()
+    self._compressions = collections.deque()
+    # Data after the last chunk boundary, and its offset at the stream
+    self._data = bytearray()
+    self._data_offset = 0
+    self._digests = bytearray()
+    self._new_digests = set()
+    self.bytes_in = 0
+    self.bytes_out = 0
+
+  def write(self, data):
+    self._segment += data
+    self.bytes_in += len(data)
+    if len(self._segment) >= self._segment_size:
+      self._submit_segment()
+    return len(data)
+
+  def close(self):
+    if self._segment:
+      self._submit_segment()
+    while self._segments:
+      self._cut_segment()
+    if self._data:
+      self._add_chunk(len(self._data))
+    while self._compressions:
+      self._store_chunk()
+    self._store.commit()
+    header = {"version": DEDUP_MANIFEST_VERSION, "store": self._store.path, "chunks": len(self._digests) // 32,
+              "size": self.bytes_in}
+    manifest = json.dumps(header, sort_keys=True).encode() + b"\n" + self._digests
+    self._file.write(manifest)
+    self.bytes_out += len(manifest)
+
+  def _submit_segment(self):
+    segment = bytes(self._segment)
+    self._segment = bytearray()
+    future = self._executor.submit(_find_chunk_boundaries, self._context + segment, len(self._context), self._bits)
+    # Candidates of the next segment depend on preceding bytes, see _find_chunk_boundaries()
+    self._context = segment[-(DEDUP_HASH_TAPS[-1] + (self._bits - 1) // 8):]
+    self._segments.append((segment, future))
+    while len(self._segments) > self._max_pending:
+      self._cut_segment()
+
+  def _cut_segment(self):
+    segment, future = self._segments.popleft()
+    segment_offset = self._data_offset + len(self._data)
+    self._data += segment
+    for candidate in future.result():
+      self._cut_until(segment_offset + candidate)
+      if segment_offset + candidate - self._data_offset >= self._min_chunk_size:
+        self._add_chunk(segment_offset + candidate - self._data_offset)
+    self._cut_until(segment_offset + len(segment))
+
+  def _cut_until(self, offset):
+    """
+    Cuts chunks of max size until the chunk that ends at offset is not too large
+    """
+    while offset - self._data_offset > self._max_chunk_size:
+      self._add_chunk(self._max_chunk_size)
+
+  def _add_chunk(self, size):
+    chunk = bytes(self._data[:size])
+    del self._data[:size]
+    self._data_offset += size
+    digest = hashlib.sha256(chunk).digest()
+    self._digests += digest
+    if digest not in self._store and digest not in self._new_digests:
+      self._new_digests.add(digest)
+      self._compressions.append((digest, self._executor.submit(zlib.compress, chunk, self._level)))
+      while len(self._compressions) > self._max_pending:
+        self._store_chunk()
+
+  def _store_chunk(self):
+    digest, future = self._compressions.popleft()
+    self.bytes_out += self._store.add_chunk(digest, future.result())
+
+
+def _find_chunk_boundaries(data, context_size, bits):
+  """
+  Finds candidates for content-defined chunk boundaries. A rolling hash over every byte is slow in Python, so a
+  byte hash is computed at C speed instead: bytes are mapped by tables of DEDUP_HASH_TABLES with bytes.translate(),
+  and the results, shifted by DEDUP_HASH_TAPS, are XORed as integers. A candidate follows a byte whose hash is zero,
+  found with bytes.find(), and whose preceding hashes supply the remaining bits. The hash of a byte depends only on
+  that byte and a few preceding ones, so segments of a stream can be processed independently.
+  :param data: context followed by the segment
+  :param context_size: number of bytes preceding the segment, DEDUP_HASH_TAPS[-1] + (bits - 1) // 8 at most
+  :param bits: a candidate follows one byte of 2 ** bits on average, at least 8
+  :return: list of offsets (relative to the segment) right after candidate bytes
+  """
+  hashes = 0
+  for tap, table in zip(DEDUP_HASH_TAPS, DEDUP_HASH_TABLES):
+    hashes ^= int.from_bytes(data.translate(table), "little") << (8 * tap)
+  hashes = hashes.to_bytes(len(data) + DEDUP_HASH_TAPS[-1] + 1, "little")
+  preceding = (bits - 1) // 8
+  mask = (1 << (bits - 8)) - 1
+  result = []
+  offset = hashes.find(0, max(context_size, preceding), len(data))
+  while offset >= 0:
+    if not int.from_bytes(hashes[offset - preceding:offset], "little") & mask:
+      result.append(offset + 1 - context_size)
+    offset = hashes.find(0, offset + 1, len(data))
+  return result
+
+# endregion
+
+
 def main():
   parser = configure_parser()
   args, unknown_args = parser.parse_known_args()
 
-  args.extension = args.extension if args.extension.startswith(".") else ".%s" % args.extension
   validate_args(args)
+  if args.extension:
+    args.extension = _normalize_extension(args.extension)
 
   exit_code = 0
   stdout = ''
@@ -262,8 +2326,15 @@ def main():
     stdout, exit_code = auto_clean(args)
   elif args.action == REMOVE_UNSUCCESSFUL_ACTION:
     stdout, exit_code = remove_unsuccessful(args)
+  elif args.action == RUN_BACKUP_ACTION:
+    stdout, exit_code = run_backup(args)
+  elif args.action == CAT_BACKUP_ACTION:
+    stdout, exit_code = cat_backup(args)
+  elif args.action == VERIFY_ACTION:
+    stdout, exit_code = verify(args)
   # There can not be another value thanks to argparse validation
-  print(stdout)
+  if stdout is not None:
+    print(stdout)
   sys.exit(exit_code)
 
 
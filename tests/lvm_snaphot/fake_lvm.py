@@ -0,0 +1,179 @@
+#!/usr/bin/env python3
+"""
+Stands in for the lvm tool in tests. Keeps LVM state at a JSON file pointed by FAKE_LVM_STATE environment variable:
+  {"processes": 0, "commands": [], "pvs": {pv: vg}, "vgs": {vg: {"vg_free": mb}}, "lvs": {"vg/lv": {field: value}}}
+Without arguments it works as an lvm shell, reading commands from stdin. Outputs of commands are JSON documents,
+as lvm prints them with --reportformat json. Like lvm, it adds a command log only with log/report_command_log=1
+at --config, so commands that change something print nothing otherwise. If the state has "command_log": false, the
+log is never added, as if the setting was not supported.
+"""
+
+import json
+import os
+import shlex
+import sys
+
+# Size of every physical volume
+PV_SIZE_MB = 1024
+
+
+class CommandFailed(Exception):
+  pass
+
+
+def main():
+  state = load_state()
+  state["processes"] += 1
+  save_state(state)
+  if len(sys.argv) > 1:
+    sys.exit(0 if execute(sys.argv[1:]) else 5)
+  while True:
+    sys.stdout.write("lvm> ")
+    sys.stdout.flush()
+    line = sys.stdin.readline()
+    if not line or line.strip() == "exit":
+      break
+    if line.strip():
+      execute(shlex.split(line))
+
+
+def execute(argv):
+  state = load_state()
+  state["commands"].append(argv[0])
+  argv = [arg for arg in argv if arg not in ("--reportformat", "json")]
+  if argv.count("--config") > 1:
+    sys.stderr.write("  Option --config may not be repeated.\n")
+    return False
+  settings = []
+  if "--config" in argv:
+    settings = option_value(argv, "--config").split()
+    del argv[argv.index("--config"):argv.index("--config") + 2]
+  document = {}
+  try:
+    report = COMMANDS[argv[0]](state, argv[1:])
+    if report is not None:
+      document["report"] = [report]
+    status = {"log_type": "status", "log_message": "success", "log_ret_code": "1"}
+    log = [status]
+  except CommandFailed as e:
+    sys.stderr.write("  %s\n" % e)
+    log = [{"log_type": "error", "log_message": str(e), "log_ret_code": "0"},
+           {"log_type": "status", "log_message": "failure", "log_ret_code": "0"}]
+  save_state(state)
+  if "log/report_command_log=1" in settings and state.get("command_log", True):
+    document["log"] = log
+  if document:
+    print(json.dumps(document, indent=2))
+  sys.stdout.flush()
+  return log[-1]["log_ret_code"] == "1"
+
+
+def pvs(state, argv):
+  return {"pv": [{"pv_name": pv, "vg_name": vg} for pv, vg in sorted(state["pvs"].items())]}
+
+
+def vgs(state, argv):
+  fields = option_value(argv, "-o").split(",")
+  if argv[-1] == option_value(argv, "-o"):
+    return {"vg": [{field: str(dict(vg, vg_name=name)[field]) for field in fields}
+                   for name, vg in sorted(state["vgs"].items())]}
+  vg = state["vgs"].get(argv[-1])
+  if vg is None:
+    raise CommandFailed("Volume group \"%s\" not found" % argv[-1])
+  return {"vg": [{field: str(vg[field]) for field in fields}]}
+
+
+def lvs(state, argv):
+  lv = find_lv(state, argv[-1])
+  return {"lv": [{field: str(lv.get(field, "")) for field in option_value(argv, "-o").split(",")}]}
+
+
+def pvcreate(state, argv):
+  state["pvs"][argv[-1]] = ""
+
+
+def pvremove(state, argv):
+  if state["pvs"].pop(argv[-1], None) is None:
+    raise CommandFailed("Physical volume %s not found" % argv[-1])
+
+
+def pvresize(state, argv):
+  state["vgs"][state["pvs"][argv[-1]]]["vg_free"] += PV_SIZE_MB
+
+
+def vgextend(state, argv):
+  state["pvs"][argv[1]] = argv[0]
+  state["vgs"][argv[0]]["vg_free"] += PV_SIZE_MB
+
+
+def vgreduce(state, argv):
+  state["pvs"][argv[1]] = ""
+  state["vgs"][argv[0]]["vg_free"] -= PV_SIZE_MB
+
+
+def lvcreate(state, argv):
+  origin = find_lv(state, argv[-1])
+  vg_name = argv[-1].split("/")[0]
+  if origin.get("segtype") == "thin":
+    state["lvs"]["%s/%s" % (vg_name, option_value(argv, "-n"))] = dict(origin)
+    return None
+  size_mb = float(option_value(argv, "-L").rstrip("m"))
+  take_space(state, vg_name, size_mb)
+  state["lvs"]["%s/%s" % (vg_name, option_value(argv, "-n"))] = {"segtype": "snapshot", "pool_lv": "",
+                                                                  "lv_size": size_mb, "data_percent": 0.0}
+  return None
+
+
+def lvextend(state, argv):
+  lv = find_lv(state, argv[-1])
+  size_mb = float(option_value(argv, "-L").lstrip("+").rstrip("m"))
+  take_space(state, argv[-1].split("/")[0], size_mb)
+  lv["data_percent"] = lv["data_percent"] * lv["lv_size"] / (lv["lv_size"] + size_mb)
+  lv["lv_size"] += size_mb
+
+
+def lvremove(state, argv):
+  lv = find_lv(state, argv[-1])
+  state["vgs"][argv[-1].split("/")[0]]["vg_free"] += lv.get("lv_size", 0) if lv["segtype"] == "snapshot" else 0
+  del state["lvs"][argv[-1]]
+
+
+def vgcfgbackup(state, argv):
+  pass
+
+
+def find_lv(state, lv_id):
+  if lv_id not in state["lvs"]:
+    raise CommandFailed("Failed to find logical volume \"%s\"" % lv_id)
+  return state["lvs"][lv_id]
+
+
+def take_space(state, vg_name, size_mb):
+  if state["vgs"][vg_name]["vg_free"] < size_mb:
+    raise CommandFailed("Volume group \"%s\" has insufficient free space" % vg_name)
+  state["vgs"][vg_name]["vg_free"] -= size_mb
+
+
+def option_value(argv, option):
+  return argv[argv.index(option) + 1]
+
+
+def load_state():
+  with open(os.environ["FAKE_LVM_STATE"]) as state_file:
+    return json.load(state_file)
+
+
+def save_state(state):
+  with open(os.environ["FAKE_LVM_STATE"], "w") as state_file:
+    json.dump(state, state_file)
+
+
+COMMANDS = {
+  "pvs": pvs, "vgs": vgs, "lvs": lvs, "pvcreate": pvcreate, "pvremove": pvremove, "pvresize": pvresize,
+  "vgextend": vgextend, "vgreduce": vgreduce, "lvcreate": lvcreate, "lvextend": lvextend, "lvremove": lvremove,
+  "vgcfgbackup": vgcfgbackup,
+}
+
+
+if __name__ == "__main__":
+  main()
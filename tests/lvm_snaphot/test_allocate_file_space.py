@@ -0,0 +1,28 @@
+import os
+
+import pytest
+
+import lvm_snaphot
+
+MB = 1024 * 1024
+
+
+@pytest.mark.parametrize("strategy", ["fallocate", "zero-fill", "sparse"])
+def test_should_allocate_file_of_requested_size(tmp_path, strategy):
+  """
+  Checks that every strategy creates a file of the requested size filled with zeros, and grows it at the offset
+  """
+  # Configuration
+  path = str(tmp_path / "tmp_space.tmp")
+
+  # Run method under test
+  lvm_snaphot.allocate_file_space(path, 0, 20, strategy)
+  lvm_snaphot.allocate_file_space(path, 20 * MB, 3, strategy)
+
+  # Assertions
+  with open(path, "rb") as tmp_file:
+    assert tmp_file.read() == bytes(23 * MB)
+  if strategy == "sparse":
+    assert os.stat(path).st_blocks == 0
+  else:
+    assert os.stat(path).st_blocks * 512 >= 23 * MB
@@ -0,0 +1,75 @@
+import subprocess
+from types import SimpleNamespace
+
+import lvm_snaphot
+
+
+def test_should_attach_free_loop_device_with_direct_io(tmp_path, mocker):
+  """
+  Checks that a free loop device is found and attached with direct I/O, and it is recorded for the unmount
+  """
+  # Configuration
+  tmp_file = str(tmp_path / "tmp_space.tmp")
+  mocker.patch('lvm_snaphot.logical_block_size', return_value=512)
+  run_mock = mocker.patch('lvm_snaphot.subprocess.run', return_value=SimpleNamespace(stdout="/dev/loop7\n"))
+
+  # Run method under test
+  loop_device = lvm_snaphot.attach_loop_device(tmp_file, None)
+
+  # Assertions
+  assert loop_device == "/dev/loop7"
+  assert run_mock.call_args.args[0] == ['/sbin/losetup', '--show', '--direct-io=on', '--sector-size', '512',
+                                        '--find', tmp_file]
+  assert lvm_snaphot.find_loop_device(create_args(tmp_file)) == "/dev/loop7"
+
+
+def test_should_attach_loop_device_without_direct_io_if_unsupported(tmp_path, mocker):
+  """
+  Checks that the tmp file is attached through the page cache if its filesystem does not support direct I/O
+  """
+  # Configuration
+  tmp_file = str(tmp_path / "tmp_space.tmp")
+  mocker.patch('lvm_snaphot.logical_block_size', return_value=None)
+  run_mock = mocker.patch('lvm_snaphot.subprocess.run', side_effect=[
+    subprocess.CalledProcessError(1, 'losetup'), SimpleNamespace(stdout="/dev/loop5\n")])
+
+  # Run method under test
+  loop_device = lvm_snaphot.attach_loop_device(tmp_file, "/dev/loop5")
+
+  # Assertions
+  assert loop_device == "/dev/loop5"
+  assert [call.args[0] for call in run_mock.call_args_list] == [
+    ['/sbin/losetup', '--show', '--direct-io=on', '/dev/loop5', tmp_file],
+    ['/sbin/losetup', '--show', '/dev/loop5', tmp_file],
+  ]
+
+
+def test_should_detach_recorded_loop_device(tmp_path, mocker):
+  """
+  Checks that the loop device recorded during mount is removed from the volume group, its physical volume is
+  destroyed, it is detached, and the record is removed
+  """
+  # Configuration
+  tmp_file = str(tmp_path / "tmp_space.tmp")
+  (tmp_path / "tmp_space.tmp.loop-device").write_text('{"loop_device": "/dev/loop7", "tmp_file": "%s"}' % tmp_file)
+  mocker.patch('lvm_snaphot.list_pvs', side_effect=[{"/dev/loop7": "vg"}, {"/dev/loop7": ""}])
+  mocker.patch('lvm_snaphot.list_loop_devices', return_value={"/dev/loop7": tmp_file})
+  lvm_command_mock = mocker.patch('lvm_snaphot.run_lvm_command')
+  run_mock = mocker.patch('lvm_snaphot.subprocess.run')
+
+  # Run method under test
+  lvm_snaphot.remove_pv_based_on_tmp_file(create_args(tmp_file))
+
+  # Assertions
+  assert [call.args[0] for call in lvm_command_mock.call_args_list] == [['vgreduce', 'vg', '/dev/loop7'],
+                                                                        ['pvremove', '/dev/loop7']]
+  assert run_mock.call_args.args[0] == ['/sbin/losetup', '-d', '/dev/loop7']
+  assert not (tmp_path / "tmp_space.tmp.loop-device").exists()
+
+
+def create_args(tmp_file):
+  args = SimpleNamespace()
+  args.source_lvm_vg = "vg"
+  args.lvm_snapshot_tmp_file = tmp_file
+  args.loop_device = None
+  return args
@@ -0,0 +1,172 @@
+import json
+import os
+import subprocess
+from types import SimpleNamespace
+
+import pytest
+
+import lvm_snaphot
+
+FAKE_LVM = os.path.join(os.path.dirname(os.path.abspath(__file__)), "fake_lvm.py")
+
+
+@pytest.fixture
+def lvm_state(tmp_path, monkeypatch):
+  state_path = str(tmp_path / "lvm_state.json")
+  with open(state_path, "w") as state_file:
+    json.dump({"processes": 0, "commands": [], "pvs": {"/dev/sda2": "vg"}, "vgs": {"vg": {"vg_free": 2048.0}},
+               "lvs": {"vg/system": {"segtype": "linear", "pool_lv": "", "lv_size": 10240.0},
+                       "vg/pool": {"segtype": "thin-pool", "pool_lv": "", "data_percent": 12.5,
+                                   "metadata_percent": 3.1},
+                       "vg/thin_data": {"segtype": "thin", "pool_lv": "pool"}}}, state_file)
+  monkeypatch.setenv("FAKE_LVM_STATE", state_path)
+  lvm_snaphot.invalidate_lvm_reports()
+  lvm_snaphot.start_lvm_shell(FAKE_LVM)
+  yield state_path
+  lvm_snaphot.stop_lvm_shell()
+
+
+def test_should_run_snapshot_lifecycle_at_single_lvm_process(lvm_state, mocker):
+  """
+  Checks that creating, extending and removing a snapshot runs all LVM commands at one lvm shell process, and
+  reports are not repeated until something changes
+  """
+  # Configuration
+  args = SimpleNamespace(source_lvm_vg="vg", source_lvm_lv="system", lvm_snapshot_name="snap",
+                         lvm_volume_size_mb=1024, lvm_snapshot_tmp_file=None)
+  mocker.patch('lvm_snaphot.os.path.exists', return_value=True)
+
+  # Run method under test
+  assert lvm_snaphot.find_thin_pool("vg", "system") is None
+  assert lvm_snaphot.find_thin_pool("vg", "system") is None
+  lvm_snaphot.create_snapshot(args)
+  assert lvm_snaphot.extend_snapshot(args, 512) == 512
+  assert lvm_snaphot.lv_report("vg", "snap", ["lv_size"]) == {"lv_size": "1536.0"}
+  lvm_snaphot.remove_snapshot_lv(args, lvm_snaphot.lvm_mapper_dev_name("vg", "snap"))
+
+  # Assertions
+  with open(lvm_state) as state_file:
+    state = json.load(state_file)
+  assert state["processes"] == 1
+  # The shell is checked with vgs at start
+  assert state["commands"] == ["vgs", "lvs", "lvcreate", "vgs", "lvextend", "lvs", "lvremove"]
+  assert "vg/snap" not in state["lvs"]
+  assert state["vgs"]["vg"]["vg_free"] == 2048
+
+
+def test_should_create_thin_snapshot_of_thin_volume(lvm_state, mocker):
+  """
+  Checks that a thin provisioned volume gets a thin snapshot, that takes no size and is not skipped at activation,
+  and no tmp file is allocated for it
+  """
+  # Configuration
+  args = SimpleNamespace(source_lvm_vg="vg", source_lvm_lv="thin_data", lvm_snapshot_name="snap",
+                         lvm_volume_size_mb=1024, lvm_snapshot_tmp_file="/media/other/tmp_space.tmp",
+                         snapshot_history_file=None)
+  mocker.patch('lvm_snaphot.os.path.exists', side_effect=lambda path: "snap" not in path)
+  allocate_mock = mocker.patch('lvm_snaphot.allocate_tmp_file')
+  create_pv_mock = mocker.patch('lvm_snaphot.create_pv_based_on_tmp_file')
+  run_lvm_command_spy = mocker.spy(lvm_snaphot, 'run_lvm_command')
+
+  # Run method under test
+  snapshot_dev = lvm_snaphot.take_snapshot(args)
+
+  # Assertions
+  assert snapshot_dev == "/dev/mapper/vg-snap"
+  assert [call.args[0] for call in run_lvm_command_spy.call_args_list] == [
+    ['lvcreate', '-s', '--setactivationskip', 'n', '-n', 'snap', 'vg/thin_data']]
+  allocate_mock.assert_not_called()
+  create_pv_mock.assert_not_called()
+  with open(lvm_state) as state_file:
+    state = json.load(state_file)
+  assert state["processes"] == 1
+  assert state["lvs"]["vg/snap"]["segtype"] == "thin"
+  assert state["vgs"]["vg"]["vg_free"] == 2048
+
+
+def test_should_run_commands_without_shell_at_configured_binary(lvm_state):
+  """
+  Checks that once the shell is stopped, commands run as separate processes of the binary the shell was started with
+  """
+  # Configuration
+  lvm_snaphot.stop_lvm_shell()
+
+  # Run method under test
+  pvs = lvm_snaphot.list_pvs()
+
+  # Assertions
+  assert pvs == {"/dev/sda2": "vg"}
+  with open(lvm_state) as state_file:
+    assert json.load(state_file)["processes"] == 2
+
+
+def test_should_raise_error_of_failed_lvm_command(lvm_state):
+  """
+  Checks that a failed command raises an error, and the shell keeps running next commands
+  """
+  # Run method under test and assertions
+  with pytest.raises(subprocess.CalledProcessError) as error:
+    lvm_snaphot.run_lvm_command(['lvremove', '--force', 'vg/missing'])
+  assert "Failed to find logical volume" in error.value.output
+  assert lvm_snaphot.list_pvs() == {"/dev/sda2": "vg"}
+
+
+def test_should_complete_command_that_prints_nothing(lvm_state, monkeypatch):
+  """
+  Checks that a command that prints no command log, as lvm does if the log is not supported, completes at the next
+  prompt instead of waiting for a JSON document
+  """
+  # Configuration
+  with open(lvm_state) as state_file:
+    state = json.load(state_file)
+  state["command_log"] = False
+  with open(lvm_state, "w") as state_file:
+    json.dump(state, state_file)
+  monkeypatch.setattr(lvm_snaphot, "TIMEOUT", 5)
+
+  # Run method under test
+  lvm_snaphot.run_lvm_command(['lvremove', '--force', 'vg/thin_data'])
+
+  # Assertions
+  assert lvm_snaphot.list_pvs() == {"/dev/sda2": "vg"}
+  with open(lvm_state) as state_file:
+    assert "vg/thin_data" not in json.load(state_file)["lvs"]
+
+
+def test_should_merge_config_of_command_with_command_log_setting(lvm_state):
+  """
+  Checks that settings of a command are passed with the command log setting at a single --config option, that lvm
+  does not allow to repeat
+  """
+  # Run method under test
+  lvm_snaphot.run_lvm_commands_frozen([], [['lvcreate', '-s', '-n', 'snap', '-L', '512m', 'vg/system']])
+
+  # Assertions
+  assert lvm_snaphot.LvmShell.command_line(['lvremove', '--config', 'backup/archive=0', 'vg/snap']) == \
+    'lvremove --config "log/report_command_log=1 backup/archive=0" vg/snap --reportformat json'
+  with open(lvm_state) as state_file:
+    assert json.load(state_file)["lvs"]["vg/snap"]["lv_size"] == 512
+
+
+def test_should_run_commands_without_shell_if_shell_has_no_command_log(lvm_state, capsys):
+  """
+  Checks that if the shell does not report statuses of commands, it is not used, and commands run as separate
+  processes
+  """
+  # Configuration
+  lvm_snaphot.stop_lvm_shell()
+  with open(lvm_state) as state_file:
+    state = json.load(state_file)
+  state["command_log"] = False
+  with open(lvm_state, "w") as state_file:
+    json.dump(state, state_file)
+
+  # Run method under test
+  lvm_snaphot.start_lvm_shell(FAKE_LVM)
+
+  # Assertions
+  assert lvm_snaphot.lvm_shell is None
+  assert "running LVM commands as separate processes" in capsys.readouterr().out
+  assert lvm_snaphot.list_pvs() == {"/dev/sda2": "vg"}
+  with open(lvm_state) as state_file:
+    assert json.load(state_file)["processes"] == 3
@@ -0,0 +1,89 @@
+import json
+from types import SimpleNamespace
+
+import lvm_snaphot
+
+
+def test_should_predict_size_from_history_and_write_rate(tmp_path, mocker):
+  """
+  Checks that the snapshot size covers the larger of the previous peak usage and the amount written during
+  the longest previous run, with a margin
+  """
+  # Configuration
+  args = create_args(tmp_path)
+  write_history(args, [
+    {"snapshot": "vg/snap", "created_at": 1000, "size_mb": 4096, "write_rate_mb_per_second": 0.5,
+     "duration_seconds": 3600, "peak_used_mb": 900},
+    {"snapshot": "vg/snap", "created_at": 2000, "size_mb": 4096, "write_rate_mb_per_second": 0.2,
+     "duration_seconds": 1800, "peak_used_mb": 1500},
+    {"snapshot": "vg/other", "created_at": 3000, "size_mb": 4096, "write_rate_mb_per_second": 9,
+     "duration_seconds": 9000, "peak_used_mb": 50000},
+  ])
+  mocker.patch('lvm_snaphot.sample_write_rate', return_value=0.5)
+
+  # Run method under test
+  size_mb = lvm_snaphot.size_snapshot(args)
+
+  # Assertions
+  assert size_mb == 3600
+  history = read_history(args)
+  assert len(history) == 4
+  assert (history[-1]["snapshot"], history[-1]["size_mb"], history[-1]["duration_seconds"]) == ("vg/snap", 3600, None)
+
+
+def test_should_use_given_size_without_history(tmp_path, mocker):
+  """
+  Checks that --lvm-volume-size-mb is used until there are previous runs to learn from
+  """
+  # Configuration
+  args = create_args(tmp_path)
+  mocker.patch('lvm_snaphot.sample_write_rate', return_value=3.0)
+
+  # Run method under test
+  size_mb = lvm_snaphot.size_snapshot(args)
+
+  # Assertions
+  assert size_mb == 4096
+  assert read_history(args)[0]["write_rate_mb_per_second"] == 3.0
+
+
+def test_should_record_peak_usage_of_snapshot(tmp_path, mocker):
+  """
+  Checks that the duration and the peak usage are recorded to the last run of the snapshot
+  """
+  # Configuration
+  args = create_args(tmp_path)
+  write_history(args, [{"snapshot": "vg/snap", "created_at": 1000, "size_mb": 2048, "write_rate_mb_per_second": None,
+                        "duration_seconds": None, "peak_used_mb": None}])
+  mocker.patch('lvm_snaphot.lv_report', return_value={"lv_size": "2048.00", "data_percent": "25.00"})
+  mocker.patch('lvm_snaphot.time.time', return_value=1600)
+
+  # Run method under test
+  lvm_snaphot.record_snapshot_usage(args)
+
+  # Assertions
+  assert read_history(args)[0]["duration_seconds"] == 600
+  assert read_history(args)[0]["peak_used_mb"] == 512
+
+
+def write_history(args, history):
+  with open(args.snapshot_history_file, "w") as history_file:
+    json.dump(history, history_file)
+
+
+def read_history(args):
+  with open(args.snapshot_history_file) as history_file:
+    return json.load(history_file)
+
+
+def create_args(tmp_path):
+  args = SimpleNamespace()
+  args.source_lvm_vg = "vg"
+  args.source_lvm_lv = "system"
+  args.lvm_snapshot_name = "snap"
+  args.lvm_volume_size_mb = 4096
+  args.snapshot_history_file = str(tmp_path / "history.json")
+  args.auto_size = True
+  args.write_sample_seconds = 10
+  args.auto_size_margin = 2.0
+  return args
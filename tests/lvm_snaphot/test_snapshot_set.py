@@ -0,0 +1,155 @@
+import argparse
+import json
+import os
+import subprocess
+
+import pytest
+
+import lvm_snaphot
+
+FAKE_LVM = os.path.join(os.path.dirname(os.path.abspath(__file__)), "fake_lvm.py")
+
+
+@pytest.fixture
+def lvm_state(tmp_path, monkeypatch):
+  state_path = str(tmp_path / "lvm_state.json")
+  with open(state_path, "w") as state_file:
+    json.dump({"processes": 0, "commands": [], "pvs": {"/dev/sda2": "vg"}, "vgs": {"vg": {"vg_free": 1536.0}},
+               "lvs": {"vg/data": {"segtype": "linear", "pool_lv": "", "lv_size": 10240.0},
+                       "vg/wal": {"segtype": "linear", "pool_lv": "", "lv_size": 2048.0}}}, state_file)
+  monkeypatch.setenv("FAKE_LVM_STATE", state_path)
+  lvm_snaphot.invalidate_lvm_reports()
+  lvm_snaphot.start_lvm_shell(FAKE_LVM)
+  yield state_path
+  lvm_snaphot.stop_lvm_shell()
+
+
+@pytest.fixture
+def events(mocker):
+  events = []
+  run_lvm_command = lvm_snaphot.run_lvm_command
+  mocker.patch('lvm_snaphot.list_mounts', return_value={"/": "/dev/mapper/vg-system",
+                                                        "/srv/db": "/dev/mapper/vg-data",
+                                                        "/srv/wal": "/dev/mapper/vg-wal"})
+  mocker.patch('lvm_snaphot.os.path.exists', side_effect=lambda path: "snap" not in path)
+  mocker.patch('lvm_snaphot.kernel_version', return_value=(6, 6))
+  mocker.patch('lvm_snaphot.os.open', side_effect=lambda path, flags: path)
+  mocker.patch('lvm_snaphot.os.close')
+  mocker.patch('lvm_snaphot.fcntl.ioctl', side_effect=lambda fd, request, arg: events.append(
+    ("freeze" if request == lvm_snaphot.FIFREEZE else "thaw", fd)))
+  mocker.patch('lvm_snaphot.run_lvm_command', side_effect=lambda cmd: events.append(cmd[0]) or run_lvm_command(cmd))
+  return events
+
+
+def test_should_create_snapshot_set_while_filesystems_are_frozen(lvm_state, events, mocker):
+  """
+  Checks that snapshots of all volumes of a set are created while their filesystems are frozen, and only LVM
+  commands that create snapshots run during the freeze
+  """
+  # Configuration
+  args = create_args(["data:data_snap:/media/db_snapshot", "wal:wal_snap:/media/wal_snapshot"])
+  mount_mock = mocker.patch('lvm_snaphot.mount')
+
+  # Run method under test
+  lvm_snaphot.mount_snapshot_set(args)
+
+  # Assertions
+  assert events == [("freeze", "/srv/db"), ("freeze", "/srv/wal"), "lvcreate", "lvcreate",
+                    ("thaw", "/srv/db"), ("thaw", "/srv/wal"), "vgcfgbackup"]
+  with open(lvm_state) as state_file:
+    state = json.load(state_file)
+  assert state["processes"] == 1
+  assert state["lvs"]["vg/data_snap"]["lv_size"] == state["lvs"]["vg/wal_snap"]["lv_size"] == 512
+  assert sorted(call.args for call in mount_mock.call_args_list) == [
+    ("/dev/mapper/vg-data_snap", "/media/db_snapshot"), ("/dev/mapper/vg-wal_snap", "/media/wal_snapshot")]
+
+
+def test_should_thaw_filesystems_if_snapshot_creation_fails(lvm_state, events):
+  """
+  Checks that filesystems are thawed if a snapshot of the set can not be created
+  """
+  # Configuration
+  args = create_args(["data:data_snap:/media/db_snapshot", "wal:wal_snap:/media/wal_snapshot"])
+  args.lvm_volume_size_mb = 1024
+
+  # Run method under test
+  with pytest.raises(subprocess.CalledProcessError):
+    lvm_snaphot.mount_snapshot_set(args)
+
+  # Assertions
+  assert events == [("freeze", "/srv/db"), ("freeze", "/srv/wal"), "lvcreate", "lvcreate",
+                    ("thaw", "/srv/db"), ("thaw", "/srv/wal")]
+
+
+def test_should_freeze_filesystem_mounted_twice_once(lvm_state, events, mocker):
+  """
+  Checks that a filesystem that is also bind mounted is frozen once
+  """
+  # Configuration
+  args = create_args(["data:data_snap:/media/db_snapshot", "wal:wal_snap:/media/wal_snapshot"])
+  mocker.patch('lvm_snaphot.list_mounts', return_value={"/srv/db": "/dev/mapper/vg-data",
+                                                        "/srv/db_bind": "/dev/mapper/vg-data",
+                                                        "/srv/wal": "/dev/mapper/vg-wal"})
+  mocker.patch('lvm_snaphot.mount')
+
+  # Run method under test
+  lvm_snaphot.mount_snapshot_set(args)
+
+  # Assertions
+  assert events == [("freeze", "/srv/db"), ("freeze", "/srv/wal"), "lvcreate", "lvcreate",
+                    ("thaw", "/srv/db"), ("thaw", "/srv/wal"), "vgcfgbackup"]
+
+
+def test_should_not_freeze_filesystems_on_old_kernel(lvm_state, events, mocker):
+  """
+  Checks that filesystems are not frozen if the kernel can not snapshot frozen filesystems
+  """
+  # Configuration
+  args = create_args(["data:data_snap:/media/db_snapshot", "wal:wal_snap:/media/wal_snapshot"])
+  mocker.patch('lvm_snaphot.kernel_version', return_value=(5, 15))
+  mocker.patch('lvm_snaphot.mount')
+
+  # Run method under test
+  lvm_snaphot.mount_snapshot_set(args)
+
+  # Assertions
+  assert events == ["lvcreate", "lvcreate", "vgcfgbackup"]
+
+
+def test_should_create_snapshots_without_freeze_if_origin_can_not_be_suspended(lvm_state, events, mocker):
+  """
+  Checks that snapshots are created after filesystems are thawed, if device mapper can not suspend a frozen origin
+  """
+  # Configuration
+  args = create_args(["data:data_snap:/media/db_snapshot", "wal:wal_snap:/media/wal_snapshot"])
+  run_lvm_command = lvm_snaphot.run_lvm_command.side_effect
+
+  def fail_on_frozen_filesystem(cmd):
+    if events.count(("freeze", "/srv/db")) > events.count(("thaw", "/srv/db")):
+      events.append(cmd[0])
+      raise subprocess.CalledProcessError(5, cmd, output="device-mapper: suspend ioctl on (253:1) failed: "
+                                                         "Device or resource busy")
+    run_lvm_command(cmd)
+
+  mocker.patch('lvm_snaphot.run_lvm_command', side_effect=fail_on_frozen_filesystem)
+  mocker.patch('lvm_snaphot.mount')
+
+  # Run method under test
+  lvm_snaphot.mount_snapshot_set(args)
+
+  # Assertions
+  assert events == [("freeze", "/srv/db"), ("freeze", "/srv/wal"), "lvcreate", ("thaw", "/srv/db"),
+                    ("thaw", "/srv/wal"), "lvcreate", "lvcreate", "vgcfgbackup"]
+  with open(lvm_state) as state_file:
+    assert {"vg/data_snap", "vg/wal_snap"} <= set(json.load(state_file)["lvs"])
+
+
+def create_args(snapshot_set_lv):
+  args = argparse.Namespace()
+  args.source_lvm_vg = "vg"
+  args.snapshot_set_lv = snapshot_set_lv
+  args.lvm_volume_size_mb = 512
+  args.lvm_snapshot_tmp_file = None
+  args.loop_device = None
+  args.remove_mountpoint = False
+  return args
@@ -0,0 +1,74 @@
+import lvm_snaphot
+
+MOUNTINFO = """22 1 253:1 / / rw,relatime shared:1 - ext4 /dev/mapper/vg-system rw,errors=remount-ro
+40 22 253:3 / /media/other\\040partition rw,relatime shared:2 - ext4 /dev/mapper/vg-other rw
+41 40 0:37 / /media/other\\040partition/tmp rw shared:3 master:1 - tmpfs tmpfs rw,size=1024k
+"""
+
+
+def test_should_read_mounts_from_mountinfo(mocker):
+  """
+  Checks that mounts are parsed from /proc/self/mountinfo, including escaped mountpoints and optional fields
+  """
+  # Configuration
+  mocker.patch('builtins.open', mocker.mock_open(read_data=MOUNTINFO))
+
+  # Run method under test
+  mounts = lvm_snaphot.list_mounts()
+
+  # Assertions
+  assert mounts == {
+    "/": "/dev/mapper/vg-system",
+    "/media/other partition": "/dev/mapper/vg-other",
+    "/media/other partition/tmp": "tmpfs",
+  }
+
+
+def test_should_find_mount_point_and_filesystem_type(mocker):
+  """
+  Checks that the nearest mountpoint of a path is found without checking directories of the path
+  """
+  # Configuration
+  mocker.patch('builtins.open', mocker.mock_open(read_data=MOUNTINFO))
+  mocker.patch('lvm_snaphot.os.path.realpath', side_effect=lambda path: path)
+  ismount_mock = mocker.patch('lvm_snaphot.os.path.ismount')
+
+  # Run method under test and assertions
+  assert lvm_snaphot.find_mount_point("/media/other partition/backups/tmp_space.tmp") == "/media/other partition"
+  assert lvm_snaphot.filesystem_type("/media/other partition/tmp/file") == "tmpfs"
+  assert lvm_snaphot.filesystem_type("/var/tmp") == "ext4"
+  ismount_mock.assert_not_called()
+
+
+def test_should_stop_at_root_missing_from_mountinfo(mocker):
+  """
+  Checks that a path outside of all mountpoints, as in a chroot whose root is not a mountpoint, resolves to "/"
+  of unknown filesystem type
+  """
+  # Configuration
+  mocker.patch('builtins.open', mocker.mock_open(read_data=MOUNTINFO.split("\n", 1)[1]))
+  mocker.patch('lvm_snaphot.os.path.realpath', side_effect=lambda path: path)
+
+  # Run method under test and assertions
+  assert lvm_snaphot.find_mount_point("/var/tmp/tmp_space.tmp") == "/"
+  assert lvm_snaphot.filesystem_type("/var/tmp") is None
+
+
+def test_should_cache_lvm_reports_until_lvm_changes(mocker):
+  """
+  Checks that an LVM report is run once, and again only after a command that changes LVM state
+  """
+  # Configuration
+  lvm_snaphot.invalidate_lvm_reports()
+  run_mock = mocker.patch('lvm_snaphot.run_lvm', return_value={
+    "report": [{"pv": [{"pv_name": "/dev/loop5", "vg_name": "vg"}]}]})
+
+  # Run method under test
+  first_pvs = lvm_snaphot.list_pvs()
+  second_pvs = lvm_snaphot.list_pvs()
+  lvm_snaphot.run_lvm_command(['vgreduce', 'vg', '/dev/loop5'])
+  lvm_snaphot.list_pvs()
+
+  # Assertions
+  assert first_pvs == second_pvs == {"/dev/loop5": "vg"}
+  assert [call.args[0][0] for call in run_mock.call_args_list] == ['pvs', 'vgreduce', 'pvs']
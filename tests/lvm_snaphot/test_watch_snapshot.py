@@ -0,0 +1,73 @@
+from types import SimpleNamespace
+
+import lvm_snaphot
+
+
+def test_should_extend_snapshot_over_threshold_until_it_is_removed(mocker):
+  """
+  Checks that the snapshot is extended when its usage crosses the threshold, and watching stops when it is removed
+  """
+  # Configuration
+  args = create_args()
+  mocker.patch('lvm_snaphot.os.path.exists', side_effect=[True, True, True, False])
+  mocker.patch('lvm_snaphot.find_thin_pool', return_value=None)
+  mocker.patch('lvm_snaphot.lv_report', side_effect=[
+    {"lv_size": "1024.00", "data_percent": "50.00"},
+    {"lv_size": "1024.00", "data_percent": "85.00"},
+    {"lv_size": "2048.00", "data_percent": "45.00"},
+  ])
+  mocker.patch('lvm_snaphot.vg_report', return_value={"vg_free": "4096.00"})
+  mocker.patch('lvm_snaphot.time.sleep')
+  mocker.patch('lvm_snaphot.time.monotonic', side_effect=[0, 0, 5, 10])
+  lvm_command_mock = mocker.patch('lvm_snaphot.run_lvm_command')
+
+  # Run method under test
+  lvm_snaphot.watch_snapshot(args)
+
+  # Assertions
+  lvm_command_mock.assert_called_once_with(['lvextend', '-L', '+1024m', 'vg/snap'])
+
+
+def test_should_grow_tmp_file_if_volume_group_is_full(mocker):
+  """
+  Checks that the tmp file backing a physical volume is grown when the volume group has no enough free space
+  """
+  # Configuration
+  args = create_args()
+  args.lvm_snapshot_tmp_file = "/media/other/tmp_space.tmp"
+  args.loop_device = "/dev/loop5"
+  mocker.patch('lvm_snaphot.vg_report', side_effect=[{"vg_free": "100.00"}, {"vg_free": "1120.00"}])
+  mocker.patch('lvm_snaphot.os.statvfs', return_value=SimpleNamespace(f_bavail=1024 * 1024, f_bsize=4096))
+  mocker.patch('lvm_snaphot.os.path.getsize', return_value=4112 * 1024 * 1024)
+  allocate_mock = mocker.patch('lvm_snaphot.allocate_file_space')
+  run_mock = mocker.patch('lvm_snaphot.subprocess.run')
+  lvm_command_mock = mocker.patch('lvm_snaphot.run_lvm_command')
+
+  # Run method under test
+  extended_mb = lvm_snaphot.extend_snapshot(args, 1024)
+
+  # Assertions
+  assert extended_mb == 1024
+  allocate_mock.assert_called_once_with("/media/other/tmp_space.tmp", 4112 * 1024 * 1024, 928, "fallocate")
+  run_mock.assert_called_once_with(['/sbin/losetup', '--set-capacity', '/dev/loop5'], timeout=lvm_snaphot.TIMEOUT,
+                                   check=True)
+  assert [call.args[0] for call in lvm_command_mock.call_args_list] == [
+    ['pvresize', '/dev/loop5'],
+    ['lvextend', '-L', '+1024m', 'vg/snap'],
+  ]
+
+
+def create_args():
+  args = SimpleNamespace()
+  args.source_lvm_vg = "vg"
+  args.source_lvm_lv = "system"
+  args.lvm_snapshot_name = "snap"
+  args.lvm_snapshot_tmp_file = None
+  args.loop_device = None
+  args.use_fallocate = False
+  args.tmp_file_allocation = "fallocate"
+  args.watch_interval_seconds = 5
+  args.extend_threshold_percent = 80
+  args.extend_step_mb = 1024
+  args.watch_metrics_file = None
+  return args
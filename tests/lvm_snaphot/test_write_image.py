@@ -0,0 +1,117 @@
+import os
+import shutil
+import subprocess
+
+import pytest
+
+import lvm_snaphot
+
+MB = 1024 * 1024
+
+
+def test_should_leave_zero_blocks_as_holes(tmp_path):
+  """
+  Checks that the image has the same content as the device, and all-zero blocks are not written
+  """
+  # Configuration
+  device = str(tmp_path / "device")
+  image = str(tmp_path / "image")
+  content = os.urandom(MB) + bytes(6 * MB) + os.urandom(MB + 123)
+  with open(device, "wb") as device_file:
+    device_file.write(content)
+
+  # Run method under test
+  lvm_snaphot.write_image(device, image, 2 * MB, False)
+
+  # Assertions
+  with open(image, "rb") as image_file:
+    assert image_file.read() == content
+  assert os.stat(image).st_blocks * 512 < 4 * MB
+
+
+@pytest.mark.skipif(not shutil.which("mke2fs") or not shutil.which("debugfs"), reason="requires e2fsprogs")
+def test_should_not_read_free_blocks_of_ext4(tmp_path, mocker):
+  """
+  Checks that free blocks of an ext4 filesystem are not read, and files of the filesystem are intact in the image
+  """
+  # Configuration
+  device = str(tmp_path / "device")
+  image = str(tmp_path / "image")
+  (tmp_path / "root").mkdir()
+  file_content = os.urandom(3 * MB)
+  (tmp_path / "root" / "data.bin").write_bytes(file_content)
+  # Garbage at free blocks would be copied if they were read
+  with open(device, "wb") as device_file:
+    device_file.write(os.urandom(64 * MB))
+  subprocess.run(["mke2fs", "-q", "-F", "-t", "ext4", "-E", "nodiscard", "-d", str(tmp_path / "root"), device],
+                 check=True)
+  read_sizes = []
+  real_preadv = os.preadv
+  mocker.patch('lvm_snaphot.os.preadv', side_effect=lambda fd, buffers, offset: read_sizes.append(len(buffers[0])) or
+               real_preadv(fd, buffers, offset))
+
+  # Run method under test
+  lvm_snaphot.write_image(device, image, MB, True)
+
+  # Assertions
+  assert sum(read_sizes) < 32 * MB
+  assert os.path.getsize(image) == 64 * MB
+  cat_result = subprocess.run(["debugfs", "-R", "cat /data.bin", image], stdout=subprocess.PIPE,
+                              stderr=subprocess.DEVNULL, check=True)
+  assert cat_result.stdout == file_content
+  fsck_result = subprocess.run(["e2fsck", "-fn", image], stdout=subprocess.DEVNULL, stderr=subprocess.DEVNULL)
+  assert fsck_result.returncode == 0
+
+
+@pytest.mark.skipif(not shutil.which("mke2fs"), reason="requires e2fsprogs")
+def test_should_read_whole_ext4_with_bigalloc(tmp_path):
+  """
+  Checks that block bitmaps of an ext4 filesystem with bigalloc, that count clusters instead of blocks, are not used
+  """
+  # Configuration
+  device = str(tmp_path / "device")
+  (tmp_path / "root").mkdir()
+  (tmp_path / "root" / "data.bin").write_bytes(os.urandom(3 * MB))
+  with open(device, "wb") as device_file:
+    device_file.write(os.urandom(64 * MB))
+  subprocess.run(["mke2fs", "-q", "-F", "-t", "ext4", "-O", "bigalloc", "-C", "65536", "-E", "nodiscard",
+                  "-d", str(tmp_path / "root"), device], check=True)
+  device_fd = os.open(device, os.O_RDONLY)
+
+  # Run method under test
+  try:
+    used_ranges = lvm_snaphot.list_used_ext_ranges(device_fd, 64 * MB)
+  finally:
+    os.close(device_fd)
+
+  # Assertions
+  assert used_ranges is None
+
+
+def test_should_restore_image_from_base_and_deltas(tmp_path):
+  """
+  Checks that runs with a block index write deltas of changed blocks only, and applying them to the first image
+  gives the image of the last run
+  """
+  # Configuration
+  device = str(tmp_path / "device")
+  index = str(tmp_path / "index")
+  content = bytearray(os.urandom(8 * MB + 5000))
+  (tmp_path / "device").write_bytes(content)
+  lvm_snaphot.write_image(device, str(tmp_path / "base.img"), 2 * MB, False, index, 64 * 1024, 2)
+  content[100000:100010] = b"0123456789"
+  content[3 * MB:4 * MB] = bytes(MB)
+  content[-10:] = b"last block"
+  (tmp_path / "device").write_bytes(content)
+  lvm_snaphot.write_image(device, str(tmp_path / "delta1"), 2 * MB, False, index, 64 * 1024, 2)
+  content[5 * MB:5 * MB + 1] = b"x"
+  (tmp_path / "device").write_bytes(content)
+  lvm_snaphot.write_image(device, str(tmp_path / "delta2"), 2 * MB, False, index, 64 * 1024, 2)
+
+  # Run method under test
+  lvm_snaphot.apply_deltas(str(tmp_path / "base.img"), [str(tmp_path / "delta1"), str(tmp_path / "delta2")])
+
+  # Assertions
+  assert (tmp_path / "base.img").read_bytes() == content
+  assert os.path.getsize(str(tmp_path / "delta1")) < 3 * 64 * 1024
+  assert os.path.getsize(str(tmp_path / "delta2")) < 2 * 64 * 1024
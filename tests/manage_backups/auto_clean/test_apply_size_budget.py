@@ -0,0 +1,99 @@
+from datetime import datetime
+from types import SimpleNamespace
+
+from manage_backups import BackupEntry
+import manage_backups
+
+MB = 1024 * 1024
+
+
+def test_should_remove_least_valuable_backups_over_max_total_size(mocker):
+  """
+  Checks that preserved backups that exceed the size budget are removed, starting from the ones that cover the
+  smallest part of their period
+  """
+  # Configuration
+  args = create_args(max_total_size_mb=500)
+  datetime_mock = mocker.patch('manage_backups.datetime')
+  datetime_mock.now = mocker.Mock(return_value=datetime(2018, 11, 14, 3, 14, 1))
+  list_of_backups = create_backups()
+
+  # Run method under test
+  backups_to_remove = manage_backups._choose_backups_to_remove(list_of_backups, args)
+
+  # Assertions
+  assert [backup.filename for backup in backups_to_remove] == ['sample_file_20181112_031512']
+
+
+def test_should_keep_min_count_per_period_if_budget_can_not_be_met(mocker):
+  """
+  Checks that every period keeps --min-count-per-period backups even if they do not fit into the budget
+  """
+  # Configuration
+  args = create_args(max_total_size_mb=100)
+  datetime_mock = mocker.patch('manage_backups.datetime')
+  datetime_mock.now = mocker.Mock(return_value=datetime(2018, 11, 14, 3, 14, 1))
+  list_of_backups = create_backups()
+
+  # Run method under test
+  backups_to_remove = manage_backups._choose_backups_to_remove(list_of_backups, args)
+
+  # Assertions
+  assert [backup.filename for backup in backups_to_remove] == [
+    'sample_file_20181111_031512',
+    'sample_file_20181112_031512',
+  ]
+
+
+def test_should_remove_backups_until_min_free_space_is_reached(mocker):
+  """
+  Checks that preserved backups are removed until the backup filesystem has enough free space
+  """
+  # Configuration
+  args = create_args(min_free_space_mb=300)
+  datetime_mock = mocker.patch('manage_backups.datetime')
+  datetime_mock.now = mocker.Mock(return_value=datetime(2018, 11, 14, 3, 14, 1))
+  mocker.patch('manage_backups.os.statvfs', return_value=SimpleNamespace(f_bavail=25, f_frsize=4 * MB))
+  list_of_backups = create_backups()
+  # Not valuable anyway, so its space counts as reclaimed
+  list_of_backups.insert(2, create_entry("20181025_031512"))
+
+  # Run method under test
+  backups_to_remove = manage_backups._choose_backups_to_remove(list_of_backups, args)
+
+  # Assertions
+  assert [backup.filename for backup in backups_to_remove] == [
+    'sample_file_20181025_031512',
+    'sample_file_20181112_031512',
+  ]
+
+
+def create_backups():
+  return [
+    create_entry("20170301_031512"),
+    create_entry("20180901_031512"),
+    create_entry("20181101_031512"),
+    create_entry("20181111_031512"),
+    create_entry("20181112_031512"),
+    create_entry("20181113_031512"),
+  ]
+
+
+def create_entry(datetime_str, size_mb=100):
+  timestamp = datetime.strptime(datetime_str, '%Y%m%d_%H%M%S').timestamp()
+  return BackupEntry("/path/to/backups", "sample_file_" + datetime_str, timestamp, size_mb * MB)
+
+
+def create_args(max_total_size_mb=None, min_free_space_mb=None, min_count_per_period=1):
+  args = SimpleNamespace()
+  args.backup_dest_dir = '/path/to/backups'
+  args.prefix = 'sample_file'
+  args.extension = ''
+  args.daily_backups_max_count = 3
+  args.weekly_backups_max_count = 1
+  args.monthly_backups_max_count = 1
+  args.yearly_backups_max_count = 1
+  args.max_total_size_mb = max_total_size_mb
+  args.min_free_space_mb = min_free_space_mb
+  args.min_count_per_period = min_count_per_period
+  return args
@@ -1,6 +1,6 @@
 from types import SimpleNamespace
 import os
-from manage_backups import auto_clean, PATH, FILENAME, TIMESTAMP
+from manage_backups import auto_clean, BackupEntry
 
 
 def test_should_fail_if_directory_does_not_exist(mocker):
@@ -50,7 +50,10 @@ def test_positive_flow(mocker):
   list_backup_files_mock = mocker.patch('manage_backups._list_backup_files', return_value = list_of_backups)
   filter_backups_according_to_limits_mock = mocker.patch('manage_backups._choose_valuable_backups',
                                                          return_value=files_that_should_be_preserved)
-  remove_mock = mocker.patch('manage_backups.os.remove')
+  open_mock = mocker.patch('manage_backups.os.open', return_value=42)
+  close_mock = mocker.patch('manage_backups.os.close')
+  mocker.patch('manage_backups.os.stat', return_value=SimpleNamespace(st_size=1024 * 1024))
+  unlink_mock = mocker.patch('manage_backups.os.unlink')
 
   # Run method under test
   output, exit_code = auto_clean(args)
@@ -59,16 +62,58 @@ def test_positive_flow(mocker):
   stdout_lines = output.splitlines()
   assert list_backup_files_mock.called
   assert filter_backups_according_to_limits_mock.called
-  assert remove_mock.call_args_list == [
-    mocker.call('/media/backups/sample_file100'),
-    mocker.call('/media/backups/sample_file200'),
-    mocker.call('/media/backups/sample_file400')
+  open_mock.assert_called_once_with('/media/backups', os.O_RDONLY | os.O_DIRECTORY)
+  close_mock.assert_called_once_with(42)
+  assert sorted(unlink_mock.call_args_list) == [
+    mocker.call('sample_file100', dir_fd=42),
+    mocker.call('sample_file100.checksums', dir_fd=42),
+    mocker.call('sample_file200', dir_fd=42),
+    mocker.call('sample_file200.checksums', dir_fd=42),
+    mocker.call('sample_file400', dir_fd=42),
+    mocker.call('sample_file400.checksums', dir_fd=42)
   ]
   assert len(stdout_lines) == len(expected_files_for_removal) + 1
-  assert stdout_lines[-1] == "Removed 3 old backup files."
+  assert stdout_lines[0].startswith("Removed old backup sample_file100 (1.0 MiB in ")
+  assert stdout_lines[-1] == "Removed 3 old backup files, reclaimed 3.0 MiB."
   assert exit_code == 0
 
 
+def test_should_report_failed_removals(mocker):
+  """
+  Checks that a failure to remove one backup does not prevent removal of others, and is reflected in exit code
+  """
+  # Configuration
+  args = create_args()
+  list_of_backups = [
+    create_entry(args, 100),
+    create_entry(args, 200),
+    create_entry(args, 300),
+  ]
+
+  def unlink_side_effect(filename, dir_fd):
+    if filename == 'sample_file100':
+      raise PermissionError("Permission denied")
+
+  mocker.patch('manage_backups.os.path.isdir', return_value=True)
+  mocker.patch('manage_backups._list_backup_files', return_value=list_of_backups)
+  mocker.patch('manage_backups._choose_valuable_backups', return_value=[list_of_backups[2]])
+  mocker.patch('manage_backups.os.open', return_value=42)
+  mocker.patch('manage_backups.os.close')
+  mocker.patch('manage_backups.os.stat', return_value=SimpleNamespace(st_size=100))
+  mocker.patch('manage_backups.os.unlink', side_effect=unlink_side_effect)
+
+  # Run method under test
+  output, exit_code = auto_clean(args)
+
+  # Assertions
+  stdout_lines = output.splitlines()
+  assert len(stdout_lines) == 3
+  assert stdout_lines[0] == "Failed to remove old backup sample_file100: Permission denied"
+  assert stdout_lines[1].startswith("Removed old backup sample_file200 (100 bytes in ")
+  assert stdout_lines[2] == "Removed 1 old backup files, reclaimed 100 bytes."
+  assert exit_code == 1
+
+
 def test_should_not_perform_actions_in_dry_mode(mocker):
   """
   Checks that in dry mode, no actual actions are done
@@ -99,7 +144,7 @@ def test_should_not_perform_actions_in_dry_mode(mocker):
   list_backup_files_mock = mocker.patch('manage_backups._list_backup_files', return_value = list_of_backups)
   filter_backups_according_to_limits_mock = mocker.patch('manage_backups._choose_valuable_backups',
                                                          return_value=files_that_should_be_preserved)
-  remove_mock = mocker.patch('manage_backups.os.remove')
+  unlink_mock = mocker.patch('manage_backups.os.unlink')
 
   # Run method under test
   output, exit_code = auto_clean(args)
@@ -108,7 +153,7 @@ def test_should_not_perform_actions_in_dry_mode(mocker):
   stdout_lines = output.splitlines()
   assert list_backup_files_mock.called
   assert filter_backups_according_to_limits_mock.called
-  assert not remove_mock.called
+  assert not unlink_mock.called
   assert len(stdout_lines) == len(expected_files_for_removal)
   for line in stdout_lines:
     assert line.startswith("Would remove")
@@ -117,24 +162,29 @@ def test_should_not_perform_actions_in_dry_mode(mocker):
 
 def create_entry(args, timestamp):
   sample_filename = "sample_file" + str(timestamp)
-  return {
-    PATH: os.path.join(args.backup_dest_dir, sample_filename),
-    FILENAME: sample_filename,
-    TIMESTAMP: timestamp
-  }
+  return BackupEntry(args.backup_dest_dir, sample_filename, timestamp)
 
 
 def create_args(backup_dest_dir='/media/backups', prefix='test', extension='.tar',
                 daily_backups_max_count=7, weekly_backups_max_count=4,
                 monthly_backups_max_count=6, yearly_backups_max_count=1,
-                dry_mode=False):
+                dry_mode=False, delete_workers=4):
   args = SimpleNamespace()
   args.backup_dest_dir = backup_dest_dir
   args.prefix = prefix
   args.extension = extension
+  args.catalog_file = None
+  args.dedup_store = None
+  args.verify_state_file = None
+  args.max_total_size_mb = None
+  args.min_free_space_mb = None
+  args.policy_file = None
   args.daily_backups_max_count = daily_backups_max_count
   args.weekly_backups_max_count = weekly_backups_max_count
   args.monthly_backups_max_count = monthly_backups_max_count
   args.yearly_backups_max_count = yearly_backups_max_count
   args.dry_mode = dry_mode
+  args.delete_workers = delete_workers
+  args.gentle_delete_rate_mb = None
+  args.gentle_delete_in_background = False
   return args
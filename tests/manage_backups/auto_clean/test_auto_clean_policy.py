@@ -0,0 +1,112 @@
+import json
+import os
+from datetime import datetime, timedelta
+from types import SimpleNamespace
+
+import pytest
+
+import manage_backups
+from manage_backups import auto_clean
+
+
+def test_should_clean_all_backup_sets_scanning_every_directory_once(tmp_path, mocker):
+  """
+  Checks that every backup set gets its own retention, while every directory is listed only once
+  """
+  # Configuration
+  now = datetime(2018, 11, 14, 3, 14, 1)
+  datetime_mock = mocker.patch('manage_backups.datetime')
+  datetime_mock.now = mocker.Mock(return_value=now)
+  datetime_mock.side_effect = datetime
+  (tmp_path / "system").mkdir()
+  (tmp_path / "db").mkdir()
+  for days in range(5):
+    create_backup(tmp_path / "system", "system", ".tar.gz", now - timedelta(days=days))
+    create_backup(tmp_path / "db", "main", ".sql.gz", now - timedelta(days=days))
+    create_backup(tmp_path / "db", "stats", ".sql.gz", now - timedelta(days=days))
+  (tmp_path / "db" / "unrelated.txt").write_text("")
+  args = create_args(tmp_path, {"backup_sets": [
+    {"backup_dest_dir": str(tmp_path / "system"), "prefix": "system", "extension": "tar.gz"},
+    {"backup_dest_dir": str(tmp_path / "db"), "prefix": "main", "extension": "sql.gz", "daily_backups_max_count": 3},
+    {"backup_dest_dir": str(tmp_path / "db"), "prefix": "stats", "extension": ".sql.gz"},
+  ]}, daily_backups_max_count=2)
+  scandir_spy = mocker.spy(manage_backups.os, 'scandir')
+
+  # Run method under test
+  output, exit_code = auto_clean(args)
+
+  # Assertions
+  assert exit_code == 0
+  assert sorted(c[0][0] for c in scandir_spy.call_args_list) == [str(tmp_path / "db"), str(tmp_path / "system")]
+  assert len(os.listdir(str(tmp_path / "system"))) == 2
+  assert len([f for f in os.listdir(str(tmp_path / "db")) if f.startswith("main__")]) == 3
+  assert len([f for f in os.listdir(str(tmp_path / "db")) if f.startswith("stats__")]) == 2
+  assert "unrelated.txt" in os.listdir(str(tmp_path / "db"))
+  stdout_lines = output.splitlines()
+  assert stdout_lines[0] == "Backup set system__*.tar.gz at %s:" % (tmp_path / "system")
+  assert stdout_lines[-1] == "Processed 3 backup sets, removed 8 old backup files, reclaimed 0 bytes."
+
+
+def test_should_report_missing_directory_and_continue(tmp_path, mocker):
+  """
+  Checks that a missing directory of one backup set does not prevent cleanup of other sets
+  """
+  # Configuration
+  (tmp_path / "system").mkdir()
+  create_backup(tmp_path / "system", "system", ".tar", datetime(2018, 11, 1, 3, 14, 1))
+  args = create_args(tmp_path, {"backup_sets": [
+    {"backup_dest_dir": str(tmp_path / "missing"), "prefix": "system", "extension": "tar"},
+    {"backup_dest_dir": str(tmp_path / "system"), "prefix": "system", "extension": "tar"},
+  ]}, dry_mode=True)
+
+  # Run method under test
+  output, exit_code = auto_clean(args)
+
+  # Assertions
+  assert output.splitlines() == [
+    "Path %s is not a directory" % (tmp_path / "missing"),
+    "Backup set system__*.tar at %s:" % (tmp_path / "system"),
+  ]
+  assert exit_code == 1
+
+
+def test_should_reject_unknown_keys(tmp_path):
+  """
+  Checks that a typo at a policy file is not silently ignored
+  """
+  # Configuration
+  args = create_args(tmp_path, {"backup_sets": [
+    {"backup_dest_dir": str(tmp_path), "prefix": "system", "extension": "tar", "daily_max_count": 3},
+  ]})
+
+  # Run method under test and assertions
+  with pytest.raises(ValueError, match="unknown keys: daily_max_count"):
+    auto_clean(args)
+
+
+def create_backup(backup_dir, prefix, extension, time):
+  (backup_dir / ("%s__%s%s" % (prefix, time.strftime('%Y%m%d_%H%M%S'), extension))).write_text("")
+
+
+def create_args(tmp_path, policy, dry_mode=False, daily_backups_max_count=7):
+  policy_file = tmp_path / "policy.json"
+  policy_file.write_text(json.dumps(policy))
+  args = SimpleNamespace()
+  args.backup_dest_dir = None
+  args.prefix = None
+  args.extension = None
+  args.catalog_file = None
+  args.dedup_store = None
+  args.verify_state_file = None
+  args.max_total_size_mb = None
+  args.min_free_space_mb = None
+  args.policy_file = str(policy_file)
+  args.daily_backups_max_count = daily_backups_max_count
+  args.weekly_backups_max_count = 4
+  args.monthly_backups_max_count = 6
+  args.yearly_backups_max_count = 1
+  args.dry_mode = dry_mode
+  args.delete_workers = 4
+  args.gentle_delete_rate_mb = None
+  args.gentle_delete_in_background = False
+  return args
@@ -1,14 +1,13 @@
-import os
-from datetime import datetime
+from datetime import datetime, timedelta
 from types import SimpleNamespace
 
-from manage_backups import PATH, FILENAME, TIMESTAMP
+from manage_backups import BackupEntry
 import manage_backups
 
 
 def test_should_return_limited_number_of_backups(mocker):
   """
-  Checks that method splits list of backups according to time periods
+  Checks that every period keeps no more backups than configured
   """
   args = create_args(daily_backups_max_count=2, weekly_backups_max_count=1,
                      monthly_backups_max_count=1, yearly_backups_max_count=1)
@@ -34,34 +33,19 @@ def test_should_return_limited_number_of_backups(mocker):
 
   # Assertions
   assert len(chosen_backups) == expected_number_of_chosen_backups
-  assert chosen_backups == [
-    {
-      'FILENAME': 'sample_file_20181014_031512',
-      'PATH': '/path/to/backups/sample_file_20181014_031512',
-      'TIMESTAMP': 1539476112.0},
-    {
-      'FILENAME': 'sample_file_20181023_022501',
-      'PATH': '/path/to/backups/sample_file_20181023_022501',
-      'TIMESTAMP': 1540250701.0},
-    {
-      'FILENAME': 'sample_file_20181106_011417',
-      'PATH': '/path/to/backups/sample_file_20181106_011417',
-      'TIMESTAMP': 1541459657.0},
-    {
-      'FILENAME': 'sample_file_20181110_031511',
-      'PATH': '/path/to/backups/sample_file_20181110_031511',
-      'TIMESTAMP': 1541812511.0},
-    {
-      'FILENAME': 'sample_file_20181113_031512',
-      'PATH': '/path/to/backups/sample_file_20181113_031512',
-      'TIMESTAMP': 1542071712.0}
+  assert [backup.filename for backup in chosen_backups] == [
+    'sample_file_20170312_041112',
+    'sample_file_20181014_031512',
+    'sample_file_20181106_011417',
+    'sample_file_20181110_031511',
+    'sample_file_20181113_031512'
   ]
 
 
 # TODO: should work with small list
 def test_should_work_with_small_list(mocker):
   """
-  Checks that method splits list of backups according to time periods
+  Checks that every period keeps no more backups than configured
   """
   args = create_args(daily_backups_max_count=20, weekly_backups_max_count=10,
                      monthly_backups_max_count=10, yearly_backups_max_count=10)
@@ -87,14 +71,69 @@ def test_should_work_with_small_list(mocker):
   assert chosen_backups == list_of_backups
 
 
+def test_should_spread_backups_over_periods(mocker):
+  """
+  Checks that backups are distributed over each period instead of clustering at its recent end
+  """
+  args = create_args(daily_backups_max_count=7, weekly_backups_max_count=4,
+                     monthly_backups_max_count=11, yearly_backups_max_count=2)
+  # Configuration
+  now = datetime(2018, 11, 14, 3, 14, 1)
+  datetime_mock = mocker.patch('manage_backups.datetime')
+  datetime_mock.now = mocker.Mock(return_value=now)
+  # Hourly backups during last 3 years
+  list_of_backups = [create_entry((now - timedelta(hours=hours)).strftime('%Y%m%d_%H%M%S'))
+                     for hours in reversed(range(3 * 365 * 24))]
+
+  # Run method under test
+  chosen_backups = manage_backups._choose_valuable_backups(list_of_backups, args)
+
+  # Assertions
+  assert len(chosen_backups) == 7 + 4 + 11 + 2
+  daily, weekly, monthly, yearly = [chosen_backups[low:high] for low, high in
+                                    manage_backups._split_backups(chosen_backups, now.timestamp())]
+  assert (len(daily), len(weekly), len(monthly), len(yearly)) == (7, 4, 11, 2)
+  # The most recent backup is always kept
+  assert chosen_backups[-1] is list_of_backups[-1]
+  # Daily backups are about a day apart
+  for previous_backup, backup in zip(daily, daily[1:]):
+    assert 23 * 3600 <= backup.timestamp - previous_backup.timestamp <= 25 * 3600
+  # Monthly backups are about a month apart
+  for previous_backup, backup in zip(monthly, monthly[1:]):
+    assert 29 * 24 * 3600 <= backup.timestamp - previous_backup.timestamp <= 32 * 24 * 3600
+  for backup in chosen_backups:
+    assert 0 <= backup.position_rating <= 1
+    assert 0 < backup.overall_rating <= 1
+
+
+def test_should_fill_slots_of_empty_buckets(mocker):
+  """
+  Checks that if backups are missing for a part of a period, slots are given to backups splitting the widest gaps
+  """
+  args = create_args(daily_backups_max_count=3, weekly_backups_max_count=0,
+                     monthly_backups_max_count=0, yearly_backups_max_count=0)
+  # Configuration
+  datetime_mock = mocker.patch('manage_backups.datetime')
+  datetime_mock.now = mocker.Mock(return_value=datetime(2018, 11, 14, 3, 14, 1))
+  list_of_backups = [
+    create_entry("20181113_001000"),
+    create_entry("20181113_061000"),
+    create_entry("20181113_121000"),
+    create_entry("20181113_181000"),
+    create_entry("20181114_001000"),
+  ]
+
+  # Run method under test
+  chosen_backups = manage_backups._choose_valuable_backups(list_of_backups, args)
+
+  # Assertions
+  assert chosen_backups == [list_of_backups[0], list_of_backups[2], list_of_backups[4]]
+
+
 def create_entry(datetime_str):
   timestamp = datetime.strptime(datetime_str, '%Y%m%d_%H%M%S').timestamp()
   sample_filename = "sample_file_" + datetime_str
-  return {
-    PATH: os.path.join("/path/to/backups", sample_filename),
-    FILENAME: sample_filename,
-    TIMESTAMP: timestamp
-  }
+  return BackupEntry("/path/to/backups", sample_filename, timestamp)
 
 
 def create_args(backup_dest_dir='/media/backups', prefix='test', extension='.tar',
@@ -0,0 +1,141 @@
+import os
+from types import SimpleNamespace
+
+import manage_backups
+from manage_backups import auto_clean, BackupEntry, GENTLE_REMOVAL_PREFIX
+
+MB = 1024 * 1024
+
+
+def test_should_shrink_large_file_in_steps(tmp_path, mocker):
+  """
+  Checks that a large file is truncated step by step under the rate budget before it is unlinked
+  """
+  # Configuration
+  backup = tmp_path / "test__20181101_031401.tar"
+  with open(str(backup), 'wb') as f:
+    f.truncate(10 * MB)
+  dir_fd = os.open(str(tmp_path), os.O_RDONLY | os.O_DIRECTORY)
+  throttle = mocker.Mock()
+  ftruncate_spy = mocker.spy(manage_backups.os, 'ftruncate')
+
+  # Run method under test
+  try:
+    size = manage_backups._remove_file_gently(backup.name, dir_fd, throttle, 4 * MB, 1 * MB)
+  finally:
+    os.close(dir_fd)
+
+  # Assertions
+  assert size == 10 * MB
+  assert [c[0][1] for c in ftruncate_spy.call_args_list] == [6 * MB, 2 * MB, 0]
+  assert throttle.consume.call_args_list == [mocker.call(4 * MB), mocker.call(4 * MB), mocker.call(2 * MB)]
+  assert os.listdir(str(tmp_path)) == []
+
+
+def test_should_not_truncate_hard_linked_file(tmp_path, mocker):
+  """
+  Checks that a file having other hard links is just unlinked, so that data visible through other links survives
+  """
+  # Configuration
+  backup = tmp_path / "test__20181101_031401.tar"
+  backup.write_bytes(b"x" * 2048)
+  os.link(str(backup), str(tmp_path / "hardlink"))
+  dir_fd = os.open(str(tmp_path), os.O_RDONLY | os.O_DIRECTORY)
+  throttle = mocker.Mock()
+
+  # Run method under test
+  try:
+    manage_backups._remove_file_gently(backup.name, dir_fd, throttle, 1024, 1024)
+  finally:
+    os.close(dir_fd)
+
+  # Assertions
+  assert not throttle.consume.called
+  assert os.listdir(str(tmp_path)) == ["hardlink"]
+  assert (tmp_path / "hardlink").read_bytes() == b"x" * 2048
+
+
+def test_should_pick_up_interrupted_removals(tmp_path, mocker):
+  """
+  Checks that files left from an interrupted gentle removal are removed, and are never considered to be backups
+  """
+  # Configuration
+  args = create_args(str(tmp_path))
+  (tmp_path / (GENTLE_REMOVAL_PREFIX + "test__20181101_031401.tar")).write_bytes(b"x" * 100)
+  (tmp_path / "test__20181102_031401.tar").write_bytes(b"x" * 100)
+  choose_mock = mocker.patch('manage_backups._choose_valuable_backups', side_effect=lambda backups, args: backups)
+
+  # Run method under test
+  output, exit_code = auto_clean(args)
+
+  # Assertions
+  assert [backup.filename for backup in choose_mock.call_args[0][0]] == ["test__20181102_031401.tar"]
+  assert os.listdir(str(tmp_path)) == ["test__20181102_031401.tar"]
+  assert output.splitlines()[-1] == "Removed 1 old backup files, reclaimed 100 bytes."
+  assert exit_code == 0
+
+
+def test_throttle_should_limit_rate(mocker):
+  """
+  Checks that throttle makes consumers wait according to the budget
+  """
+  # Configuration
+  clock = [1000.0]
+  mocker.patch('manage_backups.time.monotonic', side_effect=lambda: clock[0])
+
+  def sleep_side_effect(seconds):
+    clock[0] += seconds
+
+  sleep_mock = mocker.patch('manage_backups.time.sleep', side_effect=sleep_side_effect)
+  throttle = manage_backups._Throttle(10 * MB)
+
+  # Run method under test
+  for _ in range(4):
+    throttle.consume(5 * MB)
+
+  # Assertions
+  assert sleep_mock.call_args_list == [mocker.call(0.5), mocker.call(0.5), mocker.call(0.5)]
+
+
+def test_should_remove_in_background(mocker):
+  """
+  Checks that in background mode the parent process only reports the child process
+  """
+  # Configuration
+  args = create_args('/media/backups', gentle_delete_in_background=True)
+  backups = [BackupEntry('/media/backups', 'test__20181101_031401.tar', 1541034841.0)]
+  mocker.patch('manage_backups.os.path.isdir', return_value=True)
+  mocker.patch('manage_backups._list_backup_files', return_value=backups)
+  mocker.patch('manage_backups._choose_valuable_backups', return_value=[])
+  mocker.patch('manage_backups._list_unfinished_removals', return_value=[])
+  mocker.patch('manage_backups.os.fork', return_value=4242)
+  remove_mock = mocker.patch('manage_backups._remove_backups')
+
+  # Run method under test
+  output, exit_code = auto_clean(args)
+
+  # Assertions
+  assert output == "Removing 1 old backup files in background process 4242"
+  assert exit_code == 0
+  assert not remove_mock.called
+
+
+def create_args(backup_dest_dir, gentle_delete_in_background=False):
+  args = SimpleNamespace()
+  args.backup_dest_dir = backup_dest_dir
+  args.prefix = 'test'
+  args.extension = '.tar'
+  args.catalog_file = None
+  args.dedup_store = None
+  args.verify_state_file = None
+  args.max_total_size_mb = None
+  args.min_free_space_mb = None
+  args.policy_file = None
+  args.dry_mode = False
+  args.delete_workers = 2
+  args.gentle_delete_rate_mb = 100
+  args.gentle_delete_step_mb = 1
+  args.gentle_delete_min_size_mb = 1
+  args.gentle_delete_in_background = gentle_delete_in_background
+  args.background_log = None
+  return args
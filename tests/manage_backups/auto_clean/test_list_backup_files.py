@@ -1,6 +1,7 @@
 from types import SimpleNamespace
 
 import manage_backups
+from manage_backups import BackupEntry
 
 
 def test_should_build_a_sorted_list(mocker):
@@ -9,38 +10,25 @@ def test_should_build_a_sorted_list(mocker):
   """
   # Configuration
   args = create_args()
-  listdir_mock = mocker.patch('manage_backups.os.listdir')
-  listdir_mock.return_value = [
-    "test_.tar",
-    "test__20191101_031401.tar",
-    "test__20181101_031401.tar",
-    "test_me__20181102_031401.tar",
-    "test__20181102_031401.tar",
-  ]
-  isfile_mock = mocker.patch('manage_backups.os.path.isfile')
-  isfile_mock.return_value = True
+  mock_scandir(mocker, [
+    create_dir_entry(mocker, "test_.tar"),
+    create_dir_entry(mocker, "test__20191101_031401.tar"),
+    create_dir_entry(mocker, "test__20181101_031401.tar"),
+    create_dir_entry(mocker, "test_me__20181102_031401.tar"),
+    create_dir_entry(mocker, "test__20181102_031401.tar"),
+    create_dir_entry(mocker, "test__20181102_031401.tar.part"),
+  ])
 
   # Run method under test
   result = manage_backups._list_backup_files(args)
 
   # Assertions
   assert result == [
-    {
-      'FILENAME': 'test__20181101_031401.tar',
-      'PATH': '/media/backups/test__20181101_031401.tar',
-      'TIMESTAMP': 1541034841.0
-    },
-    {
-      'FILENAME': 'test__20181102_031401.tar',
-      'PATH': '/media/backups/test__20181102_031401.tar',
-      'TIMESTAMP': 1541121241.0
-    },
-    {
-      'FILENAME': 'test__20191101_031401.tar',
-      'PATH': '/media/backups/test__20191101_031401.tar',
-      'TIMESTAMP': 1572570841.0
-    }
+    BackupEntry('/media/backups', 'test__20181101_031401.tar', 1541034841.0),
+    BackupEntry('/media/backups', 'test__20181102_031401.tar', 1541121241.0),
+    BackupEntry('/media/backups', 'test__20191101_031401.tar', 1572570841.0)
   ]
+  assert result[0].path == '/media/backups/test__20181101_031401.tar'
 
 
 def test_should_skip_dirs(mocker):
@@ -48,19 +36,75 @@ def test_should_skip_dirs(mocker):
   Checks that method skips directories even if their names follow the patter
   """
   args = create_args()
-  listdir_mock = mocker.patch('manage_backups.os.listdir')
-  listdir_mock.return_value = [
-    "test__20181101_031401.tar",
-  ]
+  mock_scandir(mocker, [
+    create_dir_entry(mocker, "test__20181101_031401.tar", is_file=False),
+  ])
+
+  # Run method under test
+  result = manage_backups._list_backup_files(args)
+
+  # Assertions
+  assert result == []
 
-  isfile_mock = mocker.patch('manage_backups.os.path.isfile')
-  isfile_mock.return_value = False
+
+def test_should_not_check_type_of_unrelated_files(mocker):
+  """
+  Checks that file type is examined only for entries with matching names
+  """
+  args = create_args()
+  unrelated_entry = create_dir_entry(mocker, "unrelated.txt")
+  mock_scandir(mocker, [unrelated_entry])
 
   # Run method under test
   result = manage_backups._list_backup_files(args)
 
   # Assertions
   assert result == []
+  assert not unrelated_entry.is_file.called
+
+
+def test_should_recognize_incremental_backups(mocker):
+  """
+  Checks that incremental backups of the backup set are listed and flagged
+  """
+  args = create_args()
+  mock_scandir(mocker, [
+    create_dir_entry(mocker, "test__20181102_031401.incremental.tar"),
+    create_dir_entry(mocker, "test__20181101_031401.tar"),
+    create_dir_entry(mocker, "test__20181103_031401.incremental.tar.gz"),
+  ])
+
+  # Run method under test
+  result = manage_backups._list_backup_files(args)
+
+  # Assertions
+  assert [(backup.filename, backup.incremental) for backup in result] == [
+    ('test__20181101_031401.tar', False),
+    ('test__20181102_031401.incremental.tar', True),
+  ]
+
+
+def test_should_decode_timestamps_like_strptime():
+  """
+  Checks that the fast timestamp decoding gives the same results as datetime.strptime
+  """
+  for date_str in ["20181101_031401", "20180325_025959", "20181028_035959", "20201231_235959", "20000101_000000"]:
+    expected = manage_backups.datetime.strptime(date_str, manage_backups.DATE_STRING_FORMAT).timestamp()
+    assert manage_backups._decode_timestamp(date_str) == expected
+
+
+def create_dir_entry(mocker, name, is_file=True):
+  dir_entry = mocker.Mock()
+  dir_entry.name = name
+  dir_entry.path = "/media/backups/" + name
+  dir_entry.is_file.return_value = is_file
+  return dir_entry
+
+
+def mock_scandir(mocker, dir_entries):
+  scandir_mock = mocker.patch('manage_backups.os.scandir')
+  scandir_mock.return_value.__enter__.return_value = iter(dir_entries)
+  return scandir_mock
 
 
 def create_args(backup_dest_dir='/media/backups', prefix='test', extension='.tar'):
@@ -68,4 +112,7 @@ def create_args(backup_dest_dir='/media/backups', prefix='test', extension='.tar
   args.backup_dest_dir = backup_dest_dir
   args.prefix = prefix
   args.extension = extension
+  args.catalog_file = None
+  args.max_total_size_mb = None
+  args.min_free_space_mb = None
   return args
@@ -0,0 +1,71 @@
+from datetime import datetime
+from types import SimpleNamespace
+
+from manage_backups import BackupEntry
+import manage_backups
+
+
+def test_should_keep_backups_that_preserved_incremental_backups_depend_on(mocker):
+  """
+  Checks that a full backup and incremental backups are kept while a newer incremental backup of the same chain
+  is preserved, and that older chains are removed as usual
+  """
+  # Configuration
+  args = create_args()
+  datetime_mock = mocker.patch('manage_backups.datetime')
+  datetime_mock.now = mocker.Mock(return_value=datetime(2018, 11, 14, 3, 14, 1))
+  list_of_backups = [
+    create_entry("20181108_031512"),
+    create_entry("20181109_031512", incremental=True),
+    create_entry("20181110_031512"),
+    create_entry("20181111_031512", incremental=True),
+    create_entry("20181112_031512", incremental=True),
+    create_entry("20181113_031512", incremental=True),
+  ]
+
+  # Run method under test
+  backups_to_remove = manage_backups._choose_backups_to_remove(list_of_backups, args)
+
+  # Assertions
+  assert [backup.filename for backup in backups_to_remove] == [
+    'sample_file_20181108_031512',
+    'sample_file_20181109_031512',
+  ]
+
+
+def test_should_not_keep_backups_of_removed_incremental_backups():
+  """
+  Checks that nothing is added to preserved backups if only full backups are preserved
+  """
+  # Configuration
+  list_of_backups = [
+    create_entry("20181110_031512"),
+    create_entry("20181111_031512", incremental=True),
+    create_entry("20181112_031512"),
+  ]
+  filenames_to_preserve = {'sample_file_20181112_031512'}
+
+  # Run method under test
+  manage_backups._preserve_chain_dependencies(list_of_backups, filenames_to_preserve)
+
+  # Assertions
+  assert filenames_to_preserve == {'sample_file_20181112_031512'}
+
+
+def create_entry(datetime_str, incremental=False):
+  timestamp = datetime.strptime(datetime_str, '%Y%m%d_%H%M%S').timestamp()
+  return BackupEntry("/path/to/backups", "sample_file_" + datetime_str, timestamp, incremental=incremental)
+
+
+def create_args():
+  args = SimpleNamespace()
+  args.backup_dest_dir = '/path/to/backups'
+  args.prefix = 'sample_file'
+  args.extension = ''
+  args.daily_backups_max_count = 1
+  args.weekly_backups_max_count = 0
+  args.monthly_backups_max_count = 0
+  args.yearly_backups_max_count = 0
+  args.max_total_size_mb = None
+  args.min_free_space_mb = None
+  return args
@@ -1,7 +1,6 @@
-import os
 from datetime import datetime
 
-from manage_backups import PATH, FILENAME, TIMESTAMP
+from manage_backups import BackupEntry
 import manage_backups
 
 
@@ -32,20 +31,20 @@ def test_should_split_backups_by_periods(mocker):
   backups = expected_yearly_backups + expected_monthly_backups + expected_weekly_backups + expected_daily_backups
 
   # Run method under test
-  daily_backups, weekly_backups, monthly_backups, yearly_backups = manage_backups._split_backups(backups)
+  daily_range, weekly_range, monthly_range, yearly_range = manage_backups._split_backups(backups)
 
   # Assertions
-  assert daily_backups == expected_daily_backups
-  assert weekly_backups == expected_weekly_backups
-  assert monthly_backups == expected_monthly_backups
-  assert yearly_backups == expected_yearly_backups
+  assert daily_range == (6, 8)
+  assert weekly_range == (4, 6)
+  assert monthly_range == (1, 4)
+  assert yearly_range == (0, 1)
+  assert backups[slice(*daily_range)] == expected_daily_backups
+  assert backups[slice(*weekly_range)] == expected_weekly_backups
+  assert backups[slice(*monthly_range)] == expected_monthly_backups
+  assert backups[slice(*yearly_range)] == expected_yearly_backups
 
 
 def create_entry(datetime_str):
   timestamp = datetime.strptime(datetime_str, '%Y%m%d_%H%M%S').timestamp()
   sample_filename = "sample_file_" + datetime_str
-  return {
-    PATH: os.path.join("/path/to/backups", sample_filename),
-    FILENAME: sample_filename,
-    TIMESTAMP: timestamp
-  }
+  return BackupEntry("/path/to/backups", sample_filename, timestamp)
@@ -0,0 +1,180 @@
+import json
+import os
+from types import SimpleNamespace
+
+import pytest
+
+import manage_backups
+
+
+def test_should_list_regular_files_on_first_sync(tmp_path):
+  """
+  Checks that an empty catalog is filled from the directory contents with file sizes, and directories are not listed
+  as files
+  """
+  # Configuration
+  args = create_args(tmp_path)
+  (tmp_path / "backups" / "test__20181101_031401.tar").write_text("data")
+  (tmp_path / "backups" / "test__20181102_031401.tar").mkdir()
+
+  # Run method under test
+  files = manage_backups._sync_catalog(args)
+
+  # Assertions
+  assert files == {"test__20181101_031401.tar": 4}
+
+
+def test_should_not_list_directory_if_mtime_did_not_change(tmp_path, mocker):
+  """
+  Checks that directory is not rescanned while its modification time stays the same
+  """
+  # Configuration
+  args = create_args(tmp_path)
+  (tmp_path / "backups" / "test__20181101_031401.tar").write_text("")
+  manage_backups._sync_catalog(args)
+  scandir_spy = mocker.spy(manage_backups.os, 'scandir')
+
+  # Run method under test
+  files = manage_backups._sync_catalog(args)
+
+  # Assertions
+  assert files == {"test__20181101_031401.tar": 0}
+  assert not scandir_spy.called
+
+
+def test_should_not_list_directory_if_catalog_is_inside_it(tmp_path, mocker):
+  """
+  Checks that appending to a catalog placed at the backup directory does not make the directory look changed
+  """
+  # Configuration
+  args = create_args(tmp_path)
+  args.catalog_file = str(tmp_path / "backups" / ".catalog")
+  (tmp_path / "backups" / "test__20181101_031401.tar").write_text("")
+  manage_backups._sync_catalog(args)
+  manage_backups._update_catalog(args, [])
+  scandir_spy = mocker.spy(manage_backups.os, 'scandir')
+
+  # Run method under test
+  files = manage_backups._sync_catalog(args)
+
+  # Assertions
+  assert set(files) == {"test__20181101_031401.tar", ".catalog"}
+  assert not scandir_spy.called
+
+
+def test_should_examine_only_changed_entries(tmp_path):
+  """
+  Checks that after a change of the directory, only changed entries are recorded to the catalog
+  """
+  # Configuration
+  args = create_args(tmp_path)
+  (tmp_path / "backups" / "test__20181101_031401.tar").write_text("")
+  (tmp_path / "backups" / "test__20181102_031401.tar").write_text("")
+  manage_backups._sync_catalog(args)
+  os.remove(str(tmp_path / "backups" / "test__20181101_031401.tar"))
+  (tmp_path / "backups" / "test__20181103_031401.tar").write_text("")
+  with open(args.catalog_file) as catalog:
+    records_before = len(catalog.readlines())
+
+  # Run method under test
+  files = manage_backups._sync_catalog(args)
+
+  # Assertions
+  assert files == {"test__20181102_031401.tar": 0, "test__20181103_031401.tar": 0}
+  with open(args.catalog_file) as catalog:
+    new_records = [json.loads(line) for line in catalog.readlines()[records_before:]]
+  assert new_records[:-1] == [
+    {"op": "add", "name": "test__20181103_031401.tar", "size": 0},
+    {"op": "remove", "name": "test__20181101_031401.tar"},
+  ]
+  assert new_records[-1]["op"] == "sync"
+
+
+def test_should_stay_in_sync_after_own_removals(tmp_path, mocker):
+  """
+  Checks that files removed by the script are dropped from the catalog without rescanning the directory
+  """
+  # Configuration
+  args = create_args(tmp_path)
+  (tmp_path / "backups" / "test__20181101_031401.tar").write_text("")
+  (tmp_path / "backups" / "test__20181102_031401.tar").write_text("")
+  manage_backups._sync_catalog(args)
+  dir_mtime_ns = os.stat(args.backup_dest_dir).st_mtime_ns
+  os.remove(str(tmp_path / "backups" / "test__20181101_031401.tar"))
+
+  # Run method under test
+  manage_backups._update_catalog(args, ["test__20181101_031401.tar"], dir_mtime_ns)
+
+  # Assertions
+  scandir_spy = mocker.spy(manage_backups.os, 'scandir')
+  assert manage_backups._sync_catalog(args) == {"test__20181102_031401.tar": 0}
+  assert not scandir_spy.called
+
+
+def test_should_compact_redundant_catalog(tmp_path):
+  """
+  Checks that the catalog file is rewritten once it accumulates too many stale records
+  """
+  # Configuration
+  args = create_args(tmp_path)
+  backup = tmp_path / "backups" / "test__20181101_031401.tar"
+  for _ in range(20):
+    backup.write_text("")
+    manage_backups._sync_catalog(args)
+    os.remove(str(backup))
+    manage_backups._sync_catalog(args)
+
+  # Run method under test
+  files = manage_backups._sync_catalog(args)
+
+  # Assertions
+  assert files == {}
+  with open(args.catalog_file) as catalog:
+    assert len(catalog.readlines()) <= manage_backups.CATALOG_MIN_TAIL_RECORDS + 2
+
+
+def test_should_take_current_sizes_for_size_budget(tmp_path):
+  """
+  Checks that with a size budget, sizes of files that grew after they were recorded to the catalog are current
+  """
+  # Configuration
+  args = create_args(tmp_path)
+  args.max_total_size_mb = 1
+  args.min_free_space_mb = None
+  backup = tmp_path / "backups" / "test__20181101_031401.tar"
+  backup.write_text("partial")
+  manage_backups._sync_catalog(args)
+  with open(str(backup), "a") as backup_file:
+    backup_file.write(" and the rest")
+
+  # Run method under test
+  backups = manage_backups._list_backup_files(args)
+
+  # Assertions
+  assert manage_backups._sync_catalog(args) == {"test__20181101_031401.tar": len("partial")}
+  assert [backup.size for backup in backups] == [len("partial and the rest")]
+
+
+def test_should_refuse_catalog_of_another_directory(tmp_path):
+  """
+  Checks that a catalog can not be silently reused for a different directory
+  """
+  # Configuration
+  args = create_args(tmp_path)
+  manage_backups._sync_catalog(args)
+  (tmp_path / "other").mkdir()
+  args.backup_dest_dir = str(tmp_path / "other")
+
+  # Run method under test and assertions
+  with pytest.raises(ValueError, match="belongs to directory"):
+    manage_backups._sync_catalog(args)
+
+
+def create_args(tmp_path, prefix='test', extension='.tar'):
+  (tmp_path / "backups").mkdir(exist_ok=True)
+  args = SimpleNamespace()
+  args.backup_dest_dir = str(tmp_path / "backups")
+  args.prefix = prefix
+  args.extension = extension
+  args.catalog_file = str(tmp_path / "catalog")
+  return args
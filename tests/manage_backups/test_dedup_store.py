@@ -0,0 +1,157 @@
+import io
+import os
+import random
+import tarfile
+from types import SimpleNamespace
+from unittest import mock
+
+import manage_backups
+from manage_backups import cat_backup, run_backup
+
+
+def test_should_store_only_new_chunks(tmp_path):
+  """
+  Checks that a backup of slightly changed data adds only a small share of chunks to the store, and both
+  backups can be read back
+  """
+  # Configuration
+  content = random.Random(1).getrandbits(8 * 1024 * 1024).to_bytes(1024 * 1024, "little")
+  (tmp_path / "source").mkdir()
+  (tmp_path / "source" / "data.bin").write_bytes(content)
+  run_backup(create_args(tmp_path, prefix="first"))
+  stored_bytes = packs_size(tmp_path)
+  changed_content = content[:500000] + b"changed" + content[500007:]
+  (tmp_path / "source" / "data.bin").write_bytes(changed_content)
+
+  # Run method under test
+  output, exit_code = run_backup(create_args(tmp_path, prefix="second"))
+
+  # Assertions
+  assert exit_code == 0
+  assert packs_size(tmp_path) - stored_bytes < stored_bytes // 10
+  assert read_backup(tmp_path, "first", "data.bin") == content
+  assert read_backup(tmp_path, "second", "data.bin") == changed_content
+
+
+def test_should_collect_chunks_of_removed_manifests(tmp_path):
+  """
+  Checks that chunks referenced only by removed manifests are dropped, and remaining backups stay readable
+  """
+  # Configuration
+  (tmp_path / "source").mkdir()
+  (tmp_path / "source" / "data.bin").write_bytes(os.urandom(256 * 1024))
+  run_backup(create_args(tmp_path, prefix="first"))
+  (tmp_path / "source" / "data.bin").write_bytes(b"small")
+  run_backup(create_args(tmp_path, prefix="second"))
+  removed_path = str(find_backup(tmp_path, "first"))
+  os.remove(removed_path)
+
+  # Run method under test
+  output = manage_backups._collect_dedup_garbage(str(tmp_path / "store"), [removed_path])
+
+  # Assertions
+  assert output.startswith("Removed ")
+  assert packs_size(tmp_path) < 64 * 1024
+  assert read_backup(tmp_path, "second", "data.bin") == b"small"
+
+
+def test_should_keep_chunks_of_manifests_at_missing_directory(tmp_path):
+  """
+  Checks that chunks of a backup set, whose directory is not reachable at the moment, are not dropped
+  """
+  # Configuration
+  (tmp_path / "source").mkdir()
+  (tmp_path / "source" / "data.bin").write_bytes(os.urandom(256 * 1024))
+  run_backup(create_args(tmp_path, prefix="first"))
+  (tmp_path / "source" / "data.bin").write_bytes(b"small")
+  other_args = create_args(tmp_path, prefix="second")
+  other_args.backup_dest_dir = str(tmp_path / "other")
+  run_backup(other_args)
+  removed_path = str(find_backup(tmp_path, "first"))
+  os.remove(removed_path)
+  os.rename(str(tmp_path / "other"), str(tmp_path / "unmounted"))
+  stored_bytes = packs_size(tmp_path)
+
+  # Run method under test
+  output = manage_backups._collect_dedup_garbage(str(tmp_path / "store"), [removed_path])
+
+  # Assertions
+  assert output.startswith("Not collecting garbage ")
+  assert packs_size(tmp_path) == stored_bytes
+  os.rename(str(tmp_path / "unmounted"), str(tmp_path / "other"))
+  assert read_backup(tmp_path, "second", "data.bin", backups_dir="other") == b"small"
+  with open(str(tmp_path / "store" / "roots")) as roots:
+    assert roots.read().splitlines() == [str(find_backup(tmp_path, "second", backups_dir="other"))]
+
+
+def test_should_find_same_boundaries_in_segments():
+  """
+  Checks that boundaries found segment by segment with a context are the same as the ones found at once
+  """
+  # Configuration
+  data = random.Random(2).getrandbits(8 * 65536).to_bytes(65536, "little")
+
+  # Run method under test
+  segmented = []
+  for start in range(0, len(data), 1000):
+    context_start = max(start - manage_backups.DEDUP_HASH_TAPS[-1] - 1, 0)
+    segmented.extend(start + offset for offset in manage_backups._find_chunk_boundaries(
+      data[context_start:start + 1000], start - context_start, 9))
+
+  # Assertions
+  assert segmented == manage_backups._find_chunk_boundaries(data, 0, 9)
+  assert segmented
+
+
+def packs_size(tmp_path):
+  packs_dir = tmp_path / "store" / "packs"
+  return sum(os.path.getsize(str(packs_dir / name)) for name in os.listdir(str(packs_dir)))
+
+
+def find_backup(tmp_path, prefix, backups_dir="backups"):
+  return next((tmp_path / backups_dir).glob("%s__*.tar.manifest" % prefix))
+
+
+def read_backup(tmp_path, prefix, name, backups_dir="backups"):
+  args = SimpleNamespace(backup_file=str(find_backup(tmp_path, prefix, backups_dir)), dedup_store=None)
+  output = SimpleNamespace(buffer=io.BytesIO())
+  with mock.patch('manage_backups.sys.stdout', output):
+    cat_backup(args)
+  output.buffer.seek(0)
+  with tarfile.open(fileobj=output.buffer, mode="r|") as tar:
+    for member in tar:
+      if member.name.endswith("/" + name):
+        return tar.extractfile(member).read()
+  return None
+
+
+def create_args(tmp_path, prefix='test', extension='.tar.manifest'):
+  args = SimpleNamespace()
+  args.backup_dest_dir = str(tmp_path / "backups")
+  args.prefix = prefix
+  args.extension = extension
+  args.catalog_file = None
+  args.dedup_store = str(tmp_path / "store")
+  args.verify_state_file = None
+  args.dedup_chunk_kb = 16
+  args.policy_file = None
+  args.source_dir = str(tmp_path / "source")
+  args.compress_workers = 2
+  args.compress_level = 5
+  args.compress_chunk_mb = 1
+  args.write_buffer_mb = 1
+  args.checksum_block_mb = 1
+  args.walk_workers = 2
+  args.change_index_file = None
+  args.max_incremental_chain = 6
+  args.dry_mode = False
+  args.max_total_size_mb = None
+  args.min_free_space_mb = None
+  args.delete_workers = 4
+  args.gentle_delete_rate_mb = None
+  args.gentle_delete_in_background = False
+  args.daily_backups_max_count = 5
+  args.weekly_backups_max_count = 3
+  args.monthly_backups_max_count = 6
+  args.yearly_backups_max_count = 0
+  return args
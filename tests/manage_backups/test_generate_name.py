@@ -113,6 +113,7 @@ def create_args(backup_dest_dir='/media/backups', prefix='test', extension='.tar
   args.backup_dest_dir = backup_dest_dir
   args.prefix = prefix
   args.extension = extension
+  args.catalog_file = None
   return args
 
 
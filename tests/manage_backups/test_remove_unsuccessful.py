@@ -118,5 +118,7 @@ def create_args(backup_dest_dir='/media/backups', prefix='test', extension='.tar
   args.backup_dest_dir = backup_dest_dir
   args.prefix = prefix
   args.extension = extension
+  args.catalog_file = None
+  args.dedup_store = None
   args.remove_file = '/media/backups/test__20181101_031401.tar'
   return args
@@ -0,0 +1,165 @@
+import concurrent.futures
+import gzip
+import hashlib
+import json
+import os
+import tarfile
+from types import SimpleNamespace
+
+import manage_backups
+from manage_backups import run_backup
+
+
+def test_should_archive_source_dir(tmp_path):
+  """
+  Checks that the source directory is archived into a new backup file that is readable as a gzipped tar archive
+  """
+  # Configuration
+  args = create_args(tmp_path)
+  (tmp_path / "source" / "etc").mkdir(parents=True)
+  (tmp_path / "source" / "etc" / "hostname").write_text("server\n")
+  large_content = os.urandom(1024 * 1024) + bytes(2 * 1024 * 1024)
+  (tmp_path / "source" / "large.bin").write_bytes(large_content)
+
+  # Run method under test
+  output, exit_code = run_backup(args)
+
+  # Assertions
+  assert exit_code == 0
+  assert output.startswith("Created full backup %s" % (tmp_path / "backups"))
+  backup_files = sorted(os.listdir(str(tmp_path / "backups")))
+  assert len(backup_files) == 2
+  assert backup_files[1] == backup_files[0] + ".checksums"
+  source_name = str(tmp_path / "source").lstrip("/")
+  with tarfile.open(str(tmp_path / "backups" / backup_files[0]), "r:gz") as tar:
+    assert tar.extractfile(source_name + "/etc/hostname").read() == b"server\n"
+    assert tar.extractfile(source_name + "/large.bin").read() == large_content
+  with open(str(tmp_path / "backups" / backup_files[0]), "rb") as backup:
+    content = backup.read()
+  with open(str(tmp_path / "backups" / backup_files[1])) as sidecar:
+    checksums = json.load(sidecar)
+  assert checksums["file"] == backup_files[0]
+  assert checksums["size"] == len(content)
+  assert checksums["sha256"] == hashlib.sha256(content).hexdigest()
+  block_size = checksums["block_size"]
+  assert checksums["block_sha256"] == [hashlib.sha256(content[offset:offset + block_size]).hexdigest()
+                                       for offset in range(0, len(content), block_size)]
+
+
+def test_should_remove_backup_file_if_archiving_fails(tmp_path, mocker):
+  """
+  Checks that a partially written backup file is removed if archiving fails
+  """
+  # Configuration
+  args = create_args(tmp_path)
+  (tmp_path / "source").mkdir()
+  mocker.patch('manage_backups.tarfile.open', side_effect=OSError("No space left on device"))
+
+  # Run method under test
+  output, exit_code = run_backup(args)
+
+  # Assertions
+  assert exit_code == 1
+  assert output.startswith("Failed to archive %s" % args.source_dir)
+  assert os.listdir(str(tmp_path / "backups")) == []
+
+
+def test_should_archive_only_changes_since_previous_backup(tmp_path):
+  """
+  Checks that with a change index, the second backup is an incremental one that holds only new and changed
+  entries, and lists deleted ones
+  """
+  # Configuration
+  args = create_args(tmp_path)
+  args.change_index_file = str(tmp_path / "change_index")
+  (tmp_path / "source" / "etc").mkdir(parents=True)
+  (tmp_path / "source" / "etc" / "hostname").write_text("server\n")
+  (tmp_path / "source" / "etc" / "hosts").write_text("127.0.0.1 localhost\n")
+  (tmp_path / "source" / "etc" / "motd").write_text("welcome\n")
+  run_backup(args)
+  (tmp_path / "source" / "etc" / "hosts").write_text("127.0.0.1 localhost server\n")
+  (tmp_path / "source" / "etc" / "motd").unlink()
+  (tmp_path / "source" / "etc" / "resolv.conf").write_text("nameserver 127.0.0.1\n")
+
+  # Run method under test
+  output, exit_code = run_backup(args)
+
+  # Assertions
+  assert exit_code == 0
+  assert output.startswith("Created incremental backup")
+  backup_files = sorted(filename for filename in os.listdir(str(tmp_path / "backups"))
+                        if not filename.endswith(".checksums"))
+  assert len(backup_files) == 2
+  incremental_files = [filename for filename in backup_files if ".incremental.tar.gz" in filename]
+  assert len(incremental_files) == 1
+  source_name = str(tmp_path / "source").lstrip("/")
+  with tarfile.open(str(tmp_path / "backups" / incremental_files[0]), "r:gz") as tar:
+    assert sorted(tar.getnames()) == [
+      manage_backups.DELETED_PATHS_MEMBER,
+      source_name + "/etc",
+      source_name + "/etc/hosts",
+      source_name + "/etc/resolv.conf",
+    ]
+    deleted = tar.extractfile(manage_backups.DELETED_PATHS_MEMBER).read()
+  assert deleted == (source_name + "/etc/motd\0").encode()
+
+
+def test_should_write_members_in_order_in_whole_buffers(tmp_path, mocker):
+  """
+  Checks that chunks compressed concurrently are written in order, and all writes but the last one are multiples
+  of the write buffer size
+  """
+  # Configuration
+  path = str(tmp_path / "archive.gz")
+  data = b"".join(b"line %d\n" % i for i in range(5000))
+  write_sizes = []
+  real_write = os.write
+  mocker.patch('manage_backups.os.write', side_effect=lambda fd, data: write_sizes.append(len(data)) or
+               real_write(fd, data))
+  fd = os.open(path, os.O_WRONLY | os.O_CREAT)
+
+  # Run method under test
+  with concurrent.futures.ThreadPoolExecutor(max_workers=3) as executor:
+    writer = manage_backups._ParallelGzipWriter(manage_backups._ChecksumOutput(fd, 4096), executor, 3, 5, 1000, 512)
+    for offset in range(0, len(data), 300):
+      writer.write(data[offset:offset + 300])
+    writer.close()
+  os.close(fd)
+
+  # Assertions
+  with open(path, "rb") as archive:
+    assert gzip.decompress(archive.read()) == data
+  assert all(size % 512 == 0 for size in write_sizes[:-1])
+  assert writer.bytes_in == len(data)
+  assert writer.bytes_out == os.path.getsize(path)
+
+
+def create_args(tmp_path, prefix='test', extension='.tar.gz'):
+  args = SimpleNamespace()
+  args.backup_dest_dir = str(tmp_path / "backups")
+  args.prefix = prefix
+  args.extension = extension
+  args.catalog_file = None
+  args.dedup_store = None
+  args.verify_state_file = None
+  args.policy_file = None
+  args.source_dir = str(tmp_path / "source")
+  args.compress_workers = 2
+  args.compress_level = 5
+  args.compress_chunk_mb = 1
+  args.write_buffer_mb = 1
+  args.checksum_block_mb = 1
+  args.walk_workers = 2
+  args.change_index_file = None
+  args.max_incremental_chain = 6
+  args.dry_mode = False
+  args.max_total_size_mb = None
+  args.min_free_space_mb = None
+  args.delete_workers = 4
+  args.gentle_delete_rate_mb = None
+  args.gentle_delete_in_background = False
+  args.daily_backups_max_count = 5
+  args.weekly_backups_max_count = 3
+  args.monthly_backups_max_count = 6
+  args.yearly_backups_max_count = 0
+  return args
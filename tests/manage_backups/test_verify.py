@@ -0,0 +1,194 @@
+import errno
+import json
+import os
+from types import SimpleNamespace
+
+import manage_backups
+from manage_backups import verify
+
+
+def test_should_verify_backups_and_report_corrupt_ones(tmp_path):
+  """
+  Checks that intact backups pass verification, and a backup with a flipped byte is reported as corrupt
+  """
+  # Configuration
+  args = create_args(tmp_path)
+  create_backup(tmp_path, "test__20181101_031401.tar", os.urandom(5000))
+  create_backup(tmp_path, "test__20181102_031401.tar", os.urandom(5000))
+  corrupt_path = str(tmp_path / "backups" / "test__20181102_031401.tar")
+  with open(corrupt_path, "r+b") as backup:
+    backup.seek(2500)
+    byte = backup.read(1)
+    backup.seek(2500)
+    backup.write(bytes([byte[0] ^ 1]))
+
+  # Run method under test
+  output, exit_code = verify(args)
+
+  # Assertions
+  assert exit_code == 1
+  stdout_lines = output.splitlines()
+  assert "Verified backup %s" % (tmp_path / "backups" / "test__20181101_031401.tar") in stdout_lines
+  assert "Backup %s is corrupt: block 2 (bytes 2048-3071) does not match its checksum" % corrupt_path in stdout_lines
+  assert stdout_lines[-1] == "Verified 1 backups, 1 corrupt, 0 unverifiable, 0 failed, 0 not finished."
+  with open(args.verify_state_file) as state_file:
+    assert json.load(state_file)[corrupt_path]["status"] == "corrupt"
+
+
+def test_should_resume_partial_verification(tmp_path):
+  """
+  Checks that verification continues from the saved offset, and saves its progress when the time is over
+  """
+  # Configuration
+  create_backup(tmp_path, "test__20181101_031401.tar", os.urandom(5000))
+  path = str(tmp_path / "backups" / "test__20181101_031401.tar")
+  file_stat = os.stat(path)
+  # Damage a block that is already verified, keeping the modification time
+  with open(path, "r+b") as backup:
+    backup.write(b"damaged")
+  os.utime(path, ns=(file_stat.st_atime_ns, file_stat.st_mtime_ns))
+  record = {"size": file_stat.st_size, "mtime_ns": file_stat.st_mtime_ns, "offset": 3072, "verified_at": None,
+            "status": "partial", "error": None}
+  backup = manage_backups.BackupEntry(str(tmp_path / "backups"), "test__20181101_031401.tar", 0)
+  checkpoints = []
+
+  # Run method under test
+  stopped_record = manage_backups._verify_backup(backup, None, None, None, 0, checkpoints.append)
+  resumed_record = manage_backups._verify_backup(backup, record, None, None, None, checkpoints.append)
+
+  # Assertions
+  assert (stopped_record["status"], stopped_record["offset"]) == ("partial", 0)
+  assert (resumed_record["status"], resumed_record["offset"]) == ("ok", 5000)
+  assert checkpoints == [stopped_record, resumed_record]
+
+
+def test_should_keep_corrupt_backups_out_of_retention(tmp_path):
+  """
+  Checks that auto-clean neither removes nor counts backups found corrupt
+  """
+  # Configuration
+  args = create_args(tmp_path)
+  args.weekly_backups_max_count = 0
+  args.monthly_backups_max_count = 0
+  args.yearly_backups_max_count = 1
+  (tmp_path / "backups").mkdir()
+  for name in ("test__20181101_031401.tar", "test__20181102_031401.tar"):
+    (tmp_path / "backups" / name).write_text("")
+  corrupt_path = str(tmp_path / "backups" / "test__20181102_031401.tar")
+  manage_backups._write_verify_state(args.verify_state_file, {corrupt_path: {"status": "corrupt", "error": "bad"}})
+
+  # Run method under test
+  output, exit_code = manage_backups.auto_clean(args)
+
+  # Assertions
+  assert output.splitlines() == ["Backup test__20181102_031401.tar is corrupt (bad), keeping it for inspection"]
+  assert exit_code == 0
+
+
+def test_should_skip_backup_removed_during_verification(tmp_path, mocker):
+  """
+  Checks that a backup removed after it was listed is skipped and forgotten, and other backups are verified
+  """
+  # Configuration
+  args = create_args(tmp_path)
+  create_backup(tmp_path, "test__20181101_031401.tar", os.urandom(5000))
+  create_backup(tmp_path, "test__20181102_031401.tar", os.urandom(5000))
+  removed_path = str(tmp_path / "backups" / "test__20181101_031401.tar")
+  list_backup_files = manage_backups._list_backup_files
+
+  def list_and_remove(set_args):
+    backups = list_backup_files(set_args)
+    os.remove(removed_path)
+    return backups
+
+  mocker.patch('manage_backups._list_backup_files', side_effect=list_and_remove)
+
+  # Run method under test
+  output, exit_code = verify(args)
+
+  # Assertions
+  assert exit_code == 0
+  assert "Backup %s is gone, skipping it" % removed_path in output.splitlines()
+  assert output.splitlines()[-1] == "Verified 1 backups, 0 corrupt, 0 unverifiable, 0 failed, 0 not finished."
+  with open(args.verify_state_file) as state_file:
+    assert removed_path not in json.load(state_file)
+
+
+def test_should_not_take_unreadable_backup_for_corrupt(tmp_path, mocker):
+  """
+  Checks that a backup that can not be opened gets the "error" status, is retried by the next run, and is not
+  kept out of retention as corrupt
+  """
+  # Configuration
+  args = create_args(tmp_path)
+  create_backup(tmp_path, "test__20181101_031401.tar", os.urandom(5000))
+  path = str(tmp_path / "backups" / "test__20181101_031401.tar")
+  real_open = os.open
+
+  def open_denied(file, flags):
+    if file == path:
+      raise PermissionError(errno.EACCES, "Permission denied", file)
+    return real_open(file, flags)
+
+  mocker.patch('manage_backups.os.open', side_effect=open_denied)
+
+  # Run method under test
+  output, exit_code = verify(args)
+
+  # Assertions
+  assert exit_code == 1
+  assert output.splitlines()[-1] == "Verified 0 backups, 0 corrupt, 0 unverifiable, 1 failed, 0 not finished."
+  with open(args.verify_state_file) as state_file:
+    assert json.load(state_file)[path]["status"] == "error"
+  assert manage_backups._exclude_corrupt_backups(args, manage_backups._list_backup_files(args), []) != []
+
+
+def test_should_take_backup_with_disk_errors_for_corrupt(tmp_path, mocker):
+  """
+  Checks that an I/O error of the disk makes a backup corrupt
+  """
+  # Configuration
+  args = create_args(tmp_path)
+  create_backup(tmp_path, "test__20181101_031401.tar", os.urandom(5000))
+  mocker.patch('manage_backups.os.readv', side_effect=OSError(errno.EIO, "Input/output error"))
+
+  # Run method under test
+  output, exit_code = verify(args)
+
+  # Assertions
+  assert exit_code == 1
+  assert output.splitlines()[-1] == "Verified 0 backups, 1 corrupt, 0 unverifiable, 0 failed, 0 not finished."
+
+
+def create_backup(tmp_path, name, content, block_size=1024):
+  (tmp_path / "backups").mkdir(exist_ok=True)
+  path = str(tmp_path / "backups" / name)
+  fd = os.open(path, os.O_WRONLY | os.O_CREAT)
+  try:
+    output = manage_backups._ChecksumOutput(fd, block_size)
+    output.write(content)
+  finally:
+    os.close(fd)
+  manage_backups._write_checksum_sidecar(path, output)
+
+
+def create_args(tmp_path, prefix='test', extension='.tar'):
+  args = SimpleNamespace()
+  args.backup_dest_dir = str(tmp_path / "backups")
+  args.prefix = prefix
+  args.extension = extension
+  args.catalog_file = None
+  args.dedup_store = None
+  args.policy_file = None
+  args.verify_state_file = str(tmp_path / "verify_state")
+  args.verify_rate_mb = 100
+  args.verify_iops = None
+  args.verify_max_seconds = None
+  args.dry_mode = True
+  args.max_total_size_mb = None
+  args.min_free_space_mb = None
+  args.daily_backups_max_count = 5
+  args.weekly_backups_max_count = 3
+  args.monthly_backups_max_count = 6
+  args.yearly_backups_max_count = 0
+  return args
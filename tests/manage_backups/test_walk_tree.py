@@ -0,0 +1,58 @@
+import os
+
+import pytest
+
+import manage_backups
+
+
+def test_should_list_whole_tree(tmp_path):
+  """
+  Checks that every entry of a tree is listed exactly once, and symlinks to directories are not followed
+  """
+  # Configuration
+  expected = {""}
+  for i in range(20):
+    directory = tmp_path / ("dir%s" % i) / "nested"
+    directory.mkdir(parents=True)
+    (directory / "file").write_text("content")
+    expected.update({"dir%s" % i, os.path.join("dir%s" % i, "nested"), os.path.join("dir%s" % i, "nested", "file")})
+  (tmp_path / "link").symlink_to(tmp_path / "dir0")
+  expected.add("link")
+
+  # Run method under test
+  records = list(manage_backups._walk_tree(str(tmp_path), 4))
+
+  # Assertions
+  assert sorted(relpath for relpath, _ in records) == sorted(expected)
+  assert dict(records)[os.path.join("dir3", "nested", "file")].st_size == len("content")
+
+
+def test_should_sort_records_by_inode_within_window(tmp_path):
+  """
+  Checks that records are yielded in batches sorted by inode numbers
+  """
+  # Configuration
+  for i in range(30):
+    (tmp_path / ("file%s" % i)).write_text("")
+
+  # Run method under test
+  records = list(manage_backups._walk_tree(str(tmp_path), 2, window=10))
+
+  # Assertions
+  assert len(records) == 31
+  for start in range(0, 30, 10):
+    inodes = [stat.st_ino for _, stat in records[start:start + 10]]
+    assert inodes == sorted(inodes)
+
+
+def test_should_raise_errors_of_workers(tmp_path, mocker):
+  """
+  Checks that an error of listing a directory is raised to the consumer
+  """
+  # Configuration
+  (tmp_path / "dir").mkdir()
+  mocker.patch('manage_backups.os.scandir', side_effect=PermissionError("Permission denied"))
+
+  # Run method under test and assertions
+  with pytest.raises(PermissionError):
+    list(manage_backups._walk_tree(str(tmp_path), 3))